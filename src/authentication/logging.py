@@ -1,10 +1,21 @@
 # Logging functionality
 
 import json
+import lzma
+import os
+import threading
 import authentication.user
+import monitoring.metrics
+import monitoring.profiling
 import storage.encryption
+import storage.locking
 import validation.datetime
 
+lock = threading.Lock() # Held while writing to (or rewriting) the log files, so log maintenance never loses a line
+suspiciousPath = "./output/logs.suspicious" # Number of suspicious lines logged and how far every admin has viewed them (see storage.repositories.SuspiciousLogs)
+legacySuspiciousPath = "./output/logs-suspicious" # Copies of the unviewed suspicious lines, kept before the viewed marks replaced them
+
+@monitoring.profiling.timed("logging.log")
 def log(activity, details, suspicious = False):
     """Log a message"""
 
@@ -37,9 +48,77 @@ def log(activity, details, suspicious = False):
     # print("## LOG", data)
     data = { field: storage.encryption.encrypt(value) for field, value in data.items() }
     line = json.dumps(data) + "\n"
-    with open("./output/logs", "a") as file:
-        file.write(line)
-    if suspicious:
-        with open("./output/logs-suspicious", "a") as file:
-            file.write(line)
+    monitoring.metrics.increment("um_log_queue_depth", 1) # Waiting for the lock
+    with lock:
+        monitoring.metrics.increment("um_log_queue_depth", -1)
+        # Other processes may be logging at the same time: lines are appended with a single write, under a shared lock (log maintenance locks the file exclusively)
+        if not suspicious:
+            with storage.locking.locked("./output/logs"), open("./output/logs", "a") as file:
+                file.write(line)
+            return
+        def count(state):
+            # Counted while the suspicious state is locked, so the number always matches the suspicious lines in the log
+            with storage.locking.locked("./output/logs"), open("./output/logs", "a") as file:
+                file.write(line)
+            state["total"] += 1
+        changeSuspicious(count)
+
+
+def countSuspicious(lines):
+    """Count the suspicious lines among (encrypted) log lines (lines that can't be read are not counted)"""
+    count = 0
+    for line in lines:
+        try:
+            count += storage.encryption.decrypt(json.loads(line)["suspicious"]) == "Y"
+        except Exception:
+            pass
+    return count
+
+
+def initialSuspicious():
+    """Count the suspicious lines in the logs, for a new suspicious state
+    Lines left in the legacy file were not viewed yet: every admin starts with the lines before them marked as viewed (and the legacy file is removed)"""
+    import storage.retention
+    total = 0
+    for segment in storage.retention.segments("./output/logs"):
+        with lzma.open(segment, "rt") as file:
+            total += countSuspicious(file)
+    if os.path.exists("./output/logs"):
+        with storage.locking.locked("./output/logs"), open("./output/logs", "r") as file:
+            total += countSuspicious(file)
+    unviewed = 0
+    if os.path.exists(legacySuspiciousPath):
+        with storage.locking.locked(legacySuspiciousPath), open(legacySuspiciousPath, "r") as file:
+            unviewed = sum(1 for line in file if line.strip() != "")
+    return { "total": total, "dropped": 0, "default": max(total - unviewed, 0), "viewed": {}, "positions": {} }
+
+
+def readSuspicious():
+    """Get the suspicious state: the number of suspicious lines logged ("total"), the number of them in deleted archive segments ("dropped"),
+    the number of them every admin has viewed ("viewed": username => number; "default" for admins that have not marked any)
+    and where in the logs the viewed marks are ("positions": username => [segment, identity, byte position, number], see SuspiciousLogs)"""
+    with storage.locking.locked(suspiciousPath):
+        try:
+            with open(suspiciousPath, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            pass
+    return changeSuspicious(lambda state: None) # Created on first use
+
+
+def changeSuspicious(change):
+    """Change the suspicious state with {change}(state), while no other process can read or change it; returns the changed state"""
+    with storage.locking.locked(suspiciousPath, True):
+        try:
+            with open(suspiciousPath, "r") as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            state = initialSuspicious()
+        change(state)
+        with open(suspiciousPath + ".tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(suspiciousPath + ".tmp", suspiciousPath)
+        if os.path.exists(legacySuspiciousPath):
+            os.remove(legacySuspiciousPath) # Replaced by the state
+    return state
     
\ No newline at end of file
@@ -1,41 +1,81 @@
 # Authorization classes
 
+import contextlib
+import contextvars
 import os
 import authentication.logging
 import authentication.roles
+import monitoring.metrics
 import storage.encryption
+import storage.locking
 import storage.repositories
+import storage.view
 import validation.fields
 import validation.rules
 import validation.forms
 
-# Initialization
-currentUser = None
-try:
-    with open(r"./output/login-attempts", "r") as file:
-        maxAttempts = int(file.read())
-except:
-    maxAttempts = 5
+maxAttempts = 5 # Number of failed logins allowed before logging in is blocked
+
+
+class Session:
+    """State of one operator's session: the user (None if not logged in) and the number of login attempts left"""
+
+    def __init__(self, user = None, interactive = True, attempts = maxAttempts):
+        self.user = user
+        self.interactive = interactive # If False, never ask for input or print (refuse instead), for sessions that are not used from the console
+        self.attempts = attempts
+
+
+# Initialization: the console session is used unless another session is activated (see activate)
+def storedAttempts():
+    """Read the number of login attempts left on the console (shared by all processes using this output folder)"""
+    try:
+        with storage.locking.locked(r"./output/login-attempts"), open(r"./output/login-attempts", "r") as file:
+            return int(file.read())
+    except:
+        return maxAttempts
+
+
+consoleSession = Session(attempts = storedAttempts())
+activeSession = contextvars.ContextVar("session", default = None)
+
+
+def current():
+    """Get the session of the current context"""
+    session = activeSession.get()
+    return consoleSession if session is None else session
+
+
+@contextlib.contextmanager
+def activate(session):
+    """Use {session} as the current session in this context (and in tasks or threads started with a copy of it)"""
+    token = activeSession.set(session)
+    try:
+        yield session
+    finally:
+        activeSession.reset(token)
 
 
 def name():
     """Get the current user name"""
-    return currentUser.name if currentUser is not None else None
+    user = current().user
+    return user.name if user is not None else None
 
 
 def loggedIn():
     """Return if user is correctly logged in"""
-    return currentUser is not None and not currentUser.unauthorized()
+    user = current().user
+    return user is not None and not user.unauthorized()
 
 
 def role():
     """Get the current role if the user is logged in"""
-    return currentUser.role if loggedIn() else None
+    return current().user.role if loggedIn() else None
 
 
 def model():
     """Return the user model (profile fields) if the user is logged in"""
-    return currentUser.model if loggedIn() else None
+    return current().user.model if loggedIn() else None
 
 
 def checkPassword(password, user = None):
@@ -47,91 +87,141 @@ def checkPassword(password, user = None):
     return storage.encryption.checkDataHash(password, user["password"])
 
 
+def findUser(username, password):
+    """Check a username and password: returns the user object (Unauthorized if the login is not correct), the user model if it was found and whether the password is expired"""
+    if username == "super_admin" and password == "Admin_123?":
+        # Log in as super administrator
+        return authentication.roles.SuperAdministrator(username), None, False
+    # Find the user in the Users repository
+    foundUser = storage.repositories.Users().readInternal(username, False)
+    if foundUser is None or not checkPassword(password, foundUser):
+        return authentication.roles.Unauthorized(username, foundUser), foundUser, False
+    # Password is correct, create the correct User class
+    if foundUser["role"].upper() == "ADMINISTRATOR":
+        user = authentication.roles.Administrator(foundUser["username"], foundUser)
+    else:
+        user = authentication.roles.Consultant(foundUser["username"], foundUser)
+    # Passwords that do not conform to current password rules must be changed (except for hard-coded users)
+    expired = user.can("nothardcoded") and not validation.fields.Text("Login password", validation.rules.passwordRules).validate(password, False, False)
+    return user, foundUser, expired
+
+
+def failedLogin(session, username, foundUser):
+    """Log an incorrect login and count it against the session's login attempts"""
+    if foundUser is None:
+        logDetail = f"{username} is not an existing user"
+    elif foundUser["role"].upper() == "ADMINISTRATOR":
+        logDetail = f"{username} is an administrator"
+    else:
+        logDetail = f"{username} is a consultant"
+    authentication.logging.log("Incorrect login", logDetail)
+    monitoring.metrics.increment("um_failed_logins_total")
+    if session is consoleSession:
+        # Another process may have counted failed logins as well: count on from the lowest number
+        with storage.locking.locked(r"./output/login-attempts", True):
+            session.attempts = min(session.attempts, storedAttempts()) - 1
+            with open(r"./output/login-attempts", "w") as file:
+                file.write(str(session.attempts))
+    else:
+        session.attempts -= 1
+
+
+def loggedInNow(session):
+    """Log a successful login and reset the session's login attempts"""
+    authentication.logging.log("Logged in", "Role: " + session.user.__class__.__name__)
+    session.attempts = maxAttempts
+    if session is consoleSession:
+        try:
+            # Reset login attempts
+            with storage.locking.locked(r"./output/login-attempts", True):
+                os.remove(r"./output/login-attempts")
+        except:
+            # Not a problem if file does not exist because there have been no incorrect login attempts
+            pass
+
+
 def login():
     """Let a user enter their username and password to log in"""
-    global currentUser, maxAttempts
+    session = current()
     
     if loggedIn():
         # Already logged in
         return False
+
+    if not session.interactive:
+        return False # Nobody to ask (use authenticate)
     
     # Mark current user as unauthorized (will ask for login)
-    currentUser = authentication.roles.Unauthorized(None)
+    session.user = authentication.roles.Unauthorized(None)
     
-    while currentUser.unauthorized() and maxAttempts > 0:
+    while session.user.unauthorized() and session.attempts > 0:
         # Ask for login details until user is no longer unauthorized
 
         print("Please log in:")    
         result = validation.forms.Login().run()
-        usersRepository = storage.repositories.Users()
 
         if result is None:
             # Canceled with Ctrl+C
             return False
         
-        # Save the username we're trying to log in as
-        currentUser.name = result["username"]
-
-        foundUser = None
-        foundAdmin = None
-        # if result["username"] == "admin" and result["password"] == " ":
-        if result["username"] == "super_admin" and result["password"] == "Admin_123?":
-            # Log in as super administrator
-            currentUser = authentication.roles.SuperAdministrator(result["username"])
-        else:
-            # Find the user in the Users repository
-            foundUser = usersRepository.readInternal(currentUser.name, False)
-            if foundUser is not None:
-                foundAdmin = foundUser["role"].upper() == "ADMINISTRATOR"
-                currentUser.model = foundUser
-                if checkPassword(result["password"], foundUser):
-                    # Password is correct, create the correct User class
-                    if foundAdmin:
-                        currentUser = authentication.roles.Administrator(currentUser.model["username"], currentUser.model)
-                    else:
-                        currentUser = authentication.roles.Consultant(currentUser.model["username"], currentUser.model)
-                    if not validation.fields.Text("Login password", validation.rules.passwordRules).validate(result["password"], False, False):
-                        # Password does not conform to current password rules, require user to set a new one (except hard-coded users)
-                        if currentUser.can("nothardcoded") and not changePassword(result["password"]):
-                            # Canceled: force log out
-                            return False
-
-        if currentUser.unauthorized():
+        session.user, foundUser, expired = findUser(result["username"], result["password"])
+        if expired and not changePassword(result["password"]):
+            # Canceled: force log out
+            session.user = None
+            return False
+
+        if session.user.unauthorized():
             # Not logged in correctly
             print(" :: The username or password is incorrect")
-            if foundUser is None:
-                logDetail = f"{currentUser.name} is not an existing user"
-            elif foundAdmin:
-                logDetail = f"{currentUser.name} is an administrator"
-            else:
-                logDetail = f"{currentUser.name} is a consultant"
-            authentication.logging.log("Incorrect login", logDetail)
-            maxAttempts -= 1
-            with open(r"./output/login-attempts", "w") as file:
-                file.write(str(maxAttempts))
+            failedLogin(session, result["username"], foundUser)
         
-    if maxAttempts <= 0:
+    if session.attempts <= 0:
         # Too many failed logins
         print("You have reached the maximum number of login attempts. (Delete the 'login-attempts' file in the output folder to bypass this)")
         authentication.logging.log("Login blocked", "Reached maximum allowed number of login attempts", True)
         return False
 
+    loggedInNow(session)
+    return True
 
-    authentication.logging.log("Logged in", "Role: " + currentUser.__class__.__name__)
-    try:
-        # Reset login attempts
-        os.remove(r"./output/login-attempts")
-    except:
-        # Not a problem if file does not exist because there have been no incorrect login attempts
-        pass
+
+def authenticate(username, password):
+    """Log in to the current session without asking anything (for sessions that are not used from the console); returns if the login succeeded"""
+    session = current()
+
+    if session.attempts <= 0:
+        authentication.logging.log("Login blocked", "Reached maximum allowed number of login attempts", True)
+        return False
+
+    session.user, foundUser, expired = findUser(username, password)
+    if session.user.unauthorized():
+        failedLogin(session, username, foundUser)
+        return False
+    if expired:
+        # There is no way to ask for a new password here
+        authentication.logging.log("Login refused", "The password has expired and must be changed from the console")
+        session.user = None
+        return False
+
+    loggedInNow(session)
     return True
 
 
+def logout():
+    """Log the current user out and drop the decrypted data that is kept in memory for this session"""
+    session = current()
+
+    if loggedIn():
+        authentication.logging.log("Logged out", "Role: " + session.user.__class__.__name__)
+    session.user = None
+    storage.view.clearAll(session)
+
+
 def changePassword(currentPassword = None):
     """Let a user change their password"""
-    global currentUser
+    currentUser = current().user
 
-    if not loggedIn():
+    if not loggedIn() or not current().interactive:
         return
 
     if currentPassword is None:
@@ -167,7 +257,7 @@ def changePassword(currentPassword = None):
 
 def hasRole(role):
     """Check if current user has access to role"""
-    global currentUser
+    currentUser = current().user
 
     if currentUser is None:
         return False
@@ -179,15 +269,18 @@ def hasRole(role):
 
 def requireAccess(role, activity, details, suspicious = False):
     """Check if current user has access to role, allow them to log in if they aren't yet, and report them if they are unauthorized"""
-    global currentUser
+    session = current()
     
-    if currentUser is None and not login():
-        # Login was canceled
+    if session.user is None and not login():
+        # Login was canceled (or there is no one to ask)
+        if not session.interactive:
+            authentication.logging.log(activity, f"Not logged in. {details}", suspicious)
         return False
 
     if not hasRole(role):
         authentication.logging.log(activity, details, suspicious)
-        print("You are not allowed to perform this action. This incident will be reported.")
+        if session.interactive:
+            print("You are not allowed to perform this action. This incident will be reported.")
         return False
 
     return True
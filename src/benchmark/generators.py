@@ -0,0 +1,95 @@
+# Generators for synthetic (but valid) members, users and logs, used to fill repositories for benchmarking
+# The generators are seeded so every run produces the same data (only the encryption is randomized)
+
+import random
+import storage.allocator
+import storage.encryption
+import validation.forms
+import validation.rules
+
+firstNames = ["Jan", "Piet", "Klaas", "Anna", "Emma", "Sophie", "Daan", "Lucas", "Julia", "Sem", "Noah", "Tess", "Milan", "Fenna", "Ruben"]
+lastNames = ["Jansen", "de Vries", "van den Berg", "Bakker", "Visser", "Smit", "Meijer", "de Boer", "Mulder", "de Groot", "Bos", "Vos", "Peters"]
+streets = ["Hoofdstraat", "Kerkstraat", "Dorpsstraat", "Stationsweg", "Molenweg", "Schoolstraat", "Julianalaan", "Wilhelminastraat"]
+cities = ["Amsterdam", "Rotterdam", "Den Haag", "Utrecht", "Eindhoven", "Groningen", "Leiden", "Delft", "Dordrecht", "Gouda"]
+activities = ["Read all Members", "Search Members", "Read from Members", "Insert into Members", "Update Members", "Logged in", "Logged out", "Incorrect login"]
+idSalt = b"benchmark" # Fixed, so every run generates the same member IDs
+
+
+def date(generator):
+    """Random date between 2020-01-01 and 2023-12-28 (always valid and never in the future)"""
+    return f"{generator.randint(2020, 2023)}-{generator.randint(1, 12):02}-{generator.randint(1, 28):02}"
+
+
+def memberId(n):
+    """Unique member ID for the {n}th member (registered 2020-2023): the IDs of a year are numbered in the pseudo-random order of storage.allocator, with the checksum of generateMemberId"""
+    if n // 4 >= storage.allocator.idsPerYear:
+        raise ValueError(f"No more than {4 * storage.allocator.idsPerYear} unique member IDs can be generated")
+    newID = f"{20 + n % 4}{storage.allocator.permute(n // 4, idSalt):07d}"
+    return newID + validation.rules.memberIDChecksum(newID)
+
+
+def members(count, seed = 1, start = 0):
+    """Yield {count} valid members, numbered from {start}"""
+    generator = random.Random(seed)
+    form = validation.forms.Member()
+    for n in range(start, start + count):
+        firstName = generator.choice(firstNames)
+        lastName = generator.choice(lastNames)
+        model = {
+            "id": memberId(n),
+            "firstName": firstName,
+            "lastName": lastName,
+            "age": str(generator.randint(18, 99)),
+            "gender": generator.choice(["M", "F", "X"]),
+            "weight": str(generator.randint(45, 150)),
+            "street": generator.choice(streets),
+            "no": str(generator.randint(1, 300)) + generator.choice(["", "", "", "A", "B"]),
+            "zip": f"{generator.randint(1000, 9999)}{generator.choice('ABCDEFGHJKLMNPRSTVWXZ')}{generator.choice('ABCDEFGHJKLMNPRSTVWXZ')}",
+            "city": generator.choice(cities),
+            "email": f"{firstName}.{lastName}.{n}@example.com".lower().replace(" ", ""),
+            "phone": f"{generator.randint(10000000, 99999999)}",
+            "registrationDate": date(generator),
+        }
+        if not form.validate(model):
+            raise ValueError(f"Generated an invalid member: {form.errors}")
+        yield model
+
+
+def users(count, seed = 1):
+    """Yield {count} valid consultants (all with the same hashed password, since hashing is not what is being measured)"""
+    generator = random.Random(seed)
+    form = validation.forms.User()
+    password = storage.encryption.hashDataWithSalt("Benchmark-Password-1")
+    for n in range(count):
+        model = {
+            "username": f"user{n:06}",
+            "password": password,
+            "firstName": generator.choice(firstNames),
+            "lastName": generator.choice(lastNames),
+            "role": "Consultant",
+            "registrationDate": date(generator),
+        }
+        if not form.validate(model):
+            raise ValueError(f"Generated an invalid user: {form.errors}")
+        yield model
+
+
+def logs(count, seed = 1):
+    """Yield {count} valid log lines (in date order, about 1 in 20 suspicious)"""
+    generator = random.Random(seed)
+    form = validation.forms.Log()
+    for n in range(count):
+        suspicious = generator.random() < 0.05
+        seconds = n * 86400 * 365 * 3 // max(count, 1) # Spread over three years
+        day = seconds // 86400
+        model = {
+            "date": f"{2021 + day // 336}-{day % 336 // 28 + 1:02}-{day % 28 + 1:02}",
+            "time": f"{seconds % 86400 // 3600:02}:{seconds % 3600 // 60:02}:{seconds % 60:02}",
+            "username": f"user{generator.randint(0, 99):06}",
+            "activity": "Incorrect login" if suspicious else generator.choice(activities),
+            "details": f"Benchmark log line {n}",
+            "suspicious": "Y" if suspicious else "N",
+        }
+        if not form.validate(model):
+            raise ValueError(f"Generated an invalid log line: {form.errors}")
+        yield model
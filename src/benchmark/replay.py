@@ -0,0 +1,191 @@
+# Replay recorded keystroke scripts through the interactive application and time every interaction
+# Run from the src folder: python -m benchmark.replay benchmark/scripts/members.txt [--members 10000] [--repeat 3] [--output results.json]
+# Record a new script with: python -m benchmark.replay --record my-script.txt [--members 10000]
+#
+# A script has one line of input per line (an empty line is pressing enter); lines starting with "#" are comments,
+# which label the interaction that follows (start a line with "\#" to enter something that starts with "#")
+# "{member 500}" is replaced by the ID of generated member 500 (numbered from 0), so a script does not depend on how the IDs are generated; --members must be large enough to include it
+# Every interaction is timed from the moment the input is given until the application asks for the next input
+
+import argparse
+import contextlib
+import io
+import os
+import re
+import statistics
+import time
+import benchmark.generators
+import benchmark.run
+import authentication.user
+import storage.repositories
+import validation.fields
+
+
+memberPattern = re.compile(r"\{member (\d+)\}")
+
+
+def parse(text):
+    """Parse a script into a list of (label, input) pairs"""
+    lines = []
+    label = None
+    for line in text.splitlines():
+        if line.startswith("#"):
+            label = line[1:].strip()
+            continue
+        if line.startswith("\\#"):
+            line = line[1:]
+        lines.append((label, line))
+        label = None
+    return lines
+
+
+def membersNeeded(lines):
+    """Number of generated members a script needs (one more than the highest generated member it refers to)"""
+    return max((int(number) + 1 for _, line in lines for number in memberPattern.findall(line)), default = 0)
+
+
+def fillMembers(lines):
+    """Replace the references to generated members in a script by their IDs"""
+    return [(label, memberPattern.sub(lambda match: benchmark.generators.memberId(int(match.group(1))), line)) for label, line in lines]
+
+
+class Replay:
+    """Input source that answers the application's prompts from a script, and records the time and output of every interaction"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.position = 0
+        self.output = io.StringIO() # Everything the application prints
+        self.interactions = []
+        self.answered = None # Time the last input was given
+
+
+    def __call__(self, prompt):
+        now = time.perf_counter()
+        self.output.write(prompt) # Like input() would
+        if self.answered is not None:
+            # The application has finished handling the previous input
+            interaction = self.interactions[-1]
+            interaction["seconds"] = now - self.answered
+            interaction["nextPrompt"] = prompt.strip()
+            interaction["output"] = self.output.getvalue()[interaction.pop("outputStart"):]
+            self.answered = None
+        if self.position >= len(self.lines):
+            raise EOFError # End of the script: handled like Ctrl+C, so the application backs out of every menu
+        label, value = self.lines[self.position]
+        self.position += 1
+        hidden = "password" in prompt.lower()
+        self.output.write(("*" * len(value) if hidden else value) + "\n")
+        self.interactions.append({ "step": self.position, "label": label, "prompt": prompt.strip(), "input": "***" if hidden else value, "outputStart": self.output.tell() })
+        self.answered = time.perf_counter()
+        return value
+
+
+    def finish(self):
+        """Close the last interaction (when the application has quit)"""
+        if self.answered is not None:
+            interaction = self.interactions[-1]
+            interaction["seconds"] = time.perf_counter() - self.answered
+            interaction["nextPrompt"] = None
+            interaction["output"] = self.output.getvalue()[interaction.pop("outputStart"):]
+            self.answered = None
+
+
+class Recorder:
+    """Input source that asks for input as usual and writes it to a script"""
+
+    def __init__(self, file):
+        self.file = file
+
+
+    def __call__(self, prompt):
+        value = input(prompt)
+        self.file.write(f"# {prompt.strip()}\n")
+        self.file.write(("\\" if value.startswith("#") else "") + value + "\n")
+        self.file.flush()
+        return value
+
+
+def runApplication(source):
+    """Run the application (from the main menu until it quits) with input from {source}"""
+    import logic.menus # Imported here, so the repositories are created inside the benchmark workspace
+    validation.fields.inputSource = source
+    try:
+        with authentication.user.activate(authentication.user.Session()): # A new console session every time
+            logic.menus.main.run()
+    finally:
+        validation.fields.inputSource = input
+
+
+def populate(members, seed):
+    """Fill the database with {members} generated members (and start with empty logs)"""
+    for path in ["./output/database", "./output/logs", "./output/logs.suspicious", "./output/login-attempts"]:
+        if os.path.exists(path):
+            os.unlink(path)
+    benchmark.run.populate(storage.repositories.Members(), benchmark.generators.members(members, seed))
+
+
+def replay(lines, members, seed):
+    """Replay one script on a freshly populated database"""
+    populate(members, seed)
+    source = Replay(lines)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(source.output):
+        runApplication(source)
+    source.finish()
+    return { "seconds": time.perf_counter() - start, "inputsUsed": source.position, "interactions": source.interactions }
+
+
+def summary(runs):
+    """Median time of every interaction over all runs"""
+    steps = {}
+    for run in runs:
+        for interaction in run["interactions"]:
+            if "seconds" in interaction:
+                steps.setdefault((interaction["step"], interaction["label"], interaction["prompt"], interaction["input"]), []).append(interaction["seconds"])
+    return [{ "step": step, "label": label, "prompt": prompt, "input": value, "median": statistics.median(seconds), "max": max(seconds) } for (step, label, prompt, value), seconds in sorted(steps.items(), key = lambda item: item[0][0])]
+
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description = "Replay keystroke scripts through the application and time every interaction")
+    parser.add_argument("scripts", nargs = "*", help = "Script files to replay")
+    parser.add_argument("--record", default = None, help = "Record a new script to this file (runs the application interactively)")
+    parser.add_argument("--members", type = int, default = 1000, help = "Number of generated members in the database (default: 1000)")
+    parser.add_argument("--seed", type = int, default = 1, help = "Seed for the data generators (default: 1)")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Number of times to replay every script (default: 3)")
+    parser.add_argument("--output", default = None, help = "File to write the JSON results to (default: print them)")
+    options = parser.parse_args(arguments)
+    if options.record is None and len(options.scripts) == 0:
+        parser.error("Give one or more scripts to replay, or --record")
+    outputPath = None if options.output is None else os.path.abspath(options.output)
+    recordPath = None if options.record is None else os.path.abspath(options.record)
+    scripts = {}
+    for path in options.scripts:
+        with open(path, "r") as file:
+            lines = parse(file.read())
+        needed = membersNeeded(lines)
+        if options.members < needed:
+            parser.error(f"{path} refers to generated member {needed - 1}, so it needs --members {needed} or more")
+        scripts[path] = fillMembers(lines)
+
+    with benchmark.run.workspace():
+        if recordPath is not None:
+            populate(options.members, options.seed)
+            with open(recordPath, "w") as file:
+                runApplication(Recorder(file))
+            print(f"Script written to '{recordPath}'")
+            return None
+
+        results = benchmark.run.environment()
+        results.update({ "members": options.members, "repeat": options.repeat, "seed": options.seed, "scripts": [] })
+        for path, lines in scripts.items():
+            print(f"Replaying {path}...")
+            runs = [replay(lines, options.members, options.seed) for _ in range(options.repeat)]
+            results["scripts"].append({ "script": path, "inputs": len(lines), "summary": summary(runs), "runs": runs })
+
+    benchmark.run.writeResults(results, outputPath)
+    return results
+
+
+if __name__ == '__main__':
+    main()
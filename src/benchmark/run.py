@@ -0,0 +1,220 @@
+# Benchmark suite: fills the repositories with synthetic data and times the common operations
+# Run from the src folder: python -m benchmark.run [--sizes 1000,100000,1000000] [--repeat 3] [--output results.json]
+# Everything happens in a temporary working directory (the real ./output and ./backups folders are never touched)
+# The results are written as JSON, so runs on different commits can be compared
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import benchmark.generators
+import authentication.roles
+import authentication.user
+import storage.abstract
+import storage.backup
+import storage.encryption
+import storage.repositories
+import validation.forms
+
+
+class FileMembers(storage.abstract.FileRepository):
+    """Members stored in a file instead of the database (to compare both repository types with the same data)"""
+
+    def __init__(self, path = "./output/members"):
+        super().__init__(path)
+        self.form = validation.forms.Member()
+        self.idField = "id"
+
+    def readRole(self, id, item):
+        return "consult"
+    def updateRole(self, id, item):
+        return "consult"
+    def deleteRole(self, id, item):
+        return "admin"
+    def insertRole(self):
+        return "consult"
+
+
+def populate(repository, models, batchSize = 10000):
+    """Store generated models without the checks of insert (much faster, since insert checks for duplicates and logs every item)
+    Database rows are added with _addMany, {batchSize} per transaction, so the indexes (and the member statistics and name trigrams) are kept up to date like they are for inserted rows"""
+    if isinstance(repository, storage.abstract.SQLiteRepository):
+        models = iter(models)
+        while True:
+            batch = list(itertools.islice(models, batchSize))
+            if len(batch) == 0:
+                break
+            if not repository._addMany(batch):
+                raise RuntimeError(f"Could not populate {repository.name} (check the logs for more information)")
+    else:
+        rows = ([storage.encryption.encrypt(value) for value in model.values()] for model in models)
+        fields = list(repository.form.fields)
+        with open(repository.path, "a") as file:
+            for row in rows:
+                file.write(json.dumps(dict(zip(fields, row))) + "\n")
+
+
+def measure(function, repeat):
+    """Time a function {repeat} times (it gets the repetition number); returns the timings and whether every call succeeded"""
+    seconds = []
+    succeeded = True
+    for n in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()): # Some operations print progress
+            start = time.perf_counter()
+            result = function(n)
+            seconds.append(time.perf_counter() - start)
+        succeeded = succeeded and result is not None and result is not False
+    return { "seconds": seconds, "min": min(seconds), "median": statistics.median(seconds), "mean": statistics.mean(seconds), "succeeded": succeeded }
+
+
+def repositoryOperations(repository, size, repeat, seed):
+    """Time list, search, readOne, insert, update and delete on a repository with {size} members"""
+    middle = benchmark.generators.memberId(size // 2) if size > 0 else None
+    extra = list(benchmark.generators.members(repeat, seed, size)) # New members for inserting (with IDs that are not used yet)
+    results = {}
+    results["list"] = measure(lambda n: repository.readAll(0, 20, None, True), repeat)
+    results["search"] = measure(lambda n: repository.readAll(0, 20, "no such member"), repeat) # Nothing matches, so everything is scanned
+    if middle is not None:
+        results["readOne"] = measure(lambda n: repository.readOne(middle), repeat)
+    results["insert"] = measure(lambda n: repository.insert(extra[n]), repeat)
+    results["update"] = measure(lambda n: repository.update(extra[n]["id"], { "city": "Gouda" }), repeat)
+    results["delete"] = measure(lambda n: repository.delete(extra[n]["id"]), repeat)
+    return results
+
+
+def backupOperations(repeat):
+    """Time a backup and a restore of the database and logs, the same way the Backup or Restore menu does (but without asking anything)"""
+    zipPath = "./backups/benchmark.zip"
+    backupDb = "./backups/.temp-backup"
+
+    def backup(n):
+        if os.path.exists(backupDb):
+            os.unlink(backupDb)
+        storage.backup.backupRepository(storage.repositories.Users(), storage.repositories.Users(backupDb))
+        storage.backup.backupRepository(storage.repositories.Members(), storage.repositories.Members(backupDb))
+        storage.backup.zip({ backupDb: "database", "./output/logs": "logs" }, zipPath)
+        os.unlink(backupDb)
+        return os.path.exists(zipPath)
+
+    def restore(n):
+        if not storage.backup.unzip(zipPath, "database", "./backups"):
+            return False
+        storage.backup.backupRepository(storage.repositories.Users("./backups/database"), storage.repositories.Users(), True)
+        storage.backup.backupRepository(storage.repositories.Members("./backups/database"), storage.repositories.Members(), True)
+        os.unlink("./backups/database")
+        return True
+
+    return { "backup": measure(backup, repeat), "restore": measure(restore, repeat) }
+
+
+def runSize(size, repeat, seed, backupLimit):
+    """Run all benchmarks for one data size in a clean ./output folder"""
+    for path in ["./output/database", "./output/members", "./output/logs", "./output/login-attempts"]:
+        if os.path.exists(path):
+            os.unlink(path)
+    shutil.rmtree("./backups", ignore_errors = True)
+    os.mkdir("./backups")
+
+    members = storage.repositories.Members()
+    fileMembers = FileMembers()
+    users = storage.repositories.Users()
+    logs = storage.repositories.Logs()
+
+    start = time.perf_counter()
+    populate(members, benchmark.generators.members(size, seed))
+    populate(fileMembers, benchmark.generators.members(size, seed))
+    populate(users, benchmark.generators.users(min(size, 100), seed))
+    populate(logs, benchmark.generators.logs(size, seed))
+    results = { "size": size, "populateSeconds": time.perf_counter() - start }
+
+    results["sqlite"] = repositoryOperations(members, size, repeat, seed)
+    results["file"] = repositoryOperations(fileMembers, size, repeat, seed)
+    results["logs"] = {
+        "list": measure(lambda n: logs.readAll(0, 20, None, True), repeat),
+        "search": measure(lambda n: logs.readAll(0, 20, "no such log"), repeat),
+        "readOne": measure(lambda n: logs.readOne(size // 2 + 1), repeat),
+    }
+    if size <= backupLimit:
+        results["system"] = backupOperations(repeat)
+    else:
+        # Backups copy item by item and check every item for duplicates, which takes hours on large databases
+        results["system"] = { operation: { "skipped": f"More than {backupLimit} rows (see --backup-limit)" } for operation in ["backup", "restore"] }
+    return results
+
+
+@contextlib.contextmanager
+def workspace():
+    """Run in a temporary working directory with its own ./output folder and encryption keys (removed afterwards)"""
+    workingDirectory = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix = "um-benchmark-") as directory:
+        os.chdir(directory)
+        try:
+            os.mkdir("./output")
+            storage.encryption.initializeKeys()
+            yield directory
+        finally:
+            os.chdir(workingDirectory)
+
+
+def commit():
+    """Get the current git commit (if available)"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True, text = True, check = True, cwd = os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Information about this run, to include in the results"""
+    return {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def writeResults(results, outputPath = None):
+    """Write the results as JSON to a file, or print them if there is no {outputPath}"""
+    text = json.dumps(results, indent = 2)
+    if outputPath is None:
+        print(text)
+    else:
+        with open(outputPath, "w") as file:
+            file.write(text + "\n")
+        print(f"Results written to '{outputPath}'")
+
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the repositories with synthetic data")
+    parser.add_argument("--sizes", default = "1000,100000,1000000", help = "Comma-separated numbers of rows to test with (default: 1000,100000,1000000)")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Number of times to run every operation (default: 3)")
+    parser.add_argument("--seed", type = int, default = 1, help = "Seed for the data generators (default: 1)")
+    parser.add_argument("--backup-limit", type = int, default = 1000, help = "Skip backup and restore above this number of rows (default: 1000)")
+    parser.add_argument("--output", default = None, help = "File to write the JSON results to (default: print them)")
+    options = parser.parse_args(arguments)
+    sizes = [int(size) for size in options.sizes.split(",")]
+    outputPath = None if options.output is None else os.path.abspath(options.output)
+
+    results = environment()
+    results.update({ "repeat": options.repeat, "seed": options.seed, "runs": [] })
+
+    with workspace(), authentication.user.activate(authentication.user.Session(authentication.roles.SuperAdministrator("super_admin"), False)): # All operations are allowed
+        for size in sizes:
+            print(f"Benchmarking with {size} rows...")
+            results["runs"].append(runSize(size, options.repeat, options.seed, options.backup_limit))
+
+    writeResults(results, outputPath)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,21 @@
 # Logic for actions that fall outside the menus and repository table view
 
-from functools import reduce
 import datetime
-import random
 import os
+import time
 import validation.fields
 import validation.forms
+import validation.rules
 import authentication.user
 import authentication.logging
+import monitoring.metrics
+import monitoring.profiling
+import storage.allocator
 import storage.backup
 import storage.encryption
 import storage.repositories
+import storage.rotation
+import storage.statistics
 
 
 def changePassword(currentPassword = None):
@@ -22,6 +27,12 @@ def changePassword(currentPassword = None):
     authentication.user.changePassword()
 
 
+def logout():
+    """Log out the current user (this quits the application)"""
+    authentication.user.logout()
+    return True
+
+
 def createNewItem(title, repository, fixedValues = None, runAfter = lambda _: None):
     """Create a new item in a repository, with default values available"""
 
@@ -41,7 +52,17 @@ def createNewItem(title, repository, fixedValues = None, runAfter = lambda _: No
     # Allow some last changes to be made
     runAfter(model)
     
-    if repository.idField is not None and repository.idField in model and repository._one(model[repository.idField]) is not None:
+    similar = repository._similar(model) # Index lookups only
+    if len(similar) > 0:
+        # Possibly the same person or thing, registered before
+        print(f"There {'is another' if sum(len(ids) for ids in similar.values()) == 1 else 'are other'} {repository.form.name.lower()}(s) with the same:")
+        for fields, ids in similar.items():
+            print(f"  {', '.join(repository.form.fields[field].name for field in fields)}: {', '.join(str(id) for id in ids)}")
+        confirm = validation.fields.Text(f"Do you want to add this {repository.form.name.lower()} anyway? (Y/N)", [validation.rules.valueInList(["Y", "N"])]).run()
+        if confirm is None or confirm.upper() != "Y":
+            return
+
+    if repository.idField is not None and repository.idField in model and repository.exists(model[repository.idField]):
         # Item with this ID already exists!
         print(f"{repository.form.name} with {repository.form.fields[repository.idField].name} '{model[repository.idField]}' already exists!")
     elif repository.insert(model):
@@ -126,6 +147,7 @@ def createBackup():
 
     print()
     print("Backing up database...")
+    started = time.perf_counter()
         
     storage.backup.backupRepository(users, usersBackup)
     storage.backup.backupRepository(members, membersBackup)
@@ -152,6 +174,9 @@ def createBackup():
         os.unlink(file)
 
     if os.path.exists(outputPath):
+        monitoring.metrics.gauge("um_backup_duration_seconds", time.perf_counter() - started)
+        monitoring.metrics.gauge("um_backup_size_bytes", os.path.getsize(outputPath))
+        monitoring.metrics.gauge("um_backup_timestamp_seconds", int(time.time()))
         print(f"The database and logs were backed up to '{zipName}'")
     else:
         print("Something went wrong during the backup. Check the logs for more information.")
@@ -255,14 +280,153 @@ def extractBackupLogs(showMenu):
 
 
 def generateMemberId():
-    """Generate a new, valid, unused member ID for the current year"""
-
-    newID = validation.datetime.shortYear()
-    for _ in range(7):
-        # Add 7 random digits
-        newID += random.choice("0123456789")
-    newID += str(reduce(lambda check, digit: (check + ord(digit) - 8) % 10, newID, 0))
-    if storage.repositories.Users().exists(newID):
-        # If it randomly happens to exist, try again
-        return generateMemberId()
-    return newID
\ No newline at end of file
+    """Generate a new, valid, unused member ID for the current year (it is reserved, so it won't be generated again)"""
+
+    return storage.allocator.memberIds(storage.repositories.Members())[0]
+
+
+def profiling():
+    """Show the profiling report and allow the profiling to be turned on or off"""
+
+    title = "Profiling"
+    print() # newline
+    print(title)
+    print("*" * len(title))
+
+    if not authentication.user.requireAccess("admin", "Profiling", "Attempt to access the profiling report", True):
+        return
+
+    print(f"Profiling is {'on' if monitoring.profiling.enabled else 'off'}")
+    print() # newline
+    for line in monitoring.profiling.report():
+        print("  " + line)
+    print() # newline
+
+    result = validation.fields.Text(f"Do you want to turn profiling {'off' if monitoring.profiling.enabled else 'on'}? (Y/N)", [validation.rules.valueInList(["Y", "N"])]).run()
+    if result is None or result.upper() != "Y":
+        return
+    monitoring.profiling.enable(not monitoring.profiling.enabled)
+    authentication.logging.log("Profiling turned " + ("on" if monitoring.profiling.enabled else "off"), "From the System maintenance menu")
+    print(f"Profiling has been turned {'on' if monitoring.profiling.enabled else 'off'}")
+    validation.fields.EmptyValue(f"Press enter to continue").run()
+
+
+def metrics():
+    """Show a snapshot of the metrics (the same as the file that is written for the operations dashboards)"""
+
+    title = "Metrics"
+    print() # newline
+    print(title)
+    print("*" * len(title))
+
+    if not authentication.user.requireAccess("admin", "Metrics", "Attempt to access the metrics", True):
+        return
+
+    print(f"A snapshot is written to '{monitoring.metrics.path}' every {monitoring.metrics.interval} seconds")
+    print() # newline
+    for line in monitoring.metrics.snapshot().splitlines():
+        if not line.startswith("# TYPE"):
+            print("  " + line)
+    print() # newline
+    validation.fields.EmptyValue(f"Press enter to continue").run()
+
+
+def rotateKey():
+    """Show the progress of the encryption key rotation, or start a new rotation"""
+
+    title = "Rotate the encryption key"
+    print() # newline
+    print(title)
+    print("*" * len(title))
+
+    if not authentication.user.requireAccess("super", "Rotate encryption key", "Attempt to rotate the encryption key", True):
+        return
+
+    status = storage.rotation.status()
+    if status is not None:
+        print("The encryption key is being rotated in the background:")
+        print("  " + status)
+        storage.rotation.start() # In case it is not running in any process
+    else:
+        print("Everything will be re-encrypted with a new key in the background, while the application can still be used.")
+        print("Backups made before the rotation can't be restored after it has finished (make a new backup afterwards).")
+        confirm = validation.fields.Text(f"Do you want to rotate the encryption key? (Y/N)", [validation.rules.valueInList(["Y", "N"])]).run()
+        if confirm == "Y" and storage.rotation.begin():
+            storage.rotation.start()
+            print("The rotation has started")
+    print() # newline
+    validation.fields.EmptyValue(f"Press enter to continue").run()
+
+
+def memberStatistics():
+    """Show the member statistics (kept up to date while members are changed, so the members are not read for this)"""
+
+    title = "Member statistics"
+    print() # newline
+    print(title)
+    print("*" * len(title))
+
+    if not authentication.user.requireAccess("admin", "Member statistics", "Attempt to view the member statistics", True):
+        return
+
+    repository = storage.repositories.Members()
+    stats = storage.statistics.read(repository)
+    members = repository.count()
+    if stats is None or stats["members"] != members:
+        print("The statistics have not been built yet" if stats is None else f"The statistics count {stats['members']} members, but there are {members} (a change was not counted)")
+        confirm = validation.fields.Text(f"Do you want to build them from all members now? (Y/N)", [validation.rules.valueInList(["Y", "N"])]).run()
+        if confirm == "Y":
+            print("Reading all members...")
+            stats = storage.statistics.rebuild(repository)
+        if stats is None:
+            return
+    authentication.logging.log("View member statistics", f"Members: {stats['members']}")
+
+    sections = { "city": "Members per city", "gender": "Gender", "age": "Age", "weight": "Weight (kg)", "registrations": "Registrations per month" }
+    print(f"Members: {stats['members']}")
+    for statistic, heading in sections.items():
+        print() # newline
+        print(heading)
+        groups = stats[statistic]
+        if statistic in ("age", "weight"):
+            order = sorted(groups, key = lambda key: (key == "unknown", int(key.split("-")[0]) if key != "unknown" else 0)) # Ranges from low to high
+        elif statistic == "registrations":
+            order = sorted(groups) # Months in order
+        else:
+            order = sorted(groups, key = lambda key: -groups[key]) # Largest first
+        for key in order:
+            print(f"  {key.ljust(12)} {str(groups[key]).rjust(7)}  ({groups[key] / max(stats['members'], 1):.1%})")
+    print() # newline
+    validation.fields.EmptyValue(f"Press enter to continue").run()
+
+
+def memberDuplicates():
+    """Show the members that are likely registered more than once: members with the same e-mail address, phone number or name (found in the keyed indexes, in linear time)"""
+
+    title = "Find likely duplicate members"
+    print() # newline
+    print(title)
+    print("*" * len(title))
+
+    if not authentication.user.requireAccess("admin", "Find duplicate members", "Attempt to find duplicate members", True):
+        return
+
+    repository = storage.repositories.Members()
+    authentication.logging.log("Find duplicate members", "From the Manage members menu")
+    groups = 0
+    try:
+        for fields, items in repository._duplicates():
+            if groups == 0:
+                print(repository.form.generateHeader("  " + repository.form.fields[repository.idField].name.ljust(10)[:10]))
+            groups += 1
+            print() # newline
+            print(f"Same {', '.join(repository.form.fields[field].name.lower() for field in fields)}:")
+            for item in items:
+                print(f"  {str(item[repository.idField]).ljust(10)} | {repository.form.row(item)}")
+    except Exception:
+        print() # newline
+        print("Not all members could be read (the error has been logged)")
+    print() # newline
+    print(f"{groups} group(s) of likely duplicates found" if groups > 0 else "No likely duplicates found")
+    validation.fields.EmptyValue(f"Press enter to continue").run()
+
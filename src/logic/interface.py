@@ -1,7 +1,9 @@
 # Logic to display interfaces
 
+import threading
 import validation.fields
 import authentication.user
+import monitoring.metrics
 
 class MenuOption:
     """Simple class that represents a menu option"""
@@ -23,6 +25,7 @@ class Menu:
         self.extraAction = extraAction
         self.optionSeparator = ": "
         self.rekey = False # If True, key by re-generated number to prevent holes
+        self.listOptions = True # If False, the options have already been listed (by extraAction)
 
 
     def run(self):
@@ -59,8 +62,9 @@ class Menu:
         if len(optionsAvailable) > 0:
             # Generate a field from the list of options
             optionField = validation.fields.FromList(self.fieldName, optionsAvailable + [""])
-            for option in optionsAvailable:
-                print(f"  {option.ljust(optionLength)}{self.optionSeparator}{self.options[parsedOptions[option.upper()]].title}")
+            if self.listOptions:
+                for option in optionsAvailable:
+                    print(f"  {option.ljust(optionLength)}{self.optionSeparator}{self.options[parsedOptions[option.upper()]].title}")
 
             print() # newline
         else:
@@ -95,7 +99,7 @@ class Menu:
 class RepositoryMenu(Menu):
     """Class that lists items in the repository"""
 
-    def __init__(self, title, repository, deleteWhenViewed = False, extraItemOptions = None, search = None):
+    def __init__(self, title, repository, deleteWhenViewed = False, extraItemOptions = None, search = None, fuzzy = False):
         """Initialize by generating menu option from repository items"""
         self.repository = repository
         self.title = title
@@ -104,26 +108,190 @@ class RepositoryMenu(Menu):
         self.description = ""
         self.offset = 0
         self.limit = 20
-        self.deleteWhenViewed = deleteWhenViewed # Repositories that need to be deleted when viewed
+        self.page = 1 # Number of the current page
+        self.deleteWhenViewed = deleteWhenViewed # Repositories whose items are marked as viewed instead of edited (see SuspiciousLogs.markViewed)
         self.extraItemOptions = extraItemOptions # lambda id, item that should return a list of extra menu options to be shown when viewing an item
         self.search = search # Search query
-        self.extraAction = None
+        self.fuzzy = fuzzy # If True, the search query is a name that may contain typos (see fuzzySearch of the repository)
+        self.extraAction = self.generateOptions # The items are listed while they are being found
+        self.listOptions = False
         self.optionSeparator = " | "
         self.rekey = False
+        self.padding = 6 if repository.idField is None else 10 # Width of the ID column (line numbers or ID values)
+        self.source = None # Scan that is still running, to continue from when the next page is shown
+        self.sourceOffset = 0 # Offset the running scan continues from
+        self.pages = {} # Cache of pages that have been read: offset => (repository version, items, offset after the page)
+        self.maxPages = 10 # Number of pages to keep in the cache
+        self.items = {} # Items on the current page
+        self.version = None # Repository version the current page was read at
+        self.pageEnd = 0 # Offset right after the items on the current page
+        self.cancelled = False # True if the scan was stopped with Ctrl+C (or by an error)
+        self.failed = False # True if the scan was stopped by an error (which has been logged)
+        self.progressShown = False
+        self.prefetcher = None # Thread that reads the next page in the background
+        self.stopPrefetching = False
 
 
     def run(self):
-        """Load the options and show the menu"""
-        self.generateOptions()
+        """Show the menu (and stop scanning when it is closed)"""
         super().run()
+        self.stop()
+
+
+    def stop(self):
+        """Stop the running scan (if any)"""
+        self.stopPrefetching = True
+        self.waitForPrefetch()
+        self.stopPrefetching = False
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+
+
+    def showProgress(self, scanned):
+        """Show how many items have been scanned so far (on a line that is overwritten by the next item)"""
+        if threading.current_thread() is not threading.main_thread():
+            return # Don't show the progress of reading ahead in the background
+        print(f"\r  ... {scanned} scanned", end = "", flush = True)
+        self.progressShown = True
+
+
+    def clearProgress(self):
+        """Remove the progress line"""
+        if self.progressShown:
+            print("\r" + " " * 40 + "\r", end = "", flush = True)
+            self.progressShown = False
+
+
+    def cachePage(self, offset, version, items, pageEnd):
+        """Keep a page that was read completely in the cache"""
+        self.pages[offset] = (version, items, pageEnd)
+        while len(self.pages) > self.maxPages:
+            del self.pages[next(iter(self.pages))] # Forget the oldest page
+
+
+    def prefetch(self):
+        """Read the next page in the background, while the user is looking at this one (the menu waits for it, or stops it, before it uses the repository itself)"""
+        offset = self.pageEnd
+        version = self.repository.version()
+        items = {}
+        try:
+            for id, item in self.source:
+                items[id] = item
+                if len(items) >= self.limit or self.stopPrefetching:
+                    break
+            else:
+                self.source = None # Finished scanning
+        except Exception:
+            self.source = None # Read it again when it is needed (errors will be logged then)
+            return
+        if len(items) < self.limit and self.source is not None:
+            # Stopped halfway through the page: this scan can't be continued
+            self.source.close()
+            self.source = None
+            return
+        self.sourceOffset = self.repository.nextOffset
+        self.cachePage(offset, version, items, self.sourceOffset)
+
+
+    def waitForPrefetch(self):
+        """Wait until the next page has been read in the background (can be interrupted with Ctrl+C)"""
+        try:
+            while self.prefetcher is not None and self.prefetcher.is_alive():
+                self.prefetcher.join(0.1)
+        except KeyboardInterrupt:
+            self.stopPrefetching = True
+            self.prefetcher.join()
+            raise
+        self.prefetcher = None
 
 
     def generateOptions(self):
-        """Generate menu options for items"""
-        items = self.repository.readAll(self.offset, self.limit, self.search)
-        if items is None or len(items) == 0:
-            self.options = {}
-            if self.offset > 0:
+        """Generate menu options for the items on this page, and list every item as soon as it is found"""
+        self.cancelled = False
+        self.failed = False
+        self.options = {}
+        self.items = {}
+        try:
+            self.waitForPrefetch() # Only one thread uses the repository at a time (reading ahead uses its form and nextOffset too)
+        except KeyboardInterrupt:
+            pass # Stopped reading ahead: the page is read here instead
+
+        if self.search:
+            print(f"Searching for '{self.search}' (press Ctrl+C to stop searching)")
+        else:
+            total = self.repository.count() # Kept up to date by the repository, so the items are not read for this
+            if total is not None:
+                print(f"Showing page {self.page} of {max(-(-total // self.limit), 1)} ({total} {'item' if total == 1 else 'items'} in total)")
+            else:
+                print(f"Showing items from index {self.offset+1}")
+        idLabel = "  " + ("#" if self.repository.idField is None else self.fieldLabel).ljust(self.padding)[:self.padding]
+
+        def addItem(id, item):
+            """List an item and add it as menu option"""
+            if len(self.options) == 0:
+                print() # newline
+                print(self.repository.form.generateHeader(idLabel))
+            option = MenuOption(self.repository.form.row(item), lambda: self.viewItem(id), self.repository.readRole(id, item))
+            self.options[str(id)] = option
+            self.items[id] = item
+            print(f"  {str(id).ljust(self.padding)}{self.optionSeparator}{option.title}")
+
+        try:
+            self.version = self.repository.version()
+            cached = self.pages.get(self.offset)
+            if cached is not None and cached[0] == self.version:
+                # This page was read before (or read ahead) and nothing has changed since
+                monitoring.metrics.increment("um_cache_hits_total", cache = "pages")
+                for id, item in cached[1].items():
+                    addItem(id, item)
+                self.pageEnd = cached[2]
+            else:
+                monitoring.metrics.increment("um_cache_misses_total", cache = "pages")
+                if self.source is None or self.sourceOffset != self.offset:
+                    # Start scanning (again) from the start of this page
+                    self.stop()
+                    if self.fuzzy:
+                        self.source = self.repository.fuzzySearch(self.search, self.offset) # Best matches first
+                    else:
+                        self.source = self.repository.scan(self.offset, self.search, True, self.showProgress) # Only the table columns are needed here
+                for id, item in self.source:
+                    self.clearProgress()
+                    addItem(id, item)
+                    if len(self.options) >= self.limit:
+                        break # This page is full (the scan is continued for the next page)
+                else:
+                    self.source = None # Finished scanning
+                self.pageEnd = self.repository.nextOffset
+                self.sourceOffset = self.pageEnd
+                self.cachePage(self.offset, self.version, self.items, self.pageEnd)
+        except KeyboardInterrupt:
+            # Stopped with Ctrl+C: keep what was found so far
+            self.clearProgress()
+            print() # newline
+            self.pageEnd = self.repository.nextOffset
+            self.stop()
+            self.cancelled = True
+        except Exception:
+            # Not all items could be read (for instance because another process kept the database locked): keep what was found so far
+            self.clearProgress()
+            self.pageEnd = self.repository.nextOffset if len(self.options) > 0 else self.offset # Try this page again
+            self.stop()
+            self.cancelled = True
+            self.failed = True
+        self.clearProgress()
+
+        if self.source is not None and self.pageEnd not in self.pages:
+            # Read the next page while the user looks at this one
+            self.prefetcher = threading.Thread(target = self.prefetch, name = "prefetch", daemon = True)
+            self.prefetcher.start()
+
+        if len(self.options) == 0:
+            if self.failed:
+                self.description = "Not all items could be read (the error has been logged). Press enter to try again or press Ctrl+C to cancel"
+            elif self.cancelled:
+                self.description = "Stopped searching. Press enter to continue searching or press Ctrl+C to cancel"
+            elif self.offset > 0:
                 self.description = "You've reached the end of the data. Press enter to view the first page or press Ctrl+C to cancel"
             elif self.search is not None:
                 self.description = f"Nothing was found for '{self.search}'"
@@ -131,44 +299,46 @@ class RepositoryMenu(Menu):
                 self.description = "There is nothing to display"
             return
 
-        menuOptions = map(lambda id: MenuOption(self.repository.form.row(items[id]), lambda: self.viewItem(id), self.repository.readRole(id, items[id])), items)
-        self.options = dict(zip([str(id) for id in items.keys()], menuOptions))
-        if self.search:
-            self.description = f"Searching for '{self.search}'\n"
-        else:
-            self.description = f"Showing items from index {self.offset+1}\n"
+        print() # newline
+        self.description = "Not all items could be read (the error has been logged), these are the items found so far.\n" if self.failed else "Stopped searching, these are the items found so far.\n" if self.cancelled else ""
         self.description += f"Please type the {self.fieldLabel} to view or press Ctrl+C to cancel"
-        padding = max(len(str(s)) for s in items.keys())
-        idLabel = "  " + ("#" if self.repository.idField is None else self.fieldLabel).ljust(padding)[:padding]
-        self.description += "\n\n" + self.repository.form.generateHeader(idLabel)
 
     
     def viewItem(self, id):
-        """View the item that was selected"""
+        """View the item that was selected (reusing the item that was already read if it is complete and nothing has changed since)"""
+        self.stop() # The scan keeps the database locked for writing (an open SQLite cursor), and the item may be changed or deleted
         extraOptions = None
         if isinstance(self.extraItemOptions, type(lambda: None)):
             extraOptions = self.extraItemOptions
-        RepositoryItem(f"{self.repository.form.name}: {id}", self.repository, id, self.deleteWhenViewed, extraOptions).run()
+        item = self.items.get(id)
+        if item is not None and any(field not in item for field in self.repository.form.fields):
+            item = None # Only the table columns were read
+        RepositoryItem(f"{self.repository.form.name}: {id}", self.repository, id, self.deleteWhenViewed, extraOptions, item, self.version).run()
 
 
     def noInput(self):
-        """No input: prepare the next page (or loop back to the first page if we've reached the end)"""
-        if len(self.options) > 0:
-            self.offset = self.repository.nextOffset
+        """No input: show the next page (which is usually read already), or loop back to the first page if we've reached the end"""
+        if len(self.options) > 0 or self.cancelled:
+            if self.pageEnd != self.offset:
+                self.page += 1
+            self.offset = self.pageEnd
         else:
             if self.offset == 0:
                 return True # Prevent getting "stuck" in a screen that is completely empty
             self.offset = 0
+            self.page = 1
         return False
     
 
 class RepositoryItem(Menu):
     """Class that shows an item in the repository and allows the user to select an action"""
 
-    def __init__(self, title, repository, id, deleteWhenViewed = False, extraOptions = None):
-        """Initialize by generating menu option from repository items"""
+    def __init__(self, title, repository, id, deleteWhenViewed = False, extraOptions = None, item = None, version = None):
+        """Initialize by generating menu option from repository items (an {item} that was already read at repository {version} is used if nothing has changed since)"""
         self.id = id
         self.item = None
+        self.cached = item
+        self.cachedVersion = version
         self.repository = repository
         self.label = self.repository.form.name
         self.title = title
@@ -178,6 +348,7 @@ class RepositoryItem(Menu):
         self.extraOptions = extraOptions # lambda id, item that should return a list of extra menu options to be shown for the item
         self.extraAction = lambda: self.repository.form.display(self.item)
         self.optionSeparator = ": "
+        self.listOptions = True
 
     
     def updateItem(self):
@@ -214,7 +385,11 @@ class RepositoryItem(Menu):
 
     def generateOptions(self):
         """Generate menu options for the item"""
-        self.item = self.repository.readOne(self.id)
+        if self.cached is not None and self.cachedVersion is not None and self.cachedVersion == self.repository.version():
+            self.item = self.repository.readOne(self.id, self.cached)
+        else:
+            self.item = self.repository.readOne(self.id)
+        self.cached = None # Always read the item again after an action
         if self.item is None:
             self.options = {}
             return
@@ -226,7 +401,7 @@ class RepositoryItem(Menu):
             ]
         else:
             self.options = [
-                MenuOption(f"Mark as viewed", lambda: self.repository.delete(self.id), self.repository.deleteRole(self.id, self.item)),
+                MenuOption(f"Mark as viewed (with all earlier ones)", lambda: self.repository.markViewed(self.id), self.repository.deleteRole(self.id, self.item)),
                 MenuOption(f"Return without marking as viewed", lambda: True),
             ]
         if isinstance(self.extraOptions, type(lambda: None)):
@@ -1,7 +1,7 @@
 # The main menu; the entry point into the application
 
 from logic.interface import Menu, MenuOption, RepositoryMenu
-from logic.actions import searchItem, createNewItem, changePassword, hashGeneratedPassword, resetPassword, createBackup, restoreBackup, extractBackupLogs, generateMemberId
+from logic.actions import searchItem, createNewItem, logout, changePassword, hashGeneratedPassword, resetPassword, createBackup, restoreBackup, extractBackupLogs, generateMemberId, profiling, metrics, rotateKey, memberStatistics, memberDuplicates
 import authentication.user
 import storage.encryption
 import storage.repositories
@@ -13,17 +13,16 @@ usersRepository = storage.repositories.Users()
 logsRepository = storage.repositories.Logs()
 suspiciousLogsRepository = storage.repositories.SuspiciousLogs()
 
+# Members are paged and searched constantly, so keep them decrypted in memory during the session
+membersRepository.enableView()
+
 def mainMenuAction():
     """Action performed whenever the main menu is shown"""
     if not authentication.user.loggedIn():
         return
     print(f"You are logged in as {authentication.user.name()} ({authentication.user.role()})")
     if authentication.user.hasRole(suspiciousLogsRepository.readRole(None, None)):
-        suspiciousActivities = suspiciousLogsRepository._list(0, 10)
-        suspiciousNumber = len(suspiciousActivities)
-        if suspiciousNumber == 10:
-            # We won't load more than 10
-            suspiciousNumber = "10 or more"
+        suspiciousNumber = suspiciousLogsRepository.unviewed() # Kept up to date while logging, the logs are not read
         if suspiciousNumber:
             print(f"There {'is' if suspiciousNumber == 1 else 'are'} {suspiciousNumber} unviewed suspicious {'activity' if suspiciousNumber == 1 else 'activities'} in the logs!")
             print(f"Go to System maintenance to view {'it' if suspiciousNumber == 1 else 'them'}")
@@ -36,7 +35,7 @@ main = Menu("Welcome to the Member Management System", [
     MenuOption("Manage users", lambda: users.run(), "admin"),
     MenuOption("Manage members", lambda: members.run(), "consult"),
     MenuOption("System maintanance", lambda: system.run(), "admin"),
-    MenuOption("Log out (quit application)", lambda: True),
+    MenuOption("Log out (quit application)", logout),
 ], mainMenuAction)
 
 # Users menu options
@@ -52,7 +51,9 @@ users = Menu("Manage users", [
 members = Menu("Manage members", [
     MenuOption("Add new member", lambda: repositoryInsert("Add new member", membersRepository, { "id": generateMemberId(), "registrationDate": validation.datetime.date() }), membersRepository.insertRole()),
     MenuOption("Search members", lambda: repositorySearch("Search members", membersRepository), membersRepository.readRole(None, None)),
+    MenuOption("Search members by name (allowing for typos)", lambda: searchItem("Search members by name", RepositoryMenu("Search members by name", membersRepository, fuzzy = True)), membersRepository.readRole(None, None)),
     MenuOption("View all members", lambda: repositoryMenu("View all members", membersRepository), membersRepository.readRole(None, None)),
+    MenuOption("Find likely duplicates", memberDuplicates, "admin"),
     MenuOption("Back to Main Menu", lambda: True),
 ])
 
@@ -62,6 +63,10 @@ system = Menu("System maintenance", [
     MenuOption("View system logs", lambda: repositoryMenu("View system logs", logsRepository), logsRepository.readRole(None, None)),
     MenuOption("View new suspicious logs", lambda: repositoryMenu("View new suspicious logs", suspiciousLogsRepository, True), suspiciousLogsRepository.readRole(None, None)),
     MenuOption("Search the logs", lambda: repositorySearch("Search the logs", logsRepository), logsRepository.readRole(None, None)),
+    MenuOption("Member statistics", memberStatistics, "admin"),
+    MenuOption("Profiling", profiling, "admin"),
+    MenuOption("Metrics", metrics, "admin"),
+    MenuOption("Rotate the encryption key", rotateKey, "super"),
     MenuOption("Back to Main Menu", lambda: True),
 ])
 
@@ -0,0 +1,237 @@
+# Headless service mode: a local JSON-over-HTTP API, so several front desks can share one running process (and its caches)
+# Every client logs in with POST /login and gets a token; each request runs in the session of its token, on a bounded pool of worker threads
+#
+#   POST   /login                  {"username": ..., "password": ...} => {"token": ...} (send as "Authorization: Bearer <token>")
+#   POST   /logout
+#   GET    /<resource>?offset=0&limit=20&search=...  => {"items": {id: item}, "nextOffset": ...}
+#   GET    /<resource>/<id>
+#   POST   /members                {field: value} (id and registration date are generated if left out)
+#   PUT    /members/<id>           {field: value} (only the given fields are changed)
+#   DELETE /members/<id>
+#
+# The same access checks and logging apply as in the console application
+
+import concurrent.futures
+import http.server
+import json
+import secrets
+import threading
+import time
+import urllib.parse
+import authentication.logging
+import authentication.user
+import logic.actions
+import storage.repositories
+import validation.datetime
+
+host = "127.0.0.1" # Only accept connections from this machine
+port = 8080
+workers = 8 # Number of requests handled at the same time
+sessionTimeout = 1800 # Number of seconds a session stays valid without being used
+maxBodySize = 100000 # Largest request body accepted (in bytes)
+
+# Resource name => (repository class, allowed methods, fields never sent to clients)
+resources = {
+    "members": (storage.repositories.Members, ["GET", "POST", "PUT", "DELETE"], []),
+    "users": (storage.repositories.Users, ["GET"], ["password"]),
+    "logs": (storage.repositories.Logs, ["GET"], []),
+}
+
+sessions = {} # Token => [session, time last used]
+loginAttempts = {} # Username => [number of login attempts left, time of the last failed login] (every login starts a new session, so they are counted per existing username, until sessionTimeout has passed)
+sessionsLock = threading.Lock()
+local = threading.local() # Repository objects of each worker thread (repositories keep state while they work, so they are not shared between threads)
+
+
+def repository(resource):
+    """Get the repository object for a resource in the current worker thread"""
+    if not hasattr(local, "repositories"):
+        local.repositories = {}
+    if resource not in local.repositories:
+        local.repositories[resource] = resources[resource][0]()
+    return local.repositories[resource]
+
+
+def findSession(token):
+    """Find the session of a token (None if it does not exist or has expired)"""
+    now = time.monotonic()
+    with sessionsLock:
+        for expired in [key for key, (_, used) in sessions.items() if now - used > sessionTimeout]:
+            del sessions[expired]
+        if token not in sessions:
+            return None
+        sessions[token][1] = now
+        return sessions[token][0]
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Handle one API request"""
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+
+    def log_message(self, format, *args):
+        pass # Requests are logged by the application itself (in the session of the user)
+
+
+    def respond(self, status, body):
+        """Send a JSON response"""
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def body(self):
+        """Read the JSON request body (an empty object if there is none)"""
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > maxBodySize:
+            raise ValueError("Request body is too large")
+        data = json.loads(self.rfile.read(length) or b"{}") if length > 0 else {}
+        if not isinstance(data, dict) or not all(isinstance(value, str) for value in data.values()):
+            raise ValueError("Request body should be a JSON object with text values")
+        return data
+
+
+    def route(self, method):
+        """Route the request to the right action, in the session of its token"""
+        try:
+            url = urllib.parse.urlsplit(self.path)
+            parts = [urllib.parse.unquote(part) for part in url.path.strip("/").split("/")]
+            query = dict(urllib.parse.parse_qsl(url.query))
+
+            if parts == ["login"] and method == "POST":
+                return self.login(self.body())
+
+            authorization = self.headers.get("Authorization", "")
+            session = findSession(authorization[7:]) if authorization.startswith("Bearer ") else None
+            if session is None:
+                return self.respond(401, { "error": "Not logged in (or the session has expired)" })
+
+            with authentication.user.activate(session):
+                if parts == ["logout"] and method == "POST":
+                    authentication.user.logout()
+                    with sessionsLock:
+                        sessions.pop(authorization[7:], None)
+                    return self.respond(200, {})
+                if len(parts) not in (1, 2) or parts[0] not in resources:
+                    return self.respond(404, { "error": "Unknown resource" })
+                if method not in resources[parts[0]][1]:
+                    return self.respond(405, { "error": f"{method} is not available for {parts[0]}" })
+                return self.resource(method, parts[0], parts[1] if len(parts) == 2 else None, query)
+
+        except ValueError as e:
+            self.respond(400, { "error": str(e) })
+        except Exception as e:
+            authentication.logging.log("Exception occured", f"Service request {method} {self.path}: {str(e)}", True)
+            self.respond(500, { "error": "Internal error (check the logs for more information)" })
+
+
+    def login(self, body):
+        """Log in with a new session"""
+        username = body.get("username", "")
+        now = time.monotonic()
+        with sessionsLock:
+            for expired in [key for key, (_, failed) in loginAttempts.items() if now - failed > sessionTimeout]:
+                del loginAttempts[expired]
+            session = authentication.user.Session(None, False, loginAttempts.get(username, [authentication.user.maxAttempts])[0])
+        with authentication.user.activate(session):
+            success = authentication.user.authenticate(username, body.get("password", ""))
+        with sessionsLock:
+            if success:
+                loginAttempts.pop(username, None)
+            elif username in loginAttempts or username == "super_admin" or (session.user is not None and session.user.model is not None):
+                # Only usernames that exist are kept (the failed login found the user), so guessed names don't fill up memory
+                loginAttempts[username] = [session.attempts, now]
+        if not success:
+            return self.respond(401, { "error": "The username or password is incorrect" })
+        token = secrets.token_urlsafe(32)
+        with sessionsLock:
+            sessions[token] = [session, time.monotonic()]
+        return self.respond(200, { "token": token, "role": session.user.role })
+
+
+    def resource(self, method, resource, id, query):
+        """Read or change items of a resource"""
+        target = repository(resource)
+        hidden = resources[resource][2]
+        show = lambda item: { field: value for field, value in item.items() if field not in hidden }
+        if target.idField is None and id is not None:
+            if not id.isdigit():
+                return self.respond(404, { "error": "Not found" })
+            id = int(id) # Line number
+
+        if method == "GET" and id is None:
+            offset = int(query.get("offset", 0))
+            limit = min(int(query.get("limit", 20)), 1000)
+            items = target.readAll(offset, limit, query.get("search"))
+            if items is None:
+                return self.respond(403, { "error": "Not allowed" })
+            return self.respond(200, { "items": { str(key): show(item) for key, item in items.items() }, "nextOffset": target.nextOffset })
+        if method == "GET":
+            item = target.readOne(id)
+            return self.respond(200, show(item)) if item is not None else self.respond(404, { "error": "Not found" })
+        if method == "POST" and id is None:
+            model = { "id": logic.actions.generateMemberId(), "registrationDate": validation.datetime.date() }
+            model.update(self.body())
+            model = { field: model.get(field) for field in target.form.fields } # Form order, with missing fields set to None (which fails validation)
+            return self.respond(201, show(model)) if target.insert(model) else self.respond(400, { "error": "Not saved (check the logs for more information)" })
+        if method == "PUT" and id is not None:
+            result = target.update(id, self.body())
+            return self.respond(200, {}) if result else self.respond(404 if result is None else 400, { "error": "Not saved (check the logs for more information)" })
+        if method == "DELETE" and id is not None:
+            result = target.delete(id)
+            return self.respond(200, {}) if result else self.respond(404 if result is None else 403, { "error": "Not deleted (check the logs for more information)" })
+        return self.respond(405, { "error": "Not available" })
+
+
+class Server(http.server.HTTPServer):
+    """HTTP server that handles requests on a bounded pool of worker threads"""
+
+    def __init__(self, address, workers):
+        super().__init__(address, Handler)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "service")
+
+
+    def process_request(self, request, clientAddress):
+        self.pool.submit(self.work, request, clientAddress)
+
+
+    def work(self, request, clientAddress):
+        try:
+            self.finish_request(request, clientAddress)
+        except Exception:
+            self.handle_error(request, clientAddress)
+        finally:
+            self.shutdown_request(request)
+
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait = True)
+
+
+def serve(servicePort = None, serviceWorkers = None):
+    """Run the service until it is stopped with Ctrl+C"""
+    server = Server((host, port if servicePort is None else servicePort), workers if serviceWorkers is None else serviceWorkers)
+    authentication.logging.log("Service started", f"Listening on {server.server_address[0]}:{server.server_address[1]}")
+    print(f"Serving on http://{server.server_address[0]}:{server.server_address[1]} (press Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        authentication.logging.log("Service stopped", f"{len(sessions)} sessions ended")
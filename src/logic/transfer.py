@@ -0,0 +1,249 @@
+# Bulk transfer of data: importing members from CSV or JSONL files, and exporting members, users or logs to them
+# Files are streamed (read, validated and written a batch at a time), so memory use stays the same for any file size
+# Run from the src folder: python um_members.py --import-members members.csv [--rejects rejected.csv]
+#                      or: python um_members.py --export logs --output logs.jsonl [--fields date,time,activity] [--filter suspicious=Y] [--search text]
+
+import collections
+import concurrent.futures
+import csv
+import json
+import multiprocessing
+import os
+import authentication.logging
+import authentication.user
+import logic.service
+import storage.allocator
+import storage.encryption
+import storage.repositories
+import validation.datetime
+import validation.forms
+
+batchSize = 500 # Number of rows validated by a worker, and written in one transaction
+workers = min(os.cpu_count() or 1, 4) # Number of processes that validate (import) or decrypt (export) rows at the same time
+
+
+def fileFormat(path, format = None):
+    """Determine the format of a file ("csv" or "jsonl") from its extension, unless it is given"""
+    if format is None:
+        format = "jsonl" if os.path.splitext(path)[1].lower() in (".jsonl", ".json", ".ndjson") else "csv"
+    if format not in ("csv", "jsonl"):
+        raise ValueError(f"Unknown file format '{format}' (use csv or jsonl)")
+    return format
+
+
+def readRows(file, format, fields):
+    """Yield (line number, row) for every row in a CSV or JSONL file; the names of the columns are matched to {fields} (ignoring case)"""
+    names = { field.upper(): field for field in fields }
+    if format == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, { names.get(str(key).upper(), key): value for key, value in row.items() if value is not None }
+        return
+    for number, line in enumerate(file, 1):
+        if line.strip() == "":
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if not isinstance(row, dict):
+            yield number, { None: line.strip() } # Can't be read: rejected by validateMembers
+            continue
+        yield number, { names.get(str(key).upper(), key): ("" if value is None else str(value)) for key, value in row.items() }
+
+
+def validateMembers(rows):
+    """Validate (line number, row) pairs with the member form rules (runs in a worker process); returns (line number, row, errors) for every row
+    Rows without an id are valid if all other fields are (they get a new id when they are saved)"""
+    form = validation.forms.Member()
+    results = []
+    for number, row in rows:
+        errors = {}
+        for field in form.fields:
+            form.fields[field].errors = []
+            if field == "id" and row.get("id", "") == "":
+                continue # Generated
+            if field not in row:
+                errors[field] = ["Field is missing"]
+            elif not form.fields[field].validate(row[field], False, False):
+                errors[field] = form.fields[field].errors
+        for field in row:
+            if field not in form.fields:
+                errors[str(field)] = ["Unknown field" if field is not None else "Row can't be read"]
+        results.append((number, row, errors))
+    return results
+
+
+def batches(rows):
+    """Split rows into lists of {batchSize} rows"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batchSize:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def validatedBatches(rows):
+    """Validate the rows a batch at a time on the worker processes; yields the results of every batch, in order
+    Only a few batches are in progress at a time, so the file is read only as fast as the batches are saved"""
+    if workers <= 1:
+        yield from map(validateMembers, batches(rows))
+        return
+    # The worker processes are started fresh (not forked), since this process may have threads running (see storage.retention)
+    with concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context("spawn")) as executor:
+        pending = collections.deque()
+        for batch in batches(rows):
+            pending.append(executor.submit(validateMembers, batch))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def assignIds(repository, rows):
+    """Check the ids of valid (line number, row) pairs, which must not be used yet, and give rows without an id a new one; returns the errors of rows with a used id"""
+    errors = {}
+    existing = repository._existing(row["id"] for _, row in rows if row.get("id", "") != "")
+    taken = set() # Ids in this batch
+    for number, row in rows:
+        if row.get("id", "") == "":
+            continue
+        if row["id"].upper() in existing or row["id"].upper() in taken:
+            errors[number] = { "id": [f"ID {row['id']} is already used"] }
+        taken.add(row["id"].upper())
+
+    # New ids are allocated for the whole batch at once
+    missing = [row for _, row in rows if row.get("id", "") == ""]
+    while len(missing) > 0:
+        retry = []
+        for row, id in zip(missing, storage.allocator.memberIds(repository, len(missing))):
+            if id in taken:
+                retry.append(row) # Given to another row in the file
+                continue
+            row["id"] = id
+            taken.add(id)
+        missing = retry
+    return errors
+
+
+class Rejects:
+    """Writes rejected rows to a file in the same format as the imported file, with their errors (the file is only created when a row is rejected)"""
+
+    def __init__(self, path, format, columns):
+        self.path = path
+        self.format = format
+        self.columns = columns
+        self.file = None
+        self.writer = None
+        self.count = 0
+
+
+    def write(self, number, row, errors):
+        if self.file is None:
+            self.file = open(self.path, "w", newline = "")
+            if self.format == "csv":
+                self.writer = csv.DictWriter(self.file, self.columns + ["line", "errors"], extrasaction = "ignore")
+                self.writer.writeheader()
+        self.count += 1
+        if self.format == "csv":
+            self.writer.writerow({ **row, "line": number, "errors": "; ".join(f"{field}: {error}" for field, fieldErrors in errors.items() for error in fieldErrors) })
+        else:
+            self.file.write(json.dumps({ **{ str(key): value for key, value in row.items() }, "line": number, "errors": errors }) + "\n")
+
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def importMembers(path, rejectsPath = None, format = None):
+    """Import members from a CSV or JSONL file (with a column/key for every member field; id and registration date may be left out)
+    Valid rows are saved a batch at a time; rejected rows are written to {rejectsPath} with their errors; returns the number of saved and rejected rows"""
+    repository = storage.repositories.Members()
+    format = fileFormat(path, format)
+    if rejectsPath is None:
+        rejectsPath = os.path.splitext(path)[0] + ".rejects." + format
+    if not authentication.user.requireAccess(repository.insertRole(), f"Unauthorized import into {repository.name}", f"File: {path}", True):
+        return None
+    authentication.logging.log(f"Import into {repository.name}", f"File: {path}, Rejects file: {rejectsPath}")
+
+    fields = list(repository.form.fields)
+    today = validation.datetime.date()
+    saved = 0
+    with open(path, "r", newline = "", encoding = "utf-8-sig") as file:
+        columns = fields
+        if format == "csv":
+            header = next(csv.reader([file.readline()]), [])
+            file.seek(0)
+            columns = [{ field.upper(): field for field in fields }.get(column.upper(), column) for column in header]
+        rejects = Rejects(rejectsPath, format, columns)
+        try:
+            rows = readRows(file, format, fields)
+            rows = ((number, { **row, "registrationDate": row.get("registrationDate") or today }) for number, row in rows)
+            for batch in validatedBatches(rows):
+                valid = [(number, row) for number, row, errors in batch if len(errors) == 0]
+                used = assignIds(repository, valid)
+                for number, row, errors in batch:
+                    if len(errors) > 0 or number in used:
+                        rejects.write(number, row, errors or used[number])
+                models = [{ field: row[field] for field in fields } for number, row in valid if number not in used]
+                if repository._addMany(models):
+                    saved += len(models)
+                else:
+                    for number, row in valid:
+                        if number not in used:
+                            rejects.write(number, row, { "": ["Not saved (check the logs for more information)"] })
+                print(f"\r{saved} members imported, {rejects.count} rejected", end = "", flush = True)
+        finally:
+            rejects.close()
+            print() # newline
+
+    authentication.logging.log(f"Imported into {repository.name}", f"File: {path}, Saved: {saved}, Rejected: {rejects.count}" + (f" (see {rejectsPath})" if rejects.count > 0 else ""))
+    if rejects.count > 0:
+        print(f"Rejected rows were written to '{rejectsPath}'")
+    return saved, rejects.count
+
+
+def exportRepository(resource, path, fields = None, filters = None, search = None, format = None):
+    """Export the members, users or logs ({resource}, see logic.service.resources) to a CSV or JSONL file, in storage order (fields that are never sent to clients are left out)
+    Only the given {fields} are exported (default: all); only items that contain the value of every field in {filters} (a dict), and {search} in any field, are exported"""
+    if resource not in logic.service.resources:
+        raise ValueError(f"Unknown resource '{resource}' (use {', '.join(logic.service.resources)})")
+    factory, _, hidden = logic.service.resources[resource]
+    repository = factory()
+    format = fileFormat(path, format)
+    filters = { field: str(value).upper() for field, value in (filters or {}).items() }
+    allowed = [field for field in repository.form.fields if field not in hidden]
+    fields = allowed if fields is None else fields
+    for field in list(fields) + list(filters):
+        if field not in allowed:
+            raise ValueError(f"Unknown field '{field}' (use {', '.join(allowed)})")
+    if not authentication.user.requireAccess("admin", f"Unauthorized export of {repository.name}", f"File: {path}", True):
+        return None
+    authentication.logging.log(f"Export {repository.name}", f"File: {path}, Fields: {', '.join(fields)}, Filters: {str(filters)}, Search: {search}")
+
+    exported = 0
+    readFields = list(fields) + [field for field in filters if field not in fields]
+    # Decrypting is most of the work: done on worker processes (started fresh, not forked, since this process may have threads running)
+    with concurrent.futures.ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"), initializer = storage.encryption.initializeKeys) as executor, open(path, "w", newline = "", encoding = "utf-8") as file:
+        writer = csv.DictWriter(file, fields, extrasaction = "ignore") if format == "csv" else None
+        if writer is not None:
+            writer.writeheader()
+        for _, item in repository.scan(0, search, False, None, readFields, executor if workers > 1 else None):
+            if any(value not in str(item[field]).upper() for field, value in filters.items()):
+                continue
+            row = { field: item[field] for field in fields }
+            if writer is not None:
+                writer.writerow(row)
+            else:
+                file.write(json.dumps(row) + "\n")
+            exported += 1
+            if exported % 10000 == 0:
+                print(f"\r{exported} {repository.name.lower()} exported", end = "", flush = True)
+
+    print(f"\r{exported} {repository.name.lower()} exported to '{path}'")
+    authentication.logging.log(f"Exported {repository.name}", f"File: {path}, Items: {exported}")
+    return exported
@@ -0,0 +1,98 @@
+# Aggregate metrics (counters and gauges) for operations dashboards
+# A snapshot is written periodically in the Prometheus text exposition format to ./output/metrics.prom, and can be viewed in the System maintenance menu
+
+import os
+import threading
+import time
+
+# Metric name => (type, description)
+definitions = {
+    "um_rows_scanned_total": ("counter", "Rows read from storage while listing or searching"),
+    "um_rows_returned_total": ("counter", "Rows returned to the caller while listing or searching"),
+    "um_queries_total": ("counter", "Number of list and search queries"),
+    "um_decryptions_total": ("counter", "Number of values decrypted"),
+    "um_cache_hits_total": ("counter", "Reads served from a cache"),
+    "um_cache_misses_total": ("counter", "Reads that could not be served from a cache"),
+    "um_cache_hit_ratio": ("gauge", "Cache hits divided by all cache lookups"),
+    "um_log_queue_depth": ("gauge", "Number of log lines waiting to be written"),
+    "um_backup_duration_seconds": ("gauge", "Duration of the last backup"),
+    "um_backup_size_bytes": ("gauge", "Size of the last backup file"),
+    "um_backup_timestamp_seconds": ("gauge", "Time the last backup was made (Unix time)"),
+    "um_failed_logins_total": ("counter", "Number of failed login attempts"),
+}
+values = {} # (name, labels) => value, where labels is a sorted tuple of (label, value) pairs
+lock = threading.Lock()
+path = "./output/metrics.prom"
+interval = 60 # Number of seconds between writing snapshots in the background
+
+writerThread = None
+
+
+def increment(name, amount = 1, **labels):
+    """Increase a counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        values[key] = values.get(key, 0) + amount
+
+
+def gauge(name, value, **labels):
+    """Set a gauge to a value"""
+    key = (name, tuple(sorted(labels.items())))
+    with lock:
+        values[key] = value
+
+
+def hitRatios():
+    """Calculate the hit ratio of every cache from the hit and miss counters"""
+    with lock:
+        hits = { labels: value for (name, labels), value in values.items() if name == "um_cache_hits_total" }
+        misses = { labels: value for (name, labels), value in values.items() if name == "um_cache_misses_total" }
+    for labels in set(hits) | set(misses):
+        total = hits.get(labels, 0) + misses.get(labels, 0)
+        if total > 0:
+            gauge("um_cache_hit_ratio", hits.get(labels, 0) / total, **dict(labels))
+
+
+def snapshot():
+    """Get all metrics in the Prometheus text exposition format"""
+    hitRatios()
+    with lock:
+        current = dict(values)
+    lines = []
+    for name, (type, description) in definitions.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {type}")
+        for (metric, labels), value in sorted(current.items(), key = lambda item: str(item[0])):
+            if metric != name:
+                continue
+            labelText = ",".join(f'{label}="{str(labelValue).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for label, labelValue in labels)
+            lines.append(f"{name}{'{' + labelText + '}' if labelText else ''} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write(outputPath = None):
+    """Write a snapshot to a file (atomically: readers never see a half-written file)"""
+    outputPath = path if outputPath is None else outputPath
+    with open(outputPath + ".tmp", "w") as file:
+        file.write(snapshot())
+    os.replace(outputPath + ".tmp", outputPath)
+
+
+def start():
+    """Write a snapshot every {interval} seconds in a background thread (for as long as the application runs)"""
+    global writerThread
+
+    if writerThread is not None and writerThread.is_alive():
+        return False # Already running
+
+    def run():
+        while True:
+            try:
+                write()
+            except OSError:
+                pass # Try again next time
+            time.sleep(interval)
+
+    writerThread = threading.Thread(target = run, name = "metrics-writer", daemon = True)
+    writerThread.start()
+    return True
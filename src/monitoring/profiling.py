@@ -0,0 +1,118 @@
+# Lightweight profiling of the hot paths (repository methods, database queries, encryption, validation and logging)
+# Profiled functions keep a call count and a latency histogram; when profiling is disabled, a profiled call only costs one extra check
+# Enable it by setting the environment variable UM_PROFILE=1, or from the System maintenance menu
+
+import functools
+import inspect
+import os
+import threading
+import time
+
+enabled = os.environ.get("UM_PROFILE", "") not in ("", "0")
+buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5) # Upper bounds of the histogram buckets in seconds (the last bucket is everything slower)
+timings = {} # Name => [calls, total seconds, max seconds, [calls per bucket]]
+hooks = [] # Functions (name, seconds) that are called after every profiled call while profiling is enabled
+lock = threading.Lock()
+
+
+def record(name, seconds):
+    """Record the duration of one call"""
+    with lock:
+        if name not in timings:
+            timings[name] = [0, 0.0, 0.0, [0] * (len(buckets) + 1)]
+        timing = timings[name]
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+        bucket = 0
+        while bucket < len(buckets) and seconds > buckets[bucket]:
+            bucket += 1
+        timing[3][bucket] += 1
+    for hook in hooks:
+        hook(name, seconds)
+
+
+def timed(name = None):
+    """Decorator to profile a function; without a name, the method is named after the class of the object it is called on ("Members.readAll")"""
+
+    def decorator(function):
+        label = function.__qualname__ if name is None else name
+
+        def callName(args):
+            return f"{args[0].__class__.__name__}.{function.__name__}" if name is None and len(args) > 0 else label
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generatorWrapper(*args, **kwargs):
+                # Only count the time spent inside the generator, not the time the caller spends between items
+                generator = function(*args, **kwargs)
+                if not enabled:
+                    yield from generator
+                    return
+                seconds = 0.0
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        except StopIteration:
+                            break
+                        finally:
+                            seconds += time.perf_counter() - start
+                        yield item
+                finally:
+                    generator.close()
+                    record(callName(args), seconds)
+            return generatorWrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(callName(args), time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+def enable(on = True):
+    """Turn profiling on or off (the timings that were recorded are kept)"""
+    global enabled
+    enabled = on
+
+
+def reset():
+    """Forget all recorded timings"""
+    with lock:
+        timings.clear()
+
+
+def percentile(histogram, fraction):
+    """Estimate a percentile from a histogram (returns the upper bound of the bucket it falls in, or None for the last bucket)"""
+    target = fraction * sum(histogram)
+    count = 0
+    for bucket, calls in enumerate(histogram):
+        count += calls
+        if count >= target:
+            return buckets[bucket] if bucket < len(buckets) else None
+    return None
+
+
+def report():
+    """Get the recorded timings as a list of lines (slowest total first)"""
+    with lock:
+        rows = sorted(((name, list(timing)) for name, timing in timings.items()), key = lambda row: row[1][1], reverse = True)
+    if len(rows) == 0:
+        return ["Nothing has been recorded yet"]
+    milliseconds = lambda seconds: f"{seconds * 1000:.2f}"
+    bound = lambda seconds: f">{buckets[-1] * 1000:.0f}" if seconds is None else milliseconds(seconds)
+    width = max(len(name) for name, _ in rows)
+    lines = [f"{'Operation'.ljust(width)} | {'Calls':>8} | {'Total ms':>10} | {'Avg ms':>8} | {'p50 ms <':>8} | {'p95 ms <':>8} | {'Max ms':>8}"]
+    lines.append("-" * len(lines[0]))
+    for name, (calls, total, slowest, histogram) in rows:
+        lines.append(f"{name.ljust(width)} | {calls:>8} | {milliseconds(total):>10} | {milliseconds(total / calls):>8} | {bound(percentile(histogram, 0.5)):>8} | {bound(percentile(histogram, 0.95)):>8} | {milliseconds(slowest):>8}")
+    return lines
@@ -3,14 +3,47 @@
 
 import validation.forms
 import validation.fields
+import validation.records
 import validation.rules
 import authentication.user
 import authentication.logging
+import monitoring.metrics
+import monitoring.profiling
 import storage.encryption
+import storage.locking
+import storage.migrations
+import storage.search
+import storage.view
 import json
+import lzma
+import mmap
 import os
+import random
 import re
 import sqlite3
+import threading
+import time
+
+def decodeLine(line):
+    """Decode a line read by FileRepository._lines (bytes, or a slice of a memory-mapped file)"""
+    return str(line, "utf-8", "replace") # Invalid characters make the line invalid JSON (instead of raising here)
+
+
+def countLines(file, start, end):
+    """Count the non-empty lines of a file from {start} (the start of a line) up to {end}, without decoding them or copying the file into memory
+    Returns the number of complete lines, the position after the last complete line and the number of incomplete lines after it (0 or 1, a line that is still being written)"""
+    if end <= start:
+        return 0, start, 0
+    lines = 0
+    with mmap.mmap(file.fileno(), end, access = mmap.ACCESS_READ) as mapped:
+        while True:
+            newline = mapped.find(b"\n", start, end)
+            if newline < 0:
+                return lines, start, 1 if end > start else 0
+            if newline > start:
+                lines += 1
+            start = newline + 1
+
 
 class Repository:
     """Abstract repository class"""
@@ -21,6 +54,9 @@ class Repository:
         self.name = re.sub(r'([a-z])([A-Z])', r"\1 \2", self.__class__.__name__) # ClassName with added spaces ("ClassName" => "Class Name")
         self.idField = None # Can be overwritten by subclass or kept to use Nth item
         self.nextOffset = 0
+        self.rowsScanned = 0 # Number of rows the last _list call read from storage (for the metrics)
+        self.view = None # Optional in-memory view of the decrypted items (see enableView)
+        self.lastWrite = None # Version of the data before and after the last change, if no other process can have changed it in between (see _write)
 
 
     # Default roles (all "none" unless overwritten by subclasses)
@@ -42,8 +78,8 @@ class Repository:
         return value # Should return the value the field should be set to, or None if not permitted to be set/changed. The current values are available in model (which is None on insert)
 
     # Logic methods to be implemented by subclasses
-    def _list(self, offset, limit, search = None):
-        """Implement to list {limit} items starting from {offset} with a possible {search} parameter"""
+    def _list(self, offset, limit, search = None, fields = None):
+        """Implement to list {limit} items starting from {offset} with a possible {search} parameter (only {fields} are needed, if specified)"""
         self.nextOffset += limit
     def _one(self, id):
         """Implement to find specified item"""
@@ -57,15 +93,95 @@ class Repository:
     def _remove(self, id):
         """Implement to remove the specified item"""
         pass
+    def _scan(self, offset = 0, fields = None):
+        """Implement to yield (position, id, item) for every item from {offset}, in storage order (position is the offset right after the item; only {fields} are needed, if specified)"""
+        return iter(())
+    def _addMany(self, models):
+        """Add several (pre-validated) models at once (can be implemented to do this more efficiently)"""
+        return all([self._add(model) for model in models])
+    def _similar(self, model):
+        """Find the ids of other items that have the same values as {model} in an index (index fields => ids); there are no indexes by default"""
+        return {}
+    def _existing(self, ids):
+        """Find which of the given ids are already used (can be implemented to do this more efficiently); returns them in upper case"""
+        return set(str(id).upper() for id in ids if self._one(id) is not None)
+
+
+    @monitoring.profiling.timed()
+    def count(self, filter = None):
+        """Number of items, or with a {filter} (a dict of field => value) the number of items that have these values (ignoring case); None if the user has no access or they can't be read
+        Counts are kept up to date while writing, and filters use the keyed indexes where there are any, so this does not read every item"""
+
+        if not authentication.user.requireAccess(self.readRole(None, None), f"Unauthorized count of {self.name}", f"Filter: {str(filter)}", True):
+            return None # User has no access
+        for field in filter or {}:
+            if field not in self.form.fields:
+                authentication.logging.log(f"Error counting {self.name}", f"Unknown field '{field}' (use {', '.join(self.form.fields)})", True)
+                return None
+        try:
+            return self._count(filter)
+        except Exception as e:
+            authentication.logging.log(f"Error counting {self.name}", f"Filter: {str(filter)}, Error: {str(e)}", True)
+            return None # Not all items could be read
+
+
+    def _count(self, filter = None):
+        """Count the items (that have the values in {filter}) by reading all of them; overwritten by subclasses that keep counts"""
+        filter = { field: str(value).upper() for field, value in (filter or {}).items() }
+        fields = ([self.idField] if self.idField is not None else []) + [field for field in filter if field != self.idField]
+        count = 0
+        for _, _, item in self._scan(0, fields):
+            if all(str(item[field]).upper() == value for field, value in filter.items()):
+                count += 1
+        return count
+
+
+    def version(self):
+        """Implement to return a value that changes whenever the stored data changes (also when changed by another process)"""
+        return None
+
+
+    def enableView(self, maxRows = 100000):
+        """Keep a decrypted copy of all items in memory to serve reads from (only used if there are no more than {maxRows} items)"""
+        if self.view is None:
+            self.view = storage.view.View(self, maxRows)
+
+
+    def _find(self, id):
+        """Find one item, from the in-memory view if there is one"""
+        if self.view is not None and self.view.ready():
+            return self.view.one(id)
+        return self._one(id)
+
+
+    def _matches(self, id, item, search):
+        """Check if the search parameter is found in any of the fields (or is exactly the line number, if there is no ID field)"""
+        if self.idField is None and str(search) == str(id):
+            return True
+        search = str(search).upper()
+        return any(search in str(value).upper() for value in item.values())
+
+
+    def _write(self, change):
+        """Make a change (a function that returns whether it succeeded); returns whether it succeeded
+        Can be implemented to make it as a whole and to set {lastWrite}, which is None if another process may have changed the data meanwhile (then the in-memory view is loaded again)"""
+        self.lastWrite = None
+        return change()
+
+
+    def _changed(self, action, id, item):
+        """Keep the in-memory view up to date after a successful change"""
+        if self.view is not None:
+            self.view.changed(action, id, item, self.lastWrite)
 
     
-    def validate(self, action, model):
-        """Validate form model and log all validation errors"""
+    def validate(self, action, model, fields = None):
+        """Validate form model (or only the given {fields} of it) and log all validation errors"""
 
         if self.idField is not None and self.idField not in model:
             authentication.logging.log(f"{action} invalid data in {self.name}", f"Field '{self.idField}'): Missing ID field {self.idField} in {str(model)}", True)
             return False
-        if self.form.validate(model):
+        if self.form.validate(model, fields):
             return True
         for field in self.form.fields:
             if field in self.form.errors:
@@ -76,8 +192,9 @@ class Repository:
         return False
     
 
-    def readAll(self, offset = 0, limit = 20, search = None):
-        """Read all items up to {limit} starting from {offset}"""
+    @monitoring.profiling.timed()
+    def readAll(self, offset = 0, limit = 20, search = None, columnsOnly = False):
+        """Read all items up to {limit} starting from {offset} (only the ID field and table columns are read if {columnsOnly} is True)"""
 
         if not authentication.user.requireAccess(self.readRole(None, None), f"Unauthorized read of all {self.name}", f"Offset: {offset}, Limit: {limit}, Search: {search}", True):
             return None # User has no access
@@ -87,18 +204,74 @@ class Repository:
         else:
             authentication.logging.log(f"Read all {self.name}", f"Offset: {offset}, Limit: {limit}")
         
-        items = self._list(offset, limit, search)
+        fields = self.form.listFields(self.idField) if columnsOnly else None
+        if self.view is not None and self.view.ready():
+            items = self.view.list(offset, limit, search)
+        else:
+            items = self._list(offset, limit, search, fields)
 
         # Return only validated items (errors will be logged by self.validate)
-        return { id: item for id, item in items.items() if self.validate("Read", item) and self.readRole(id, item) }
+        results = { id: item for id, item in (items or {}).items() if self.validate("Read", item, fields) and self.readRole(id, item) }
+        self._countQuery(search, self.rowsScanned, len(results))
+        return results
     
 
+    @monitoring.profiling.timed()
+    def scan(self, offset = 0, search = None, columnsOnly = False, progress = None, fields = None, executor = None):
+        """Yield (id, item) for all (matching) items starting from {offset}, one by one while they are being read; nextOffset is kept up to date while scanning
+        Only the given {fields} are read if not searching (the ID field is always included); with an {executor}, the items are decrypted on it in parallel (see validation.records.decryptAhead)"""
+
+        if not authentication.user.requireAccess(self.readRole(None, None), f"Unauthorized read of all {self.name}", f"Offset: {offset}, Search: {search}", True):
+            return # User has no access
+        
+        if search is not None:
+            authentication.logging.log(f"Search {self.name}", f"Search: {search}, Offset: {offset}")
+        else:
+            authentication.logging.log(f"Read all {self.name}", f"Offset: {offset}")
+
+        if fields is not None and search is None:
+            fields = ([self.idField] if self.idField is not None else []) + [field for field in fields if field != self.idField]
+        else:
+            fields = self.form.listFields(self.idField) if columnsOnly and search is None else None # Searching looks at all fields
+        if self.view is not None and self.view.ready():
+            source = self.view.scan(offset) # Already decrypted
+        else:
+            source = self._scan(offset, fields)
+            if executor is not None:
+                source = validation.records.decryptAhead(source, executor)
+        scanned = 0
+        returned = 0
+        try:
+            for position, id, item in source:
+                self.nextOffset = position
+                scanned += 1
+                if progress is not None and scanned % 100 == 0:
+                    progress(scanned) # Report how far we are
+                if search is not None and not self._matches(id, item, search):
+                    continue
+                # Only yield validated items (errors will be logged by self.validate)
+                if self.validate("Read", item, fields if search is None else None) and self.readRole(id, item):
+                    returned += 1
+                    yield id, item
+        finally:
+            self._countQuery(search, scanned, returned) # Also when the caller stops early
+
+
+    def _countQuery(self, search, scanned, returned):
+        """Update the metrics for one list or search query"""
+        query = "list" if search is None else "search"
+        monitoring.metrics.increment("um_queries_total", 1, repository = self.name, query = query)
+        monitoring.metrics.increment("um_rows_scanned_total", scanned, repository = self.name, query = query)
+        monitoring.metrics.increment("um_rows_returned_total", returned, repository = self.name, query = query)
+
+
+    @monitoring.profiling.timed()
     def readInternal(self, id, shouldExist = True):
         """Read one item by ID (what 'ID' means depends on the {idField} property), for internal use without access checking"""
 
         fieldName = "Line number" if self.idField is None else self.idField
 
-        item = self._one(id)
+        item = self._find(id)
 
         if item is None:
             if shouldExist:
@@ -112,17 +285,22 @@ class Repository:
         return item
     
 
+    @monitoring.profiling.timed()
     def exists(self, id):
         """Check if item with ID exists"""
-        return self._one(id) is not None
+        return self._find(id) is not None
 
 
-    def readOne(self, id):
-        """Read one item by ID (what 'ID' means depends on the {idField} property), with access checking"""
+    @monitoring.profiling.timed()
+    def readOne(self, id, cached = None):
+        """Read one item by ID (what 'ID' means depends on the {idField} property), with access checking ({cached} is the item if it was already read)"""
 
         fieldName = "Line number" if self.idField is None else self.idField
 
-        item = self.readInternal(id)
+        if cached is not None and self.validate("Read", cached):
+            item = cached.copy() # No need to read it again
+        else:
+            item = self.readInternal(id)
 
         if not authentication.user.requireAccess(self.readRole(id, item), f"Unauthorized read from {self.name}", f"{fieldName}: {id}", True):
             return None # User has no access
@@ -132,6 +310,7 @@ class Repository:
         return item
     
 
+    @monitoring.profiling.timed()
     def insert(self, model):
         """Insert a data model as a new item"""
 
@@ -170,9 +349,13 @@ class Repository:
                 authentication.logging.log(f"Insert error in {self.name}", f"{field} should be '{newValue}', not '{model[field]}'. Data: {str(model)}", True)
                 model[field] = newValue
 
-        return self._add(model)
+        if not self._write(lambda: self._add(model)):
+            return False
+        self._changed("insert", model[self.idField] if self.idField is not None else None, model)
+        return True
     
 
+    @monitoring.profiling.timed()
     def update(self, id, model):
         """Update the specified id with a new data model (unspecified fields will be unchanged)"""
 
@@ -193,6 +376,10 @@ class Repository:
             return None
         
         for field in model:
+            if field not in self.form.fields:
+                authentication.logging.log(f"Update invalid data in {self.name}", f"Field '{field}': Unknown field", True)
+                return False
+
             if self.idField is not None and field == self.idField and model[field] != item[field]:
                 authentication.logging.log(f"Update error in {self.name}", f"{fieldName} cannot be changed because it is the ID field", True)
                 return False
@@ -214,9 +401,14 @@ class Repository:
             # Form model is not valid (errors have been logged during validation)
             return False
         
-        return self._replace(id, model)
+        # Save the complete updated item (including any values corrected by fieldCheck)
+        if not self._write(lambda: self._replace(id, item)):
+            return False
+        self._changed("update", id, item)
+        return True
     
     
+    @monitoring.profiling.timed()
     def delete(self, id):
         """Delete the specified id"""
 
@@ -233,7 +425,10 @@ class Repository:
         
         authentication.logging.log(f"Delete from {self.name}", f"{fieldName}: {id}")
         
-        return self._remove(id)
+        if not self._write(lambda: self._remove(id)):
+            return False
+        self._changed("delete", id, None)
+        return True
     
 
 class FileRepository(Repository):
@@ -245,17 +440,168 @@ class FileRepository(Repository):
         self.nextOffset = 0
 
 
-    def _list(self, offset, limit, search = None):
+    def segments(self):
+        """Files that together contain the lines of this repository, in order (can be overwritten to include archived segments)"""
+        return [self.path]
+    
+
+    def _openSegments(self):
+        """Open all segments at once, so they are read as they were at this moment (files are only replaced as a whole, never changed in place); returns (segment, file) pairs
+        Compressed '.xz' segments are opened to be decompressed while reading"""
+        with storage.locking.locked(self.path):
+            return [(segment, lzma.open(segment, "rb") if segment.endswith(".xz") else open(segment, "rb")) for segment in self.segments() if os.path.exists(segment)]
+
+
+    def _identity(self, file):
+        """Identify an opened segment as it is now: by its inode and a hash of its first line (a segment that was replaced starts with another (encrypted) line, even if it got the same inode)"""
+        first = file.readline()
+        file.seek(0)
+        return f"{os.fstat(file.fileno()).st_ino}-{storage.encryption.hashData(first)[:16]}"
+
+
+    def _readLines(self, files, start = None):
+        """Yield (position, line) for all non-empty lines of opened segments (see _openSegments), one by one, undecoded (see decodeLine)
+        Plain segments are memory-mapped and their lines are handed out as slices of the mapping, so reading a large file does not copy it into memory;
+        compressed segments can't be mapped and are decompressed while reading
+        The position (segment, identity, byte position right after the line) is where reading can be continued later: with a {start} position, everything up to it is skipped
+        A last line without a newline may still be being written: its position is None"""
+        skipping = start is not None
+        for segment, file in files:
+            identity = self._identity(file)
+            position = 0
+            if skipping:
+                if (segment, identity) != tuple(start[:2]):
+                    continue # Before the start
+                position = start[2]
+                skipping = False
+            if isinstance(file, lzma.LZMAFile):
+                file.seek(position)
+                for line in file:
+                    position += len(line)
+                    complete = line.endswith(b"\n")
+                    line = line.rstrip(b"\n")
+                    if len(line) > 0:
+                        yield (segment, identity, position) if complete else None, line
+                continue
+            size = os.fstat(file.fileno()).st_size
+            if size <= position:
+                continue # Nothing to read (empty files can't be mapped)
+            with mmap.mmap(file.fileno(), size, access = mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                while position < size:
+                    end = mapped.find(b"\n", position)
+                    complete = end >= 0
+                    if not complete:
+                        end = size # Last line without a newline
+                    if end > position:
+                        with view[position:end] as line:
+                            yield (segment, identity, end + 1) if complete else None, line # The line is only valid until the next line is read
+                    position = end + 1
+
+
+    def _lines(self):
+        """Yield all non-empty lines of all segments, one by one, undecoded (see decodeLine and _readLines)"""
+        files = self._openSegments()
+        lines = self._readLines(files)
+        try:
+            for _, line in lines:
+                yield line
+        finally:
+            lines.close()
+            for _, file in files:
+                file.close()
+
+
+    def _counts(self):
+        """Line counts of the segments, as they were last counted: segment => (identity, position counted up to, number of lines) (see _identity)"""
+        try:
+            with open(self.path + ".count", "r") as file:
+                return { segment: tuple(count) for segment, count in json.load(file).items() }
+        except (OSError, ValueError):
+            return {}
+
+
+    def _saveCounts(self, counts):
+        """Keep the line counts of the segments in a file next to it ('logs' => 'logs.count')"""
+        try:
+            with storage.locking.locked(self.path + ".count", True):
+                with open(self.path + ".count.tmp", "w") as file:
+                    json.dump(counts, file)
+                os.replace(self.path + ".count.tmp", self.path + ".count")
+        except OSError:
+            pass # Counted again next time
+
+
+    def _count(self, filter = None):
+        """Count the lines of all segments (with a {filter}: count the matching items by reading them)
+        Only what was appended to a segment since it was last counted is counted; a segment that was replaced (rewritten, archived or re-encrypted) is counted again"""
+        if filter:
+            return super()._count(filter)
+        known = self._counts()
+        counts = {}
+        total = 0
+        with storage.locking.locked(self.path):
+            files = { segment: open(segment, "rb") for segment in self.segments() if os.path.exists(segment) }
+        try:
+            for segment, file in files.items():
+                stat = os.fstat(file.fileno())
+                identity = self._identity(file) # Not just the inode: a replaced segment can get the inode of the one it replaced
+                counted, position, lines = known.get(segment, (None, 0, 0))
+                if counted != identity or position > stat.st_size:
+                    position, lines = 0, 0 # Count it again
+                partial = 0
+                if segment.endswith(".xz"):
+                    if position != stat.st_size:
+                        # Compressed: can only be counted as a whole (archived segments are not appended to)
+                        with lzma.open(file, "rb") as data:
+                            lines = sum(1 for line in data if len(line.rstrip(b"\n")) > 0)
+                        position = stat.st_size
+                else:
+                    added, position, partial = countLines(file, position, stat.st_size)
+                    lines += added
+                counts[segment] = (identity, position, lines)
+                total += lines + partial
+        finally:
+            for file in files.values():
+                file.close()
+        if counts != known:
+            self._saveCounts(counts)
+        return total
+
+
+    def version(self):
+        """Modification time and size of all segments (changes whenever any process writes to the file)"""
+        version = []
+        for segment in self.segments():
+            if os.path.exists(segment):
+                stat = os.stat(segment)
+                version.append((segment, stat.st_mtime_ns, stat.st_size))
+        return tuple(version)
+
+
+    def _scan(self, offset = 0, fields = None):
+        """Yield (line number, id, item) for every line from {offset} that can be parsed, in file order"""
+        l = 0
+        for line in self._lines():
+            l += 1 # Line number
+            if l <= offset:
+                continue # Skip "offset" number of lines without decoding them
+            try:
+                # Try to parse line as JSON (the values are decrypted when they are first used)
+                line = decodeLine(line)
+                model = self.form.record(json.loads(line), True)
+            except:
+                # Invalid JSON
+                authentication.logging.log("Data parsing error", "Raw data: " + str(line), True)
+                continue
+            yield l, (model[self.idField] if self.idField is not None and self.idField in model else l), model
+
+
+    @monitoring.profiling.timed()
+    def _list(self, offset, limit, search = None, fields = None):
         """List all items in the repository (from offset X with a limit of Y and a possible search parameter)"""
         
         try:
-            if not os.path.exists(self.path):
-                # There is nothing to read
-                return {}
-            with open(self.path, "r") as file:
-                file.seek(0)
-                content = file.read()
-            content = content.strip("\n").split("\n")
+            content = self._lines()
             l = 0
             skip = 0 # Number of skipped items because they did not match the search parameter
             items = {}
@@ -269,11 +615,11 @@ class FileRepository(Repository):
                     l -= 1
                     break
                 try:
-                    # Try to decrypt line and parse as JSON
-                    model = json.loads(line)
-                    model = { field: storage.encryption.decrypt(value) for field, value in model.items() }
+                    # Try to parse line as JSON (the values are decrypted when they are first used)
+                    line = decodeLine(line)
+                    model = self.form.record(json.loads(line), True)
                 except:
-                    # Invalid JSON or decryption failed
+                    # Invalid JSON
                     authentication.logging.log("Data parsing error", "Raw data: " + str(line), True)
                     continue
                 if search is not None:
@@ -294,6 +640,7 @@ class FileRepository(Repository):
                 else:
                     items[l] = model
             self.nextOffset = l if l > offset + limit else offset + limit
+            self.rowsScanned = max(l - offset, 0)
             return items
 
         except Exception as e:
@@ -301,17 +648,12 @@ class FileRepository(Repository):
             return {}
         
 
+    @monitoring.profiling.timed()
     def _one(self, id):
         """Get one item in the repository (by id)"""
     
         try:
-            if not os.path.exists(self.path):
-                # There is nothing to read
-                return None
-            with open(self.path, "r") as file:
-                file.seek(0)
-                content = file.read()
-            content = content.strip("\n").split("\n")
+            content = self._lines()
             l = 0
             for line in content:
                 l += 1 # Line number
@@ -319,11 +661,11 @@ class FileRepository(Repository):
                     # Skip to the correct line number (only possible if there is no ID field)
                     continue
                 try:
-                    # Try to decrypt line and parse as JSON
-                    model = json.loads(line)
-                    model = { field: storage.encryption.decrypt(value) for field, value in model.items() }
+                    # Try to parse line as JSON (the values are decrypted when they are first used)
+                    line = decodeLine(line)
+                    model = self.form.record(json.loads(line), True)
                 except:
-                    # Invalid JSON or decryption failed
+                    # Invalid JSON
                     authentication.logging.log("Data parsing error", "Raw data: " + str(line), True)
                     continue
                 if self.idField is None:
@@ -345,14 +687,15 @@ class FileRepository(Repository):
             return None
         
 
+    @monitoring.profiling.timed()
     def _add(self, model):
         """Insert a new line into a file"""
 
         try:
             model = { field: storage.encryption.encrypt(value) for field, value in model.items() }
-            line = json.dumps(model)
-            with open(self.path, "a") as file:
-                file.write(line)
+            line = json.dumps(model) + "\n"
+            with storage.locking.locked(self.path), open(self.path, "a") as file:
+                file.write(line) # One write of a whole line, so lines appended by other processes can't get mixed in
         except Exception as e:
             authentication.logging.log(f"File write error", f"File: {self.path}, Error: {str(e)}", True)
             return False
@@ -360,133 +703,197 @@ class FileRepository(Repository):
         return True
     
 
-    def _replace(self, id, model):
-        """Replace/update a line in the file (by id)"""
-    
-        try:
+    def _rewrite(self, id, model):
+        """Rewrite the file with the line of {id} replaced by {model}, or removed if {model} is None; returns whether the line was found
+        The lines are streamed to a temporary file next to it, which is synced to disk and then replaces the file as a whole,
+        so memory use does not depend on the size of the file and readers (or a crash) never see a half-written file"""
 
+        with storage.locking.locked(self.path, True):
+            # No other process can open or write the file while it is being rewritten
             if not os.path.exists(self.path):
                 # There is nothing to read
                 return False
-            with open(self.path, "r") as file:
-                file.seek(0)
-                content = file.read()
-            content = content.strip("\n").split("\n")
             l = 0
+            kept = 0 # Number of lines written to the new file
             found = False
-            newContent = ""
+            try:
+                with open(self.path, "r") as file, open(self.path + ".tmp", "w") as newFile:
+                    for line in file:
+                        line = line.rstrip("\n")
+                        if len(line) == 0:
+                            continue
+                        l += 1 # Line number
+                        if found == True or (self.idField is None and l != id):
+                            # Keep the content of this line if we've already found or have yet to reach the correct line number (only possible if there is no ID field)
+                            newFile.write(line + "\n")
+                            kept += 1
+                            continue
+                        try:
+                            # Try to decrypt line and parse as JSON
+                            lineModel = json.loads(line)
+                            lineModel = { field: storage.encryption.decrypt(value) for field, value in lineModel.items() }
+                        except:
+                            # Invalid JSON or decryption failed
+                            authentication.logging.log("Data parsing error", "Raw data: " + str(line), True)
+                            continue
+                        if self.idField is None or (self.idField in lineModel and lineModel[self.idField] == id):
+                            # We've found it: don't keep this line but save the new content (if any)
+                            found = True
+                            if model is not None:
+                                newFile.write(json.dumps({ field: storage.encryption.encrypt(value) for field, value in model.items() }) + "\n")
+                                kept += 1
+                            continue
+                        elif self.idField is not None and self.idField not in lineModel:
+                            # ID field unexpectedly not included in the validated model (configuration error)
+                            authentication.logging.log(f"Validation error in {self.name}", f"Validated model does not contain ID field {self.idField}: {str(lineModel)}", True)
+                        # If we get here it's not yet found, keep this line as-is and try the next one
+                        newFile.write(line + "\n")
+                        kept += 1
+                    newFile.flush()
+                    os.fsync(newFile.fileno()) # On disk before it replaces the file
+
+                if found == False:
+                    # The line was not found: leave the file as it is
+                    os.remove(self.path + ".tmp")
+                    return False
 
-            for line in content:
-                l += 1 # Line number 
-                if found == True or (self.idField is None and l != id):
-                    # Keep the content of this line if we've already found or have yet to reach the correct line number (only possible if there is no ID field)
-                    newContent += line + "\n"
-                    continue
-                try:
-                    # Try to decrypt line and parse as JSON
-                    lineModel = json.loads(line)
-                    lineModel = { field: storage.encryption.decrypt(value) for field, value in lineModel.items() }
-                except:
-                    # Invalid JSON or decryption failed
-                    authentication.logging.log("Data parsing error", "Raw data: " + str(line), True)
-                    continue
-                if self.idField is None or (self.idField in lineModel and lineModel[self.idField] == id):
-                    # We've found it: don't keep this line but save the new content
-                    model = { field: storage.encryption.encrypt(value) for field, value in model.items() }
-                    newLine = json.dumps(model)
-                    newContent += newLine + "\n"
-                    found = True
-                    continue
-                elif self.idField is not None and self.idField not in lineModel:
-                    # ID field unexpectedly not included in the validated model (configuration error)
-                    authentication.logging.log(f"Validation error in {self.name}", f"Validated model does not contain ID field {self.idField}: {str(lineModel)}", True)
-                # If we get here it's not yet found, keep this line as-is and try the next one
-                newContent += line + "\n"
-            
-            if found == False:
-                # The line to update was not found
+                counts = self._counts()
+                if kept == 0:
+                    # There is no content left to be saved, remove the file because Python does not like reading empty files
+                    os.remove(self.path + ".tmp")
+                    os.remove(self.path)
+                    counts.pop(self.path, None)
+                else:
+                    os.replace(self.path + ".tmp", self.path)
+                    with open(self.path, "rb") as file:
+                        counts[self.path] = (self._identity(file), os.fstat(file.fileno()).st_size, kept) # Counted while writing it
+                storage.locking.syncDirectory(self.path)
+                self._saveCounts(counts)
+                return True
+
+            except Exception as e:
+                authentication.logging.log(f"File read or write error", f"File: {self.path}, Error: {str(e)}", True)
+                if os.path.exists(self.path + ".tmp"):
+                    os.remove(self.path + ".tmp")
                 return False
-            
-            with open(self.path, "w") as file:
-                # Now write the new/updated content
-                file.seek(0)
-                file.write(newContent)
-            return True
 
-        except Exception as e:
-            authentication.logging.log(f"File read or write error", f"File: {self.path}, Error: {str(e)}", True)
-            return False
+
+    @monitoring.profiling.timed()
+    def _replace(self, id, model):
+        """Replace/update a line in the file (by id)"""
+        return self._rewrite(id, model)
         
 
+    @monitoring.profiling.timed()
     def _remove(self, id):
         """Remove a line from the file (by id)"""
-    
-        try:
-
-            if not os.path.exists(self.path):
-                # There is nothing to read
-                return False
-            with open(self.path, "r") as file:
-                file.seek(0)
-                content = file.read()
-            content = content.strip("\n").split("\n")
-            l = 0
-            found = False
-            newContent = ""
-
-            for line in content:
-                l += 1 # Line number 
-                if found == True or (self.idField is None and l != id):
-                    # Keep the content of this line if we've already found or have yet to reach the correct line number (only possible if there is no ID field)
-                    newContent += line + "\n"
-                    continue
-                try:
-                    # Try to decrypt line and parse as JSON
-                    lineModel = json.loads(line)
-                    lineModel = { field: storage.encryption.decrypt(value) for field, value in lineModel.items() }
-                except:
-                    # Invalid JSON or decryption failed
-                    authentication.logging.log("Data parsing error", "Raw data: " + str(line), True)
-                    continue
-                if self.idField is None or (self.idField in lineModel and lineModel[self.idField] == id):
-                    # We've found it: remove (don't keep) this line and skip to the next
-                    found = True
-                    continue
-                elif self.idField is not None and self.idField not in lineModel:
-                    # ID field unexpectedly not included in the validated model (configuration error)
-                    authentication.logging.log(f"Validation error in {self.name}", f"Validated model does not contain ID field {self.idField}: {str(lineModel)}", True)
-                # If we get here it's not yet found, keep this line as-is and try the next one
-                newContent += line + "\n"
-            
-            if found == False:
-                # The line to delete was not found
-                return False
-            
-            if newContent.strip() == "" and os.path.exists(self.path):
-                # There is no content left to be saved, remove the file because Python does not like reading empty files
-                os.remove(self.path)
-                return True
-            
-            with open(self.path, "w") as file:
-                # Now write the new/updated content
-                file.seek(0)
-                file.write(newContent)
-            return True
-
-        except Exception as e:
-            authentication.logging.log(f"Error reading or writing file", f"File: {self.path}, Error: {str(e)}", True)
-            return False
+        return self._rewrite(id, None)
         
 
 class SQLiteRepository(Repository):
     """Repository class that represents an SQLite database"""
 
+    busyTimeout = 5 # Number of seconds SQLite waits for a lock held by another process
+    retries = 5 # Number of times a statement is retried (with increasing delays) if the database stays locked
+
     def __init__(self, path):
         super().__init__()
         self.path = path
         self.nextOffset = 0
         self.table = None
         self.initialized = False
+        self.schemaVersion = 0 # Number of migrations applied to the table (see storage.migrations)
+        self.fuzzyFields = [] # Name fields that can be searched allowing for typos (see fuzzySearch)
+        self.transaction = None # Connection of the change in progress, which all statements use until it is saved (see _write)
+        self.versionConnection = None # (Process ID, inode, connection) kept open to ask SQLite whether the data changed (see version)
+        self.versionLock = threading.Lock() # The version can be asked from another thread (see RepositoryMenu.prefetch)
+
+
+    def _retry(self, attempt):
+        """Call {attempt} (which opens a connection and uses it) and return its result; if another process keeps the database locked, retry with exponential backoff"""
+        delay = 0.05
+        for number in range(self.retries):
+            try:
+                return attempt()
+            except sqlite3.OperationalError as e:
+                if number == self.retries - 1 or ("locked" not in str(e) and "busy" not in str(e)):
+                    raise
+                time.sleep(delay * (1 + random.random())) # Random jitter, so waiting processes don't all retry at the same moment
+                delay *= 2
+
+
+    def _execute(self, query, params = (), many = False):
+        """Open a connection and execute a statement (committing it), or the same statement for every set of parameters if {many} is True (in one transaction)
+        If another process keeps the database locked, retry with exponential backoff; returns the connection and cursor, so the results can be read (close the connection with _release)
+        While a change is in progress (see _write), the statement is executed in its transaction instead, and saved with it"""
+        if self.transaction is not None:
+            cursor = self.transaction.cursor()
+            if many:
+                cursor.executemany(query, params)
+            else:
+                cursor.execute(query, params)
+            return self.transaction, cursor
+
+        def attempt():
+            sql = sqlite3.connect(self.path, timeout = self.busyTimeout, check_same_thread = False) # The rows can be read from another thread (see RepositoryMenu.prefetch)
+            try:
+                cursor = sql.cursor()
+                if many:
+                    cursor.executemany(query, params)
+                else:
+                    cursor.execute(query, params)
+                sql.commit()
+                return sql, cursor
+            except:
+                sql.close()
+                raise
+        return self._retry(attempt)
+
+
+    def _release(self, sql):
+        """Close a connection returned by _execute (unless it is the connection of the change in progress)"""
+        if sql is not self.transaction:
+            sql.close()
+
+
+    def _write(self, change):
+        """Make a change (a function that returns whether it succeeded) in one transaction, which takes the write lock right away: it is saved as a whole, or not at all
+        All statements use its connection until then (see _execute), also those of the statistics and indexes that are kept up to date with it; returns whether it was saved
+        A change made while another one is in progress is part of that one"""
+        if self.transaction is not None:
+            return change()
+        self.lastWrite = None
+
+        def begin():
+            sql = sqlite3.connect(self.path, timeout = self.busyTimeout, isolation_level = None) # Transactions are started explicitly
+            try:
+                sql.execute("BEGIN IMMEDIATE")
+                return sql
+            except:
+                sql.close()
+                raise
+        try:
+            self.transaction = self._retry(begin)
+        except Exception as e:
+            authentication.logging.log(f"Error changing {self.name}", f"File: {self.path}, Error: {str(e)}", True)
+            return False
+        try:
+            versionBefore = self.version() # No other process can change the data until this transaction ends
+            if not change():
+                return False
+            dataVersion = self.transaction.execute("PRAGMA data_version").fetchone()[0]
+            self.transaction.execute("COMMIT")
+            versionAfter = self.version()
+            if self.transaction.execute("PRAGMA data_version").fetchone()[0] == dataVersion:
+                self.lastWrite = (versionBefore, versionAfter) # No other connection has saved a change since this one (data_version changes when one does)
+            return True
+        except Exception as e:
+            authentication.logging.log(f"Error changing {self.name}", f"File: {self.path}, Error: {str(e) if len(str(e)) > 0 else 'Data integrety error'} (nothing was saved)", True)
+            return False
+        finally:
+            sql = self.transaction
+            self.transaction = None
+            sql.close() # Rolls back what was not saved
 
 
     def _safeName(self, value):
@@ -502,6 +909,7 @@ class SQLiteRepository(Repository):
         return value
     
 
+    @monitoring.profiling.timed()
     def _query(self, query, params = (), returnAll = None, leaveParamsUnencrypted = 0, leaveEncrypted = False):
         """Perform a database query"""
         if not self.initialized:
@@ -511,35 +919,84 @@ class SQLiteRepository(Repository):
             # Encrypt all but last 'paramLeaveOpen' parameters (useful for queries like: UPDATE ?, ?, ? WHERE ID = ? -- where the last parameter should stay unencrypted)
             leaveParamsUnencrypted = leaveParamsUnencrypted if leaveParamsUnencrypted <= len(params) else len(params)
             originalParams = params
-            params = tuple(map(storage.encryption.encrypt, params[:-leaveParamsUnencrypted] if leaveParamsUnencrypted > 0 else params)) + ((params[-leaveParamsUnencrypted],) if leaveParamsUnencrypted > 0 else tuple())
-            with sqlite3.connect(self.path) as sql:
-                cursor = sql.cursor()
-                cursor.execute(query, params)
-                sql.commit()
+            params = tuple(map(storage.encryption.encrypt, params[:-leaveParamsUnencrypted] if leaveParamsUnencrypted > 0 else params)) + (tuple(params[-leaveParamsUnencrypted:]) if leaveParamsUnencrypted > 0 else tuple())
+            sql, cursor = self._execute(query, params)
+            try:
                 authentication.logging.log(f"Query {self.table}", f"File: {self.path}, Query: {query}, Parameters: {str(originalParams)}, Encrypted parameters: {str(params)}")
-            if returnAll is not None:
-                # Return the result if parameter returnAll is set to True [all] or False [one], but not None
-                if returnAll:
-                    results = cursor.fetchall()
-                    if not results:
-                        # No results
-                        return []
-                    return results if leaveEncrypted else [tuple(map(storage.encryption.decrypt, result)) for result in results]
-                else:
-                    result = cursor.fetchone()
-                    if not result:
-                        # No result
-                        return None
-                    return results if leaveEncrypted else tuple(map(storage.encryption.decrypt, result))
-            return True
+                if returnAll is not None:
+                    # Return the result if parameter returnAll is set to True [all] or False [one], but not None
+                    if returnAll:
+                        results = cursor.fetchall()
+                        if not results:
+                            # No results
+                            return []
+                        return results if leaveEncrypted else [tuple(map(storage.encryption.decrypt, result)) for result in results]
+                    else:
+                        result = cursor.fetchone()
+                        if not result:
+                            # No result
+                            return None
+                        return result if leaveEncrypted else tuple(map(storage.encryption.decrypt, result))
+                return True
+            finally:
+                self._release(sql)
         except Exception as e:
             authentication.logging.log(f"Error querying database", f"File: {self.path}, Query: {query}, Parameters: {str(originalParams)}, Encrypted parameters: {str(params)}, Error: {str(e) if len(str(e)) > 0 else 'Data integrety error'}", True)
             return False if returnAll is None else None if returnAll is False else []
     
     
-    def _fields(self, suffix = None):
-        """Return the fields as a string for use in a query: 'field1, field2, field3', possibly with a suffix: 'field1 TEXT, field2 TEXT, field3 TEXT'"""
-        return ", ".join([self._safeName(field) + ("" if suffix is None else " " + suffix) for field in self.form.fields])
+    @monitoring.profiling.timed()
+    def _stream(self, query, leaveEncrypted = False, params = ()):
+        """Perform a database query and yield the (decrypted) result rows one by one (without loading all of them into memory); the {params} are not encrypted
+        Errors are logged and raised, so rows that were read before an error are never taken for all of them"""
+        if not self.initialized:
+            return
+        try:
+            sql, cursor = self._execute(query, params)
+            try:
+                while True:
+                    results = cursor.fetchmany(100)
+                    if not results:
+                        break
+                    for result in results:
+                        yield result if leaveEncrypted else tuple(map(storage.encryption.decrypt, result))
+            finally:
+                self._release(sql)
+        except Exception as e:
+            authentication.logging.log(f"Error querying database", f"File: {self.path}, Query: {query}, Error: {str(e) if len(str(e)) > 0 else 'Data integrety error'}", True)
+            raise # The rows read so far are not all of them
+
+
+    def version(self):
+        """Changes whenever any connection (in any process) commits a change to the database file
+        The modification time and size alone don't do: a change that overwrites rows keeps the size, and two changes can be made within one tick of the clock
+        SQLite keeps a counter in the file header that every commit increases, and reports a change of it to a connection that stays open as its data_version"""
+        if not os.path.exists(self.path):
+            return None
+        stat = os.stat(self.path)
+        with self.versionLock:
+            if self.versionConnection is None or self.versionConnection[:2] != (os.getpid(), stat.st_ino):
+                # Opened again if the file was replaced, or in a new process (a connection can't be shared with a forked one)
+                sql = sqlite3.connect(self.path, timeout = self.busyTimeout, check_same_thread = False)
+                self.versionConnection = (os.getpid(), stat.st_ino, sql)
+            dataVersion = self._retry(lambda: self.versionConnection[2].execute("PRAGMA data_version").fetchone()[0])
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size, dataVersion)
+
+
+    def _scan(self, offset = 0, fields = None):
+        """Yield (position, id, item) for every row from {offset}, in storage order (the values are decrypted when they are first used)"""
+        fields = list(self.form.fields.keys()) if fields is None else fields
+        position = int(offset)
+        for result in self._stream(f"SELECT {self._fields(None, fields)} FROM {self.table} LIMIT -1 OFFSET {position}", True):
+            position += 1
+            item = self.form.record(zip(fields, result), True)
+            if self.idField in item:
+                yield position, item[self.idField], item
+
+
+    def _fields(self, suffix = None, fields = None):
+        """Return the (given or all) fields as a string for use in a query: 'field1, field2, field3', possibly with a suffix: 'field1 TEXT, field2 TEXT, field3 TEXT'"""
+        return ", ".join([self._safeName(field) + ("" if suffix is None else " " + suffix) for field in (self.form.fields if fields is None else fields)])
 
 
     def _initialize(self):
@@ -553,10 +1010,57 @@ class SQLiteRepository(Repository):
         fieldList = self._fields("TEXT")
         self.initialized = True
         self._query(f"CREATE TABLE IF NOT EXISTS {self.table} ({fieldList})")
-
-
-    def _list(self, offset, limit, search = None):
-        """List all items in the repository (from offset X with a limit of Y and a possible search parameter)"""
+        self.schemaVersion = storage.migrations.migrate(self)
+
+
+    def _indexDefinitions(self):
+        """All index columns of the table: column => (schema version that adds it, indexed fields, function that gives the normalized value to hash from a model)"""
+        return { "_id_index": (1, [self.idField], lambda model: str(model[self.idField]).upper()) }
+
+
+    def _indexKeys(self, version = None):
+        """Index columns the table has (up to its schema version, or {version}): column => (indexed fields, function that gives the normalized value to hash from a model)"""
+        version = self.schemaVersion if version is None else version
+        return { column: (fields, normalize) for column, (since, fields, normalize) in self._indexDefinitions().items() if since <= version }
+
+
+    def _indexes(self, model):
+        """Index columns of a row and their values (keyed hashes, so rows can be found without decrypting them); only the indexes of which {model} has all fields"""
+        return { column: storage.encryption.keyedHash(normalize(model)) for column, (fields, normalize) in self._indexKeys().items() if all(field in model for field in fields) }
+
+
+    @monitoring.profiling.timed()
+    def _count(self, filter = None):
+        """Count the rows: the count kept in the database (see storage.migrations), or with a {filter}, the rows found in the keyed indexes of the filtered fields
+        Only filtered fields without an index are decrypted, of the rows the indexes leave"""
+        filter = filter or {}
+        if len(filter) == 0 and self.schemaVersion >= 2:
+            result = self._query("SELECT count FROM row_counts WHERE name = ?", (self.table,), False, 1, True)
+            return result[0] if result is not None else 0
+        conditions = []
+        params = []
+        indexed = set()
+        for column, (fields, normalize) in self._indexKeys().items():
+            if all(field in filter for field in fields):
+                hashes = storage.encryption.keyedHashes(normalize(filter)) # More than one while the key is being rotated
+                conditions.append(f"{column} IN ({', '.join('?' for _ in hashes)})")
+                params += hashes
+                indexed.update(fields)
+        where = f" WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ""
+        remaining = { field: str(value).upper() for field, value in filter.items() if field not in indexed }
+        if len(remaining) == 0:
+            result = self._query(f"SELECT COUNT(*) FROM {self.table}{where}", tuple(params), False, len(params), True)
+            return result[0] if result is not None else 0
+        count = 0
+        for result in self._stream(f"SELECT {self._fields(None, remaining)} FROM {self.table}{where}", False, tuple(params)):
+            if all(value.upper() == remaining[field] for field, value in zip(remaining, result)):
+                count += 1
+        return count
+
+
+    @monitoring.profiling.timed()
+    def _list(self, offset, limit, search = None, fields = None):
+        """List all items in the repository (from offset X with a limit of Y and a possible search parameter), with only the given {fields} if not searching"""
         
         # Ensure even offset and limit are safe (digits only)
         if not re.search(r'^\d+$', str(offset)) or not re.search(r'^\d+$', str(limit)):
@@ -566,27 +1070,31 @@ class SQLiteRepository(Repository):
             offset = int(offset)
             limit = int(limit)
             totalResults = 0
+            self.rowsScanned = 0
             keyedResults = {}
             results = ["dummy"]
+            # Searching looks at all fields, otherwise only the requested fields are selected
+            fields = list(self.form.fields.keys()) if fields is None or search is not None else fields
             while len(results) > 0 and totalResults < limit:
                 # Because data is encrypted and randomized, there is no other way than to just loop through everything to find it
-                results = self._query(f"SELECT {self._fields()} FROM {self.table} LIMIT {limit} OFFSET {offset}", (), True)
-                fields = list(self.form.fields.keys())
+                results = self._query(f"SELECT {self._fields(None, fields)} FROM {self.table} LIMIT {limit} OFFSET {offset}", (), True, 0, True)
                 if results is None:
                     break
+                self.rowsScanned += len(results)
                 for result in results:
+                    # Values are only decrypted when they are used (for searching or displaying)
+                    parsedResult = self.form.record(zip(fields, result), True)
 
                     found = True
                     if search is not None:
                         # Check if the search parameter is found in any of the fields
                         found = False
-                        for value in result:
+                        for value in parsedResult.values():
                             if str(search).upper() in str(value).upper():
                                 found = True
                                 break
                     if found:
                         # We found a match!
-                        parsedResult = dict(zip(fields, result))
                         if self.idField in parsedResult:
                             keyedResults[parsedResult[self.idField]] = parsedResult
                             totalResults += 1
@@ -603,6 +1111,14 @@ class SQLiteRepository(Repository):
 
     def _findEncrypted(self, id):
         """Helper function to find the encrypted ID as it is stored in the database"""
+        if self.idField is not None and self.schemaVersion >= 1:
+            # Look it up in the keyed index (and check the decrypted value, in case of a hash collision)
+            hashes = storage.encryption.keyedHashes(str(id).upper()) # More than one while the key is being rotated
+            results = self._query(f"SELECT {self._safeName(self.idField)} FROM {self.table} WHERE _id_index IN ({', '.join('?' for _ in hashes)})", tuple(hashes), True, len(hashes), True)
+            for (encrypted,) in results or []:
+                if storage.encryption.decrypt(encrypted).upper() == str(id).upper():
+                    return encrypted
+            return None
         if self.idField is not None:
             offset = 0
             limit = 20
@@ -621,30 +1137,123 @@ class SQLiteRepository(Repository):
             return None # Not found...
 
 
+    @monitoring.profiling.timed()
     def _one(self, id):
         """Get one item in the repository (by id)"""
         encrypted = self._findEncrypted(id)
         if encrypted is not None:
-            result = self._query(f"SELECT {self._fields()} FROM {self.table} WHERE {self._safeName(self.idField)} = ?", (encrypted,), False, 1)
+            result = self._query(f"SELECT {self._fields()} FROM {self.table} WHERE {self._safeName(self.idField)} = ?", (encrypted,), False, 1, True)
             if result is None:
                 return None
-            return dict(zip(self.form.fields, result))
+            return self.form.record(zip(self.form.fields, result), True)
         
 
+    @monitoring.profiling.timed()
     def _add(self, model):
         """Insert a new row into the database"""
-        placeholders = ", ".join("?" for _ in self.form.fields)
-        return self._query(f"INSERT INTO {self.table} ({self._fields()}) VALUES ({placeholders})", tuple(model.values()))
+        indexes = self._indexes(model)
+        columns = ", ".join([self._fields()] + list(indexes.keys()))
+        placeholders = ", ".join("?" for _ in list(self.form.fields) + list(indexes))
+        return self._query(f"INSERT INTO {self.table} ({columns}) VALUES ({placeholders})", tuple(model.values()) + tuple(indexes.values()), None, len(indexes))
+
+
+    @monitoring.profiling.timed()
+    def _addMany(self, models):
+        """Insert several rows into the database in one transaction"""
+        if not self.initialized or len(models) == 0:
+            return len(models) == 0
+        indexes = list(self._indexes(models[0]).keys())
+        columns = ", ".join([self._fields()] + indexes)
+        placeholders = ", ".join("?" for _ in list(self.form.fields) + indexes)
+        query = f"INSERT INTO {self.table} ({columns}) VALUES ({placeholders})"
+        try:
+            rows = [tuple(map(storage.encryption.encrypt, model.values())) + tuple(self._indexes(model).values()) for model in models]
+            sql, _ = self._execute(query, rows, True)
+            self._release(sql)
+            authentication.logging.log(f"Query {self.table}", f"File: {self.path}, Query: {query}, Rows: {len(rows)}")
+            return True
+        except Exception as e:
+            authentication.logging.log(f"Error querying database", f"File: {self.path}, Query: {query}, Rows: {len(models)}, Error: {str(e) if len(str(e)) > 0 else 'Data integrety error'}", True)
+            return False
 
 
+    def _existing(self, ids):
+        """Find which of the given ids are already used, with one query on the keyed index; returns them in upper case"""
+        ids = set(str(id).upper() for id in ids)
+        if self.schemaVersion < 1 or len(ids) == 0:
+            return super()._existing(ids)
+        hashes = { hash: id for id in ids for hash in storage.encryption.keyedHashes(id) }
+        results = self._query(f"SELECT {self._safeName(self.idField)}, _id_index FROM {self.table} WHERE _id_index IN ({', '.join('?' for _ in hashes)})", tuple(hashes.keys()), True, len(hashes), True)
+        # Check the decrypted values, in case of a hash collision
+        return set(hashes[hash] for encrypted, hash in results or [] if storage.encryption.decrypt(encrypted).upper() == hashes[hash])
+
+
+    @monitoring.profiling.timed()
+    def fuzzySearch(self, text, offset = 0):
+        """Yield (id, item) for the items with names (the {fuzzyFields}) most like {text}, allowing for typos, best match first, from {offset}; nextOffset is kept up to date
+        Only a shortlist from the trigram index is decrypted (see storage.search), so this costs about the same as an exact lookup"""
+
+        if not authentication.user.requireAccess(self.readRole(None, None), f"Unauthorized read of all {self.name}", f"Offset: {offset}, Fuzzy search: {text}", True):
+            return # User has no access
+        authentication.logging.log(f"Fuzzy search {self.name}", f"Search: {text}, Offset: {offset}")
+
+        results = storage.search.search(self, text)
+        returned = 0
+        for position, (id, item) in enumerate(results[offset:], offset + 1):
+            self.nextOffset = position
+            # Only yield validated items (errors will be logged by self.validate)
+            if self.validate("Read", item) and self.readRole(id, item):
+                returned += 1
+                yield id, item
+        self._countQuery(text, len(results), returned)
+
+
+    def _similar(self, model):
+        """Find the ids of other rows with the same (normalized) values in an index than {model}, with one index lookup per index: index fields => ids"""
+        similar = {}
+        for column, (fields, normalize) in self._indexKeys().items():
+            if column == "_id_index" or any(field not in model for field in fields):
+                continue
+            hashes = storage.encryption.keyedHashes(normalize(model)) # More than one while the key is being rotated
+            results = self._query(f"SELECT {self._safeName(self.idField)} FROM {self.table} WHERE {column} IN ({', '.join('?' for _ in hashes)})", tuple(hashes), True, len(hashes))
+            ids = [id for (id,) in results or [] if str(id).upper() != str(model.get(self.idField, "")).upper()]
+            if len(ids) > 0:
+                similar[tuple(fields)] = ids
+        return similar
+
+
+    def _duplicates(self):
+        """Yield (index fields, items) for every group of rows with the same (normalized) values in an index (other than the id), with one pass over each index
+        Only the ID field and table columns of the items are read (they are decrypted when they are used)"""
+        fields = self.form.listFields(self.idField)
+        for column, (indexFields, _) in self._indexKeys().items():
+            if column == "_id_index":
+                continue
+            query = f"SELECT {column}, {self._fields(None, fields)} FROM {self.table} WHERE {column} IN (SELECT {column} FROM {self.table} WHERE {column} IS NOT NULL GROUP BY {column} HAVING COUNT(*) > 1) ORDER BY {column}"
+            group = []
+            previous = None
+            for hash, *values in self._stream(query, True):
+                if hash != previous and len(group) > 0:
+                    yield tuple(indexFields), group
+                    group = []
+                previous = hash
+                group.append(self.form.record(zip(fields, values), True))
+            if len(group) > 0:
+                yield tuple(indexFields), group
+
+
+    @monitoring.profiling.timed()
     def _replace(self, id, model):
         """Replace/update a row in the database (by id)"""
         encrypted = self._findEncrypted(id)
         if encrypted is not None:
-            return self._query(f'UPDATE {self.table} SET {self._fields("= ?")} WHERE {self._safeName(self.idField)} = ?', tuple(model.values()) + (encrypted,), None, 1)
+            indexes = self._indexes(model)
+            columns = ", ".join([self._fields("= ?")] + [f"{column} = ?" for column in indexes])
+            return self._query(f'UPDATE {self.table} SET {columns} WHERE {self._safeName(self.idField)} = ?', tuple(model.values()) + tuple(indexes.values()) + (encrypted,), None, len(indexes) + 1)
         return False # Not found
         
 
+    @monitoring.profiling.timed()
     def _remove(self, id):
         """Remove a row from the database (by id)"""
         encrypted = self._findEncrypted(id)
@@ -0,0 +1,98 @@
+# Allocation of new member IDs: without collisions, in constant time, and atomic across processes
+# The IDs of a year (the first two digits) are handed out in a fixed pseudo-random order: the n-th ID is a permutation of n that depends on a random salt,
+# so no two allocations get the same ID and the IDs don't reveal how many members there are; only a counter and the salt are stored per year (in the member_id_counters table)
+# They are stored encrypted, like everything else: with them, the order could be reversed to list every ID that was handed out (and the counter tells how many there are)
+# IDs given out before the allocator existed were random, so an allocated ID is still looked up in the keyed index (and skipped if it is used)
+
+import hashlib
+import hmac
+import json
+import secrets
+import sqlite3
+import storage.encryption
+import storage.migrations
+import validation.datetime
+import validation.rules
+
+idsPerYear = 10 ** 7 # Seven digits after the year
+
+
+def permute(number, salt):
+    """Map the numbers 0 up to {idsPerYear} onto themselves in a pseudo-random order determined by {salt}
+    A Feistel network shuffles 24 bit numbers; it is applied again until the result is in range (which keeps it a one-to-one mapping)"""
+    while True:
+        left, right = number >> 12, number & 0xFFF
+        for round in range(4):
+            mixed = int.from_bytes(hmac.new(salt, bytes([round]) + right.to_bytes(2, "big"), hashlib.sha256).digest()[:2], "big") & 0xFFF
+            left, right = right, left ^ mixed
+        number = (left << 12) | right
+        if number < idsPerYear:
+            return number
+
+
+def used(repository, sql, id):
+    """Check if a member ID is already used (in the keyed index of the repository's table)"""
+    if repository.schemaVersion < 1:
+        return len(repository._existing([id])) > 0 # No index yet
+    hashes = storage.encryption.keyedHashes(id)
+    results = sql.execute(f"SELECT {repository._safeName(repository.idField)} FROM {repository.table} WHERE _id_index IN ({', '.join('?' for _ in hashes)})", hashes).fetchall()
+    return any(storage.encryption.decrypt(encrypted).upper() == id for (encrypted,) in results)
+
+
+def createTable(sql):
+    """Create the table of the counters; counters stored in plain text by an earlier version (in the member_ids table) are moved into it, encrypted"""
+    sql.execute("CREATE TABLE IF NOT EXISTS member_id_counters (prefix TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    if sql.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'member_ids'").fetchone() is not None:
+        for prefix, next, salt in sql.execute("SELECT prefix, next, salt FROM member_ids").fetchall():
+            save(sql, prefix, next, salt)
+        sql.execute("DROP TABLE member_ids")
+
+
+def load(sql, prefix):
+    """Get the counter and salt of a year: (next, salt), or None if no IDs have been allocated for it yet"""
+    result = sql.execute("SELECT value FROM member_id_counters WHERE prefix = ?", (prefix,)).fetchone()
+    return None if result is None else tuple(json.loads(storage.encryption.decrypt(result[0])))
+
+
+def save(sql, prefix, next, salt):
+    sql.execute("INSERT OR REPLACE INTO member_id_counters (prefix, value) VALUES (?, ?)", (prefix, storage.encryption.encrypt(json.dumps([next, salt]))))
+
+
+def connect(repository):
+    return sqlite3.connect(repository.path, timeout = repository.busyTimeout, isolation_level = None) # Transactions are started explicitly
+
+
+def memberIds(repository, count = 1, prefix = None):
+    """Allocate {count} new, valid, unused member IDs for the current year (or the year given as two digit {prefix}) for the members {repository}
+    The IDs are reserved right away, so no other call (in any process) gets them"""
+    prefix = validation.datetime.shortYear() if prefix is None else prefix
+    sql = connect(repository)
+    try:
+        with storage.migrations.transaction(sql):
+            createTable(sql)
+            next, salt = load(sql, prefix) or (0, secrets.token_hex(16))
+            ids = []
+            while len(ids) < count:
+                if next >= idsPerYear:
+                    raise ValueError(f"All member IDs starting with {prefix} have been used")
+                id = prefix + f"{permute(next, bytes.fromhex(salt)):07d}"
+                id += validation.rules.memberIDChecksum(id)
+                next += 1
+                if not used(repository, sql, id):
+                    ids.append(id)
+            save(sql, prefix, next, salt)
+        return ids
+    finally:
+        sql.close()
+
+
+def reencrypt(repository):
+    """Encrypt the counters again with the newest key (see storage.rotation)"""
+    sql = connect(repository)
+    try:
+        with storage.migrations.transaction(sql):
+            createTable(sql)
+            for (prefix,) in sql.execute("SELECT prefix FROM member_id_counters").fetchall():
+                save(sql, prefix, *load(sql, prefix))
+    finally:
+        sql.close()
@@ -0,0 +1,123 @@
+# Asynchronous (asyncio) access to the repositories, for non-interactive integrations
+# The blocking repository methods (database queries, file access and encryption) run on a bounded pool of worker threads, so they never block the event loop
+# Every call goes through the normal repository methods, so the same access checks and logging apply
+
+import asyncio
+import concurrent.futures
+import contextvars
+import functools
+import itertools
+import threading
+import authentication.logging
+import authentication.user
+
+maxWorkers = 4 # Maximum number of repository calls running at the same time
+executor = None
+executorLock = threading.Lock()
+
+
+def getExecutor():
+    """Get the shared pool of worker threads (created when it is first needed)"""
+    global executor
+    with executorLock:
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers = maxWorkers, thread_name_prefix = "repository")
+        return executor
+
+
+def shutdown():
+    """Stop the worker threads (calls that have not started yet are canceled)"""
+    global executor
+    with executorLock:
+        if executor is not None:
+            executor.shutdown(wait = True, cancel_futures = True)
+            executor = None
+
+
+async def run(function, *args, **kwargs):
+    """Run a blocking function on the worker threads, in a copy of the caller's context (so context variables are the same)
+    If the calling task is canceled before the function has started, it will not run at all; once started, it finishes and the result is dropped"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(getExecutor(), functools.partial(context.run, function, *args, **kwargs))
+
+
+class AsyncRepository:
+    """Asynchronous version of a repository: the same methods, but awaitable
+
+    Repository objects keep state while they work (such as nextOffset and validation errors), so each worker thread gets its own repository object from {factory}
+    (for example: AsyncRepository(storage.repositories.Members)); they share the same storage"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.local = threading.local()
+
+
+    def repository(self):
+        """Get the repository object of the current worker thread"""
+        if not hasattr(self.local, "repository"):
+            self.local.repository = self.factory()
+        return self.local.repository
+
+
+    async def call(self, method, *args):
+        """Call a method of the repository on a worker thread
+        There is no one to ask for a login, so without a logged in user the call is refused and logged (instead of asking for a login like the blocking methods do)"""
+        if not authentication.user.loggedIn():
+            authentication.logging.log(f"Unauthorized {method} in {self.factory.__name__}", "No user is logged in", True)
+            return None
+        return await run(lambda: getattr(self.repository(), method)(*args))
+
+
+    async def readAll(self, offset = 0, limit = 20, search = None, columnsOnly = False):
+        return await self.call("readAll", offset, limit, search, columnsOnly)
+
+
+    async def readOne(self, id):
+        return await self.call("readOne", id)
+
+
+    async def exists(self, id):
+        return await self.call("exists", id)
+
+
+    async def insert(self, model):
+        return await self.call("insert", model)
+
+
+    async def update(self, id, model):
+        return await self.call("update", id, model)
+
+
+    async def delete(self, id):
+        return await self.call("delete", id)
+
+
+    async def scan(self, offset = 0, search = None, columnsOnly = False, batchSize = 100):
+        """Yield (id, item) for all (matching) items, like Repository.scan; items are read {batchSize} at a time on the worker threads
+        The scan stops (and its storage is closed) as soon as the consumer stops iterating or its task is canceled"""
+        if not authentication.user.loggedIn():
+            authentication.logging.log(f"Unauthorized scan in {self.factory.__name__}", "No user is logged in", True)
+            return
+        repository = await run(self.factory) # A repository object of its own, since the batches may be read by different worker threads
+        generator = repository.scan(offset, search, columnsOnly)
+        lock = threading.Lock() # A batch may still be running when the scan is closed
+
+        def nextBatch():
+            with lock:
+                return list(itertools.islice(generator, batchSize))
+
+        def close():
+            with lock:
+                generator.close()
+
+        try:
+            while True:
+                batch = await run(nextBatch)
+                for id, item in batch:
+                    yield id, item
+                if len(batch) < batchSize:
+                    break
+        finally:
+            # Release the scan on a worker thread (after the batch that is being read, if any), without waiting for it
+            getExecutor().submit(close)
@@ -2,19 +2,29 @@
 
 import base64
 import hashlib
+import hmac
 import os
 import random
+import time
 
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+import monitoring.metrics
+import monitoring.profiling
+import storage.locking
 
 privateKey = None
 publicKey = None
 encryptor = None
+indexKeys = None # Keys for keyed hashes (derived from the symmetric keys, in the same order)
+keyCount = 0 # Number of symmetric keys in use (more than one while the key is being rotated, see storage.rotation)
+keyFileVersion = None # Modification time and size of the key file when it was loaded
+keysChecked = 0 # When the key file was last checked for changes
+reloadInterval = 5 # Number of seconds between checks for a changed key file (another process may have rotated the key)
 
 def hashData(data):
     """Hash string data"""
@@ -55,6 +65,92 @@ def checkDataHash(data, hash):
     return hashData(bytes.fromhex(salt) + data.encode()) == hash
     
 
+def keyedHash(data):
+    """Keyed hash (HMAC) of string data: equal values have equal hashes, so they can be found without decrypting, but without the key nothing can be learned from them"""
+    checkKeys()
+    return hmac.new(indexKeys[0], str(data).encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def keyedHashes(data):
+    """Keyed hashes of string data with every key in use (while the key is being rotated, stored hashes may have been made with the old key)"""
+    checkKeys()
+    return [hmac.new(key, str(data).encode("utf-8"), hashlib.sha256).hexdigest() for key in indexKeys]
+
+
+def useKeys(keys):
+    """Use these symmetric keys: the first one encrypts, all of them can decrypt"""
+    global encryptor, indexKeys, keyCount
+    encryptor = MultiFernet([Fernet(key) for key in keys])
+    indexKeys = [hashlib.sha256(b"index" + key).digest() for key in keys]
+    keyCount = len(keys)
+
+
+def loadKeys():
+    """Load the symmetric keys from the key file (newest first, one per line, encrypted with the public key)"""
+    global keyFileVersion, keysChecked
+    with storage.locking.locked("./output/.key"), open("./output/.key", "rb") as file:
+        keys = decryptAsymmetric(file.read()).split(b"\n")
+        stat = os.fstat(file.fileno())
+    useKeys(keys)
+    keyFileVersion = (stat.st_mtime_ns, stat.st_size)
+    keysChecked = time.monotonic()
+
+
+def saveKeys(keys):
+    """Replace the symmetric keys in the key file (another process may be reading them, so the file is replaced as a whole)"""
+    global keyFileVersion
+    with storage.locking.locked("./output/.key", True):
+        with open("./output/.key.tmp", "wb") as file:
+            file.write(encryptAsymmetric(b"\n".join(keys)))
+        os.replace("./output/.key.tmp", "./output/.key")
+    useKeys(keys)
+    stat = os.stat("./output/.key")
+    keyFileVersion = (stat.st_mtime_ns, stat.st_size)
+
+
+def readKeys():
+    """Read the symmetric keys from the key file"""
+    with storage.locking.locked("./output/.key"), open("./output/.key", "rb") as file:
+        return decryptAsymmetric(file.read()).split(b"\n")
+
+
+def addKey():
+    """Add a new symmetric key, which is used to encrypt from now on (the current keys can still decrypt); returns all keys, newest first"""
+    with storage.locking.locked("./output/.key", True):
+        keys = [Fernet.generate_key()] + readKeys()
+        saveKeys(keys)
+    return keys
+
+
+def retireKeys():
+    """Stop using all but the newest symmetric key (when nothing is encrypted with the older keys anymore)"""
+    with storage.locking.locked("./output/.key", True):
+        saveKeys(readKeys()[:1])
+
+
+def reloadKeys():
+    """Load the symmetric keys again if the key file was changed (by another process); returns whether they were changed"""
+    global keysChecked
+    keysChecked = time.monotonic()
+    try:
+        stat = os.stat("./output/.key")
+    except OSError:
+        return False
+    if (stat.st_mtime_ns, stat.st_size) == keyFileVersion:
+        return False
+    loadKeys()
+    return True
+
+
+def checkKeys():
+    """Ensure the symmetric keys are loaded, and load them again if another process may have changed them since they were last checked
+    Everything that is written with the newest key (encrypted values and keyed hashes) checks this first"""
+    if encryptor is None:
+        initializeKeys()
+    elif time.monotonic() - keysChecked > reloadInterval:
+        reloadKeys() # Start using a new key as soon as another process adds one
+
+
 def initializeKeys():
     """Ensure an encryption key exists"""
     global privateKey, publicKey, encryptor
@@ -74,10 +170,8 @@ def initializeKeys():
             publicKey = serialization.load_pem_public_key(file.read(), backend=default_backend())
         if not os.path.isdir('./output'):
             os.mkdir("./output")
-        # Load and decrypt the Fernet key for symmetric entryption
-        with open("./output/.key", "rb") as file:
-            key = decryptAsymmetric(file.read())
-        encryptor = Fernet(key)
+        # Load and decrypt the Fernet keys for symmetric entryption
+        loadKeys()
         return False # Key already generated
     except:
         pass
@@ -104,10 +198,7 @@ def initializeKeys():
                     format=serialization.PublicFormat.SubjectPublicKeyInfo
                 ))
         if encryptor is None:
-            key = Fernet.generate_key()
-            with open("./output/.key", "wb") as file:
-                file.write(encryptAsymmetric(key))
-            encryptor = Fernet(key)
+            saveKeys([Fernet.generate_key()])
         return True # Keys were generated
 
 
@@ -135,21 +226,28 @@ def decryptAsymmetric(data):
     ))
 
 
+@monitoring.profiling.timed("encryption.encrypt")
 def encrypt(data):
     """Symmetrically encrypt data"""
     global encryptor
     data = str(data)
-    if encryptor is None:
-        initializeKeys()
+    checkKeys()
     return encryptor.encrypt(data.encode("utf-8")).decode("utf-8")
 
 
+@monitoring.profiling.timed("encryption.decrypt")
 def decrypt(data):
     """Symmetrically decrypt data"""
     global encryptor
     if encryptor is None:
         initializeKeys()
-    return encryptor.decrypt(data.encode("utf-8")).decode("utf-8")
+    monitoring.metrics.increment("um_decryptions_total")
+    try:
+        return encryptor.decrypt(data.encode("utf-8")).decode("utf-8")
+    except InvalidToken:
+        if not reloadKeys():
+            raise
+        return encryptor.decrypt(data.encode("utf-8")).decode("utf-8") # Encrypted with a key another process has added
 
 
 def tempPassword():
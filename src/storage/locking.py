@@ -0,0 +1,59 @@
+# Advisory file locks, so several processes (and threads) can safely work on the same files in ./output
+# Each file is protected by a separate lock file next to it ('logs' => 'logs.lock'), which stays in place when the file itself is replaced
+#   - Shared: for opening a file to read it and for appending lines (appends are single writes to a file opened in append mode)
+#   - Exclusive: for rewriting a file (the new content is written to a temporary file, which is synced to disk and then replaces the file)
+# Readers only hold the lock while opening the file: a file is only ever replaced as a whole, so an open file always has complete content
+# Locking is not available on systems without fcntl (Windows); the locks do nothing there
+
+import contextlib
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+held = threading.local() # Locks held by the current thread: path => exclusive (a thread can take a lock it already holds again)
+
+
+@contextlib.contextmanager
+def locked(path, exclusive = False, wait = True):
+    """Hold a shared (or exclusive) lock on a file for the duration of the with block
+    Yields whether the lock is held: always True, unless {wait} is False and another process holds the lock"""
+    locks = held.__dict__.setdefault("locks", {})
+    if fcntl is None or path in locks:
+        # No locking available, or already locked by this thread (locking again would wait for ourselves)
+        if path in locks and exclusive and not locks[path]:
+            raise RuntimeError(f"Can't lock '{path}' for writing while it is locked for reading by the same thread")
+        yield True
+        return
+    try:
+        lockFile = open(path + ".lock", "a")
+    except OSError:
+        # The lock file can't be created (read-only folder): nobody else can change the file either
+        yield True
+        return
+    with lockFile:
+        try:
+            fcntl.flock(lockFile.fileno(), (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False # Held by another process
+            return
+        locks[path] = exclusive
+        try:
+            yield True
+        finally:
+            del locks[path]
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+
+
+def syncDirectory(path):
+    """Write the folder entry of a file to disk (after it was replaced or removed), so the change survives a crash"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return # Folders can't be opened (Windows)
+    directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
@@ -0,0 +1,171 @@
+# Schema versions and migrations of the SQLite database
+# The schema_version table holds the version of every table; migrations are applied in order to bring a table up to date when it is opened
+# Migrations that change existing rows do so in batches, each in a transaction of its own that also records how far the migration got,
+# so the table is never locked for long and an interrupted migration continues where it left off (in this process or another one)
+
+import contextlib
+import sqlite3
+import authentication.logging
+import storage.encryption
+import storage.search
+
+batchSize = 500 # Number of rows changed per transaction
+
+
+class Migration:
+    """One migration step: {prepare} changes the schema, {update} changes existing rows (a batch at a time) and {finish} completes the migration
+    All three get the repository and the database connection; {update} also gets a batch of rows: (rowid, *{columns}) tuples"""
+
+    def __init__(self, description, prepare = None, columns = None, update = None, finish = None):
+        self.description = description
+        self.prepare = prepare
+        self.columns = columns # Function that returns the (safe) column names {update} needs
+        self.update = update
+        self.finish = finish
+
+
+def updateIdIndex(repository, sql, rows):
+    """Store the keyed hash of the (decrypted) id of every row"""
+    sql.executemany(f"UPDATE {repository.table} SET _id_index = ? WHERE rowid = ?", [(storage.encryption.keyedHash(storage.encryption.decrypt(id).upper()), rowid) for rowid, id in rows])
+
+
+def createRowCount(repository, sql):
+    """Count the rows of the table in the row_counts table, and keep the count up to date with triggers (so it is right whichever process or statement changes the table)"""
+    table = repository.table
+    sql.execute("CREATE TABLE IF NOT EXISTS row_counts (name TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+    sql.execute(f"INSERT OR REPLACE INTO row_counts (name, count) SELECT ?, COUNT(*) FROM {table}", (table,))
+    sql.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_count_insert AFTER INSERT ON {table} BEGIN UPDATE row_counts SET count = count + 1 WHERE name = '{table}'; END")
+    sql.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_count_delete AFTER DELETE ON {table} BEGIN UPDATE row_counts SET count = count - 1 WHERE name = '{table}'; END")
+
+
+def newIndexes(repository, version):
+    """Index columns that schema version {version} adds to the table of a repository: column => (indexed fields, normalize function)"""
+    return { column: keys for column, keys in repository._indexKeys(version).items() if column not in repository._indexKeys(version - 1) }
+
+
+def newIndexFields(repository, version):
+    """Fields needed for the index columns that schema version {version} adds, in order"""
+    return list(dict.fromkeys(field for _, (fields, _) in newIndexes(repository, version).items() for field in fields))
+
+
+def addIndexColumns(repository, sql, version):
+    for column in newIndexes(repository, version):
+        sql.execute(f"ALTER TABLE {repository.table} ADD COLUMN {column} TEXT")
+
+
+def updateIndexes(repository, sql, rows, version):
+    """Store the keyed hashes of the (decrypted, normalized) values of the index columns that schema version {version} adds"""
+    indexes = newIndexes(repository, version)
+    if len(indexes) == 0:
+        return
+    fields = newIndexFields(repository, version)
+    updates = []
+    for rowid, *values in rows:
+        model = dict(zip(fields, map(storage.encryption.decrypt, values)))
+        updates.append(tuple(storage.encryption.keyedHash(normalize(model)) for _, (_, normalize) in indexes.items()) + (rowid,))
+    sql.executemany(f"UPDATE {repository.table} SET {', '.join(f'{column} = ?' for column in indexes)} WHERE rowid = ?", updates)
+
+
+def createIndexes(repository, sql, version):
+    for column in newIndexes(repository, version):
+        sql.execute(f"CREATE INDEX IF NOT EXISTS {repository.table}{column} ON {repository.table} ({column})")
+
+
+# The migrations, in order: the schema version of a table is the number of migrations applied to it
+migrations = [
+    Migration("Keyed index of the id field",
+        lambda repository, sql: sql.execute(f"ALTER TABLE {repository.table} ADD COLUMN _id_index TEXT"),
+        lambda repository: [repository._safeName(repository.idField)],
+        updateIdIndex,
+        lambda repository, sql: sql.execute(f"CREATE INDEX IF NOT EXISTS {repository.table}_id_index ON {repository.table} (_id_index)")),
+    Migration("Row count", createRowCount),
+    Migration("Keyed indexes of other fields (such as the e-mail address, phone and name of members)",
+        lambda repository, sql: addIndexColumns(repository, sql, 3),
+        lambda repository: [repository._safeName(field) for field in newIndexFields(repository, 3)],
+        lambda repository, sql, rows: updateIndexes(repository, sql, rows, 3),
+        lambda repository, sql: createIndexes(repository, sql, 3)),
+    Migration("Trigram index of names, for fuzzy search",
+        lambda repository, sql: storage.search.createTable(repository, sql),
+        lambda repository: [repository._safeName(field) for field in repository.fuzzyFields],
+        lambda repository, sql, rows: storage.search.indexEncrypted(repository, sql, rows)),
+]
+
+
+@contextlib.contextmanager
+def transaction(sql):
+    """Run the with block in a transaction, which takes the write lock right away (so what is read in it can't be changed by another process)"""
+    sql.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+        sql.execute("COMMIT")
+    except:
+        sql.execute("ROLLBACK")
+        raise
+
+
+def state(sql, table):
+    """Get the schema version of a table and the position (rowid) of the migration in progress (None if there is none)"""
+    result = sql.execute("SELECT version, position FROM schema_version WHERE name = ?", (table,)).fetchone()
+    return (0, None) if result is None else result
+
+
+def save(sql, table, version, position):
+    sql.execute("INSERT OR REPLACE INTO schema_version (name, version, position) VALUES (?, ?, ?)", (table, version, position))
+
+
+def printProgress(table, description, done, total):
+    """Default progress report: a line that is updated after every batch"""
+    print(f"\rUpgrading {table} ({description}): {done} of {total} rows", end = "\n" if done >= total else "", flush = True)
+
+
+def migrate(repository, report = printProgress):
+    """Apply all migrations the table of an (initialized) SQLite repository does not have yet; returns the schema version of the table
+    {report} is called after every batch with the table name, the description of the migration, the number of rows done and the total number of rows"""
+    table = repository.table
+    sql = sqlite3.connect(repository.path, timeout = repository.busyTimeout, isolation_level = None) # Transactions are started explicitly
+    try:
+        sql.execute("CREATE TABLE IF NOT EXISTS schema_version (name TEXT PRIMARY KEY, version INTEGER NOT NULL, position INTEGER)")
+        for number, migration in enumerate(migrations, 1):
+            if state(sql, table)[0] >= number:
+                continue # Already applied
+
+            with transaction(sql):
+                version, position = state(sql, table)
+                if version < number and position is None:
+                    # Not started yet
+                    authentication.logging.log("Database migration", f"File: {repository.path}, Table: {table}, Migration {number}: {migration.description}")
+                    if migration.prepare is not None:
+                        migration.prepare(repository, sql)
+                    save(sql, table, version, 0)
+            total = sql.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            done = sql.execute(f"SELECT COUNT(*) FROM {table} WHERE rowid <= ?", (position or 0,)).fetchone()[0]
+
+            while True:
+                with transaction(sql):
+                    version, position = state(sql, table)
+                    if version >= number:
+                        break # Finished by another process
+                    rows = []
+                    if migration.update is not None:
+                        columns = ", ".join(["rowid"] + migration.columns(repository))
+                        rows = sql.execute(f"SELECT {columns} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT {batchSize}", (position,)).fetchall()
+                    if len(rows) > 0:
+                        migration.update(repository, sql, rows)
+                        save(sql, table, version, rows[-1][0])
+                    else:
+                        if migration.finish is not None:
+                            migration.finish(repository, sql)
+                        save(sql, table, number, None)
+                if len(rows) == 0:
+                    break
+                done += len(rows)
+                if report is not None:
+                    report(table, migration.description, min(done, total), total)
+        return state(sql, table)[0]
+    except Exception as e:
+        authentication.logging.log("Error migrating database", f"File: {repository.path}, Table: {table}, Error: {str(e)}", True)
+        with contextlib.suppress(sqlite3.Error):
+            return state(sql, table)[0]
+        return 0
+    finally:
+        sql.close()
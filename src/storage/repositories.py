@@ -1,6 +1,20 @@
+import json
+import os
+import re
+import unicodedata
 import validation.forms
+import authentication.logging
 import authentication.user
 import storage.abstract
+import storage.retention
+import storage.search
+import storage.statistics
+
+
+def normalizedName(model):
+    """First and last name in lower case without accents, spaces or punctuation ("Jan-Willem de Vries" and "jan willem DE VRIËS" are the same)"""
+    name = unicodedata.normalize("NFKD", f"{model['firstName']}|{model['lastName']}").lower()
+    return "".join(character for character in name if character.isalnum() or character == "|")
 
 
 class Members(storage.abstract.SQLiteRepository):
@@ -10,6 +24,7 @@ class Members(storage.abstract.SQLiteRepository):
         super().__init__(path)
         self.form = validation.forms.Member() # User form with all fields
         self.idField = "id"
+        self.fuzzyFields = ["firstName", "lastName"]
         self._initialize()
     
     def readRole(self, id, item):
@@ -21,6 +36,37 @@ class Members(storage.abstract.SQLiteRepository):
     def insertRole(self):
         return "consult"
     
+    def _indexDefinitions(self):
+        """Keyed indexes of the normalized e-mail address, phone number and name, to find members that are registered more than once"""
+        return {
+            **super()._indexDefinitions(),
+            "_email_index": (3, ["email"], lambda model: str(model["email"]).strip().lower()),
+            "_phone_index": (3, ["phone"], lambda model: re.sub(r"\D", "", str(model["phone"]))[-8:]), # Digits only, without 06 or +31 6
+            "_name_index": (3, ["firstName", "lastName"], normalizedName),
+        }
+    
+    # Keep the member statistics and the name search index up to date, in the same transaction as the change (see storage.statistics and storage.search; deleted rows are removed from the index by the database)
+    def _changedMembers(self, removed, added):
+        return storage.statistics.change(self, removed, added) and storage.search.added(self, added)
+    def _add(self, model):
+        add = super()._add
+        return self._write(lambda: add(model) and self._changedMembers([], [model]))
+    def _addMany(self, models):
+        addMany = super()._addMany
+        return self._write(lambda: addMany(models) and self._changedMembers([], models))
+    def _replace(self, id, model):
+        replace = super()._replace
+        def change():
+            old = self._one(id) # Read in the transaction, so it can't be changed by another process before it is replaced
+            return old is not None and replace(id, model) and self._changedMembers([old], [model])
+        return self._write(change)
+    def _remove(self, id):
+        remove = super()._remove
+        def change():
+            old = self._one(id)
+            return old is not None and remove(id) and self._changedMembers([old], [])
+        return self._write(change)
+    
 
 class Users(storage.abstract.SQLiteRepository):
     """Users repository class"""
@@ -58,15 +104,117 @@ class Logs(storage.abstract.FileRepository):
     def readRole(self, id, item):
         return "admin" # Overwrite 'read' access role
     
+    def segments(self):
+        return storage.retention.segments(self.path) + [self.path] # Archived (compressed) segments come before the current log file
+    
 
-class SuspiciousLogs(storage.abstract.FileRepository):
-    """Suspicious Logs repository class, for keeping track of unviewed suspicious logs (these are deleted when viewed, all logs are available in the Logs repository)"""
+class SuspiciousLogs(Logs):
+    """Suspicious Logs repository class, for keeping track of unviewed suspicious logs: the suspicious lines in the logs, numbered in the order they were logged
+    Every admin has a mark up to which they have viewed them (see authentication.logging.readSuspicious); only the lines after it are listed
+    The position in the logs of the mark is kept with it, so the logs before it are not read again (unless the file it is in has been replaced since, by archiving or re-encrypting)"""
 
-    def __init__(self, path = "./output/logs-suspicious"):
+    def __init__(self, path = "./output/logs"):
         super().__init__(path)
-        self.form = validation.forms.Log() # Log form with all fields
+        self.positions = {} # Number => position (segment, identity, byte position, number) right after suspicious lines that have been read, to continue reading from (see _readLines)
+        self.maxPositions = 1000
     
-    def readRole(self, id, item):
-        return "admin" # Overwrite 'read' access role
     def deleteRole(self, id, item):
-        return "admin" # Overwrite 'delete' access role (to "mark as read" means to delete from here; all logs will stay available in the Logs repository)
\ No newline at end of file
+        return "admin" # Overwrite 'delete' access role (to "mark as viewed" means to move the viewed mark; all logs stay available in the Logs repository)
+    
+    def version(self):
+        state = os.stat(authentication.logging.suspiciousPath) if os.path.exists(authentication.logging.suspiciousPath) else None
+        return super().version() + ((state.st_mtime_ns, state.st_size) if state is not None else (),) # The list also changes when the viewed mark is moved
+    
+    def viewed(self, state = None):
+        """Number of suspicious logs the logged in admin has viewed (all logs up to and including this number)"""
+        state = authentication.logging.readSuspicious() if state is None else state
+        return state["viewed"].get(authentication.user.name(), state["default"])
+    
+    def unviewed(self):
+        """Number of suspicious logs the logged in admin has not viewed yet (without reading the logs)"""
+        state = authentication.logging.readSuspicious()
+        return max(state["total"] - self.viewed(state), 0)
+    
+    def markViewed(self, number):
+        """Mark the suspicious logs up to and including {number} as viewed by the logged in admin"""
+        if not authentication.user.requireAccess(self.deleteRole(number, None), f"Unauthorized mark as viewed in {self.name}", f"Number: {number}", True):
+            return False # User has no access
+        authentication.logging.log(f"Marked as viewed in {self.name}", f"Up to number: {number}")
+        return self._remove(number)
+    
+    def _count(self, filter = None):
+        return super()._count(filter) if filter else self.unviewed()
+    
+    def _suspicious(self, offset = 0):
+        """Yield (number, item) for the suspicious lines numbered after {offset}
+        Reading starts at the closest known position before them (the viewed mark of the logged in admin, or lines read before) if its file is still there as it was, else at the start of the logs"""
+        state = authentication.logging.readSuspicious()
+        known = [state.get("positions", {}).get(authentication.user.name())] + list(self.positions.values())
+        files = self._openSegments()
+        lines = None
+        try:
+            opened = set((segment, self._identity(file)) for segment, file in files)
+            start = max((tuple(position) for position in known if position is not None and position[3] <= offset and tuple(position[:2]) in opened), key = lambda position: position[3], default = None)
+            number = state["dropped"] if start is None else start[3] # Numbers of the suspicious logs that are still there start after the ones that were deleted
+            lines = self._readLines(files, start)
+            for position, line in lines:
+                try:
+                    model = self.form.record(json.loads(storage.abstract.decodeLine(line)), True)
+                    if model["suspicious"] != "Y":
+                        continue # Only this field is decrypted
+                except:
+                    continue # Parsing errors are logged when reading the Logs repository
+                number += 1
+                if number > offset:
+                    if position is not None:
+                        self.positions[number] = position + (number,)
+                        while len(self.positions) > self.maxPositions:
+                            del self.positions[next(iter(self.positions))] # Forget the oldest
+                    yield number, model
+        finally:
+            if lines is not None:
+                lines.close()
+            for _, file in files:
+                file.close()
+    
+    def _scan(self, offset = 0, fields = None):
+        offset = max(offset, self.viewed())
+        for number, model in self._suspicious(offset):
+            yield number, number, model
+    
+    def _list(self, offset, limit, search = None, fields = None):
+        items = {}
+        self.rowsScanned = 0
+        self.nextOffset = offset
+        for number, _, model in self._scan(offset):
+            self.rowsScanned += 1
+            self.nextOffset = number
+            if search is None or self._matches(number, model, search):
+                items[number] = model
+                if len(items) >= limit:
+                    break
+        return items
+    
+    def _one(self, id):
+        for number, model in self._suspicious(int(id) - 1):
+            return model if number == int(id) else None
+        return None
+    
+    def _replace(self, id, model):
+        return False # Logs can't be changed
+    
+    def _remove(self, id):
+        """Move the viewed mark of the logged in admin up to {id}, with its position in the logs (one small write, the logs are not touched)"""
+        username = authentication.user.name()
+        number = int(id)
+        if number > self.viewed() and number not in self.positions:
+            for _ in self._suspicious(number - 1):
+                break # Finds its position (if reading can be continued after it)
+        position = self.positions.get(number)
+        def mark(state):
+            if number > state["viewed"].get(username, state["default"]):
+                state["viewed"][username] = number
+                if position is not None:
+                    state.setdefault("positions", {})[username] = list(position) # Otherwise the position of the previous mark is still a good place to start
+        authentication.logging.changeSuspicious(mark)
+        return True
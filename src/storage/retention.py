@@ -0,0 +1,187 @@
+# Log retention: keeps the most recent logs in the (hot) log file and moves older lines into compressed archive segments
+# Archived segments are still encrypted line by line (they are only compressed on top of that) and stay readable through the Logs repository
+
+import datetime
+import json
+import lzma
+import os
+import re
+import shutil
+import threading
+import time
+import authentication.logging
+import storage.encryption
+import storage.locking
+
+hotDays = 30 # Number of days of logs to keep in the log file itself
+hardLimitDays = None # Archived segments with only lines older than this many days are deleted (None = keep archived logs forever)
+interval = 60 * 60 # Number of seconds between maintenance runs in the background
+
+maintenanceThread = None
+
+
+def archivePath(path):
+    """Directory where archived segments of a log file are stored (an 'archive' folder next to the log file)"""
+    return os.path.join(os.path.dirname(path), "archive")
+
+
+def segments(path):
+    """List the archived segments of a log file, oldest first"""
+    directory = archivePath(path)
+    if not os.path.isdir(directory):
+        return []
+    # Segment names look like 'logs.000001.2024-01-01.2024-01-31.xz' (sequence number, first date, last date)
+    pattern = re.compile(r'^' + re.escape(os.path.basename(path)) + r'\.(\d+)\.(\d{4}-\d{2}-\d{2})\.(\d{4}-\d{2}-\d{2})\.xz$')
+    found = []
+    for file in os.scandir(directory):
+        match = pattern.search(file.name)
+        if match and file.is_file():
+            found.append((int(match.group(1)), file.path))
+    return [segment for _, segment in sorted(found)]
+
+
+def segmentDates(segment):
+    """Get the first and last date of the lines in an archived segment (from its name)"""
+    parts = os.path.basename(segment).split(".")
+    return parts[-3], parts[-2]
+
+
+def lineDate(line):
+    """Decrypt the date of an (encrypted) log line, or None if it can't be read"""
+    try:
+        return storage.encryption.decrypt(json.loads(line)["date"])
+    except:
+        return None
+
+
+def alreadyArchived(file, segment):
+    """Byte position in an opened log file right after its first lines, if they are the lines of the archived {segment} (0 if they are not)
+    They are still there if archiving was interrupted after the segment was saved, but before the lines were removed from the log file"""
+    with lzma.open(segment, "rb") as data:
+        first = data.readline()
+        if len(first) == 0 or file.readline() != first:
+            return 0
+        last = first
+        for last in data:
+            pass # Decompressed only to find the last line
+    file.seek(0)
+    position = 0
+    for line in iter(file.readline, b""):
+        position += len(line)
+        if line == last:
+            return position
+    return 0
+
+
+def archive(path = "./output/logs", days = None):
+    """Move the lines older than {days} days from the start of a log file into a new compressed archive segment; returns the number of archived lines"""
+
+    days = hotDays if days is None else days
+    cutoff = str(datetime.date.today() - datetime.timedelta(days = days))
+
+    with authentication.logging.lock, storage.locking.locked(path, True):
+        # No new lines can be logged (by this or any other process) while the log file is being split up
+        if not os.path.exists(path):
+            return 0
+        directory = archivePath(path)
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        existing = segments(path)
+        sequence = int(os.path.basename(existing[-1]).split(".")[-4]) + 1 if existing else 1
+        temporary = os.path.join(directory, f"{os.path.basename(path)}.{sequence:06d}.tmp") # A half-written segment is never read
+        with open(path, "rb") as file:
+            # Lines that are already in the newest segment are skipped (and removed from the log file)
+            start = alreadyArchived(file, existing[-1]) if existing else 0
+            file.seek(start)
+
+            # Logs are written in chronological order, so only the lines before the first recent line are archived (this keeps the order intact)
+            # They are compressed while they are read; {offset} is the byte position in the log file where archiving stopped
+            offset = start
+            count = 0
+            first = None
+            last = None
+            with open(temporary, "wb") as segmentFile:
+                with lzma.open(segmentFile, "wb") as compressed:
+                    for line in iter(file.readline, b""):
+                        date = lineDate(line)
+                        if date is not None and date >= cutoff:
+                            break
+                        compressed.write(line)
+                        offset += len(line)
+                        count += 1
+                        if date is not None:
+                            first = date if first is None else first
+                            last = date
+                segmentFile.flush()
+                os.fsync(segmentFile.fileno()) # On disk before the lines are removed from the log file
+
+            if first is None:
+                os.remove(temporary) # Nothing (readable) to archive
+                if start == 0:
+                    return 0
+                count = 0
+                offset = start
+            else:
+                segment = os.path.join(directory, f"{os.path.basename(path)}.{sequence:06d}.{first}.{last}.xz")
+                os.replace(temporary, segment)
+                storage.locking.syncDirectory(segment)
+
+            # Keep only the remaining (recent) lines in the log file
+            file.seek(offset)
+            with open(path + ".tmp", "wb") as hot:
+                shutil.copyfileobj(file, hot)
+                hot.flush()
+                os.fsync(hot.fileno())
+        os.replace(path + ".tmp", path)
+        storage.locking.syncDirectory(path)
+
+    return count
+
+
+def drop(path = "./output/logs", days = None):
+    """Delete archived segments that only contain lines older than {days} days; returns the number of deleted segments"""
+
+    days = hardLimitDays if days is None else days
+    if days is None:
+        return 0 # No hard limit
+    cutoff = str(datetime.date.today() - datetime.timedelta(days = days))
+    dropped = 0
+    for segment in segments(path):
+        if segmentDates(segment)[1] < cutoff:
+            if path == "./output/logs":
+                # Suspicious logs are numbered from the first one ever logged, so keep count of the ones that are gone
+                with lzma.open(segment, "rt") as file:
+                    suspicious = authentication.logging.countSuspicious(file)
+                authentication.logging.changeSuspicious(lambda state: state.update(dropped = state["dropped"] + suspicious))
+            os.remove(segment)
+            dropped += 1
+    return dropped
+
+
+def maintain(path = "./output/logs"):
+    """Run one round of log maintenance: archive old lines and drop archived data past the hard limit"""
+    try:
+        archived = archive(path)
+        dropped = drop(path)
+    except Exception as e:
+        authentication.logging.log("Log maintenance error", f"File: {path}, Error: {str(e)}", True)
+        return
+    if archived > 0 or dropped > 0:
+        authentication.logging.log("Log maintenance", f"File: {path}, Lines archived: {archived}, Archived segments deleted: {dropped}")
+
+
+def start(path = "./output/logs"):
+    """Start log maintenance in a background thread (runs every {interval} seconds for as long as the application runs)"""
+    global maintenanceThread
+
+    if maintenanceThread is not None and maintenanceThread.is_alive():
+        return False # Already running
+
+    def run():
+        while True:
+            maintain(path)
+            time.sleep(interval)
+
+    maintenanceThread = threading.Thread(target = run, name = "log-maintenance", daemon = True)
+    maintenanceThread.start()
+    return True
@@ -0,0 +1,219 @@
+# Online rotation of the symmetric encryption key, while the application keeps running (in this and other processes)
+#   1. A new key is added in front of the current one: new values are encrypted with it, values encrypted with either key can be read
+#   2. A background job re-encrypts every table and log file (and the member statistics and member ID counters) with the new key, a batch at a time, and rebuilds the keyed index columns (and name trigrams) along the way
+#      It records its progress after every batch (so it continues where it left off after a restart) and is throttled to a target I/O rate
+#   3. When everything has been re-encrypted, the old key is retired
+# Backups are not re-encrypted: a backup made before the rotation can't be restored after the old key is retired
+
+import json
+import lzma
+import os
+import sqlite3
+import threading
+import time
+import authentication.logging
+import storage.allocator
+import storage.encryption
+import storage.locking
+import storage.migrations
+import storage.repositories
+import storage.retention
+import storage.search
+import storage.statistics
+
+statePath = "./output/.rotation" # Progress of the rotation in progress (there is none if this file does not exist)
+logPaths = ["./output/logs"]
+bytesPerSecond = 1024 * 1024 # Target I/O rate of the re-encryption (bytes of encrypted data read per second)
+batchSize = 200 # Number of rows re-encrypted per transaction
+gracePeriod = 2 * storage.encryption.reloadInterval # Number of seconds other processes get to start using the new key before re-encrypting starts
+
+rotationThread = None
+
+
+class Throttle:
+    """Keeps the average I/O rate at or below {rate} bytes per second, by sleeping when it is ahead"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.bytes = 0
+
+
+    def __call__(self, size):
+        self.bytes += size
+        ahead = self.bytes / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def readState():
+    """Get the progress of the rotation in progress, or None if there is none"""
+    try:
+        with open(statePath, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def saveState(state):
+    with open(statePath + ".tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(statePath + ".tmp", statePath)
+
+
+def begin():
+    """Add a new key and record that everything has to be re-encrypted with it (see run); returns False if a rotation is already in progress"""
+    with storage.locking.locked(statePath, True):
+        if readState() is not None:
+            return False
+        saveState({ "started": time.time(), "done": {} })
+        keys = storage.encryption.addKey()
+    authentication.logging.log("Encryption key rotation started", f"Number of keys in use: {len(keys)}")
+    return True
+
+
+def reencryptTable(repository, state, throttle):
+    """Re-encrypt all rows of a table with the newest key and rebuild its index columns, a batch (transaction) at a time; returns the number of rows that could not be read"""
+    task = f"table {repository.table}"
+    position = state["done"].get(task, 0)
+    if position is True:
+        return 0 # Already done
+    fields = list(repository.form.fields)
+    columns = [repository._safeName(field) for field in fields]
+    failed = 0
+    sql = sqlite3.connect(repository.path, timeout = repository.busyTimeout, isolation_level = None) # Transactions are started explicitly
+    try:
+        while True:
+            with storage.migrations.transaction(sql):
+                rows = sql.execute(f"SELECT rowid, {', '.join(columns)} FROM {repository.table} WHERE rowid > ? ORDER BY rowid LIMIT {batchSize}", (position,)).fetchall()
+                updates = []
+                models = []
+                for rowid, *values in rows:
+                    try:
+                        model = dict(zip(fields, map(storage.encryption.decrypt, values)))
+                    except Exception:
+                        failed += 1 # Keep the row as it is (it can't be read with any key)
+                        continue
+                    indexes = repository._indexes(model)
+                    updates.append(tuple(map(storage.encryption.encrypt, model.values())) + tuple(indexes.values()) + (rowid,))
+                    models.append((rowid, model))
+                if len(updates) > 0:
+                    assignments = ", ".join(f"{column} = ?" for column in columns + list(indexes.keys()))
+                    sql.executemany(f"UPDATE {repository.table} SET {assignments} WHERE rowid = ?", updates)
+                    storage.search.index(repository, sql, models) # The trigram hashes too
+            if len(rows) == 0:
+                break
+            position = rows[-1][0]
+            state["done"][task] = position
+            saveState(state)
+            throttle(sum(len(value) for row in rows for value in row[1:]))
+    finally:
+        sql.close()
+    state["done"][task] = True
+    saveState(state)
+    return failed
+
+
+def reencryptLines(source, target, throttle):
+    """Write the lines of {source} to {target} with every value re-encrypted with the newest key; returns the number of lines that could not be read (which are kept as they are)"""
+    failed = 0
+    for line in source:
+        try:
+            target.write(json.dumps({ field: storage.encryption.encrypt(storage.encryption.decrypt(value)) for field, value in json.loads(line).items() }) + "\n")
+        except Exception:
+            target.write(line)
+            failed += 1
+        throttle(len(line))
+    return failed
+
+
+def reencryptLog(path, throttle):
+    """Re-encrypt a log file, which may be logged to meanwhile; returns the number of lines that could not be read
+    The lines are re-encrypted without locking the file; only the lines that were logged meanwhile are re-encrypted while the file is locked, right before it is replaced"""
+    while True:
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r") as source, open(path + ".rotate", "w") as target:
+            failed = reencryptLines(source, target, throttle)
+            with authentication.logging.lock, storage.locking.locked(path, True):
+                # Nothing can be logged until the file is replaced (so nothing may be logged here either)
+                if not os.path.exists(path) or not os.path.samestat(os.stat(path), os.fstat(source.fileno())):
+                    continue # The file was replaced meanwhile (lines were archived or removed): start again
+                failed += reencryptLines(source, target, lambda size: None) # Logged meanwhile
+                target.close()
+                os.replace(path + ".rotate", path)
+                return failed
+
+
+def reencryptSegment(segment, throttle):
+    """Re-encrypt an archived (compressed) log segment; returns the number of lines that could not be read"""
+    with lzma.open(segment, "rt") as source, lzma.open(segment + ".rotate", "wt") as target:
+        failed = reencryptLines(source, target, throttle)
+    if os.path.exists(segment):
+        os.replace(segment + ".rotate", segment)
+    else:
+        os.remove(segment + ".rotate") # Deleted meanwhile (see storage.retention.drop)
+    return failed
+
+
+def run():
+    """Re-encrypt everything with the newest key and retire the old key, continuing the rotation in progress (if there is one and no other process is working on it)
+    Returns whether a rotation was finished"""
+    with storage.locking.locked(statePath + ".job", True, False) as locked:
+        state = readState()
+        if not locked or state is None:
+            return False
+        time.sleep(max(0, state["started"] + gracePeriod - time.time()))
+        throttle = Throttle(bytesPerSecond)
+        failed = 0
+
+        for repository in [storage.repositories.Members(), storage.repositories.Users()]:
+            failed += reencryptTable(repository, state, throttle)
+        storage.statistics.change(storage.repositories.Members(), [], []) # Encrypted again with the newest key
+        storage.allocator.reencrypt(storage.repositories.Members())
+        for path in logPaths:
+            # The log file first, then its segments; they are listed again until none are left, because lines can be archived while the log file is re-encrypted
+            while True:
+                files = [file for file in [path] + storage.retention.segments(path) if not state["done"].get(f"file {file}")]
+                if len(files) == 0:
+                    break
+                for file in files:
+                    failed += reencryptLog(file, throttle) if file == path else reencryptSegment(file, throttle)
+                    state["done"][f"file {file}"] = True
+                    saveState(state)
+
+        with storage.locking.locked(statePath, True):
+            storage.encryption.retireKeys()
+            os.remove(statePath)
+    authentication.logging.log("Encryption key rotated", f"Everything is re-encrypted with the new key and the old key is retired. Values that could not be read: {failed}", failed > 0)
+    return True
+
+
+def status():
+    """Describe the rotation in progress (None if there is none)"""
+    state = readState()
+    if state is None:
+        return None
+    done = [task for task, position in state["done"].items() if position is True]
+    busy = [f"{task} (up to row {position})" for task, position in state["done"].items() if position is not True]
+    return f"Started {time.strftime('%Y-%m-%d %H:%M', time.localtime(state['started']))}, finished: {', '.join(done) or 'nothing yet'}" + (f", busy: {', '.join(busy)}" if busy else "")
+
+
+def start():
+    """Continue the rotation in progress (if any) in a background thread"""
+    global rotationThread
+
+    if rotationThread is not None and rotationThread.is_alive():
+        return False # Already running
+    if readState() is None:
+        return False # Nothing to do
+
+    def work():
+        try:
+            run()
+        except Exception as e:
+            authentication.logging.log("Encryption key rotation error", f"Error: {str(e)} (the rotation continues when the application is started again)", True)
+
+    rotationThread = threading.Thread(target = work, name = "key-rotation", daemon = True)
+    rotationThread.start()
+    return True
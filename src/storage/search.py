@@ -0,0 +1,111 @@
+# Typo tolerant (fuzzy) search of names, such as the first and last names of members (the {fuzzyFields} of a repository)
+# The trigrams (three character pieces) of the names are indexed as keyed hashes in the {table}_trigrams table, by rowid
+# A search shortlists the rows that share the most trigrams with the search term; only those are decrypted and ranked by edit distance
+# Without the key nothing can be learned from the trigram hashes, but like any index they do show how often the same trigram occurs
+
+import unicodedata
+import storage.encryption
+
+shortlistSize = 50 # Number of rows that are decrypted and ranked per search
+batchSize = 400 # Number of ids looked up per query (SQLite limits the number of parameters)
+
+
+def normalize(text):
+    """Lower case letters and digits without accents; everything else separates words ("Jan-Willem de Vriës" => "jan willem de vries")"""
+    text = unicodedata.normalize("NFKD", str(text)).lower()
+    return " ".join("".join(character if character.isalnum() else " " for character in text if not unicodedata.combining(character)).split())
+
+
+def trigrams(text):
+    """Trigrams of every word of a text, with the start and end of the word marked ("jan" => "  j", " ja", "jan", "an ")"""
+    result = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        for start in range(len(padded) - 2):
+            result.add(padded[start:start + 3])
+    return result
+
+
+def distance(a, b):
+    """Edit (Levenshtein) distance: the number of characters that have to be inserted, deleted or replaced to turn {a} into {b}"""
+    previous = list(range(len(b) + 1))
+    for i, characterA in enumerate(a, 1):
+        current = [i]
+        for j, characterB in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (characterA != characterB)))
+        previous = current
+    return previous[-1]
+
+
+def rank(text, model, fields):
+    """Edit distance between a (normalized) search term and the closest of the names in {model} (every field on its own, and all of them together)"""
+    names = [normalize(model[field]) for field in fields]
+    return min(distance(text, name) for name in names + [" ".join(names)])
+
+
+def createTable(repository, sql):
+    """Create the trigram table of a repository that has {fuzzyFields}; the trigrams of deleted rows are deleted with them"""
+    if len(repository.fuzzyFields) == 0:
+        return
+    table = repository.table
+    sql.execute(f"CREATE TABLE IF NOT EXISTS {table}_trigrams (trigram TEXT NOT NULL, row INTEGER NOT NULL)")
+    sql.execute(f"CREATE INDEX IF NOT EXISTS {table}_trigrams_trigram ON {table}_trigrams (trigram)")
+    sql.execute(f"CREATE INDEX IF NOT EXISTS {table}_trigrams_row ON {table}_trigrams (row)")
+    sql.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_trigrams_delete AFTER DELETE ON {table} BEGIN DELETE FROM {table}_trigrams WHERE row = OLD.rowid; END")
+
+
+def index(repository, sql, rows):
+    """Index the names of (rowid, model) pairs again, replacing their trigrams (in the transaction of {sql})"""
+    if len(repository.fuzzyFields) == 0 or len(rows) == 0:
+        return
+    table = repository.table
+    sql.executemany(f"DELETE FROM {table}_trigrams WHERE row = ?", [(rowid,) for rowid, _ in rows])
+    sql.executemany(f"INSERT INTO {table}_trigrams (trigram, row) VALUES (?, ?)", [(storage.encryption.keyedHash(trigram), rowid) for rowid, model in rows for trigram in trigrams(" ".join(str(model[field]) for field in repository.fuzzyFields))])
+
+
+def indexEncrypted(repository, sql, rows):
+    """Index the names of (rowid, *encrypted {fuzzyFields}) rows (see storage.migrations)"""
+    index(repository, sql, [(rowid, dict(zip(repository.fuzzyFields, map(storage.encryption.decrypt, values)))) for rowid, *values in rows])
+
+
+def added(repository, models):
+    """Index the names of {models} that were just added or changed (their rows are found by their id, in the keyed index); returns whether this was saved
+    This is part of the change in progress (if any), so it is saved together with the names, or not at all"""
+    if len(repository.fuzzyFields) == 0 or repository.schemaVersion < 4 or len(models) == 0:
+        return True
+    def indexed():
+        sql = repository.transaction
+        byId = { str(model[repository.idField]).upper(): model for model in models }
+        ids = list(byId)
+        for start in range(0, len(ids), batchSize):
+            hashes = [hash for id in ids[start:start + batchSize] for hash in storage.encryption.keyedHashes(id)]
+            results = sql.execute(f"SELECT rowid, {repository._safeName(repository.idField)} FROM {repository.table} WHERE _id_index IN ({', '.join('?' for _ in hashes)})", hashes).fetchall()
+            rows = [(rowid, byId.get(storage.encryption.decrypt(encrypted).upper())) for rowid, encrypted in results]
+            index(repository, sql, [(rowid, model) for rowid, model in rows if model is not None])
+        return True
+    return repository._write(indexed)
+
+
+def search(repository, text):
+    """Find the items whose names are most like {text}; returns (id, item) pairs, best match first
+    Only the rows on the shortlist from the trigram index are decrypted, and only the ones within a few typos of {text} are returned"""
+    text = normalize(text)
+    grams = trigrams(text)
+    if len(grams) == 0 or len(repository.fuzzyFields) == 0 or repository.schemaVersion < 4:
+        return []
+    table = repository.table
+    hashes = tuple(hash for gram in grams for hash in storage.encryption.keyedHashes(gram)) # More than one key while the key is being rotated
+    shortlist = repository._query(f"SELECT row, COUNT(*) FROM {table}_trigrams WHERE trigram IN ({', '.join('?' for _ in hashes)}) GROUP BY row ORDER BY COUNT(*) DESC LIMIT {shortlistSize}", hashes, True, len(hashes), True)
+    if not shortlist:
+        return []
+    shared = dict(shortlist)
+    fields = list(repository.form.fields)
+    results = repository._query(f"SELECT rowid, {repository._fields()} FROM {table} WHERE rowid IN ({', '.join('?' for _ in shared)})", tuple(shared), True, len(shared), True)
+    ranked = []
+    for rowid, *values in results or []:
+        item = repository.form.record(zip(fields, values), True)
+        score = rank(text, item, repository.fuzzyFields)
+        if score <= max(2, len(text) // 3):
+            ranked.append((score, -shared[rowid], item[repository.idField], item))
+    ranked.sort(key = lambda result: result[:2])
+    return [(id, item) for _, _, id, item in ranked]
@@ -0,0 +1,113 @@
+# Aggregate statistics of the members for management reports: members per city, gender split, age and weight distributions and registrations per month
+# The statistics are kept up to date while members are added, changed and removed (see storage.repositories.Members), so a report never reads the members
+# They are stored encrypted, as one value in the member_statistics table of the database, and can be rebuilt with a single streaming pass over the members
+# A change is counted in the same transaction as the change itself (see SQLiteRepository._write), so the statistics can't miss a change that was saved
+
+import json
+import sqlite3
+import authentication.logging
+import storage.encryption
+import storage.migrations
+
+statistics = ["city", "gender", "age", "weight", "registrations"] # Fields that are counted and how they are grouped: see keys
+fields = ["city", "gender", "age", "weight", "registrationDate"] # Member fields the statistics are made from
+
+
+def bucket(value, size):
+    """Group a number into a range of {size} ("34" => "30-39"); values that are not a number are counted as "unknown" """
+    try:
+        start = int(float(value)) // size * size
+    except (TypeError, ValueError):
+        return "unknown"
+    return f"{start}-{start + size - 1}"
+
+
+def keys(model):
+    """The group a member is counted in for every statistic"""
+    return {
+        "city": str(model["city"]),
+        "gender": str(model["gender"]).upper(),
+        "age": bucket(model["age"], 10),
+        "weight": bucket(model["weight"], 10),
+        "registrations": str(model["registrationDate"])[:7], # Year and month
+    }
+
+
+def empty():
+    return { "members": 0, **{ statistic: {} for statistic in statistics } }
+
+
+def count(stats, models, change):
+    """Add {change} (1 or -1) to the groups of every member in {models}"""
+    for model in models:
+        stats["members"] += change
+        for statistic, key in keys(model).items():
+            stats[statistic][key] = stats[statistic].get(key, 0) + change
+            if stats[statistic][key] == 0:
+                del stats[statistic][key]
+
+
+def createTable(sql):
+    sql.execute("CREATE TABLE IF NOT EXISTS member_statistics (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+
+def connect(repository):
+    sql = sqlite3.connect(repository.path, timeout = repository.busyTimeout, isolation_level = None) # Transactions are started explicitly
+    createTable(sql)
+    return sql
+
+
+def load(sql, table):
+    result = sql.execute("SELECT value FROM member_statistics WHERE name = ?", (table,)).fetchone()
+    return None if result is None else json.loads(storage.encryption.decrypt(result[0]))
+
+
+def save(sql, table, stats):
+    sql.execute("INSERT OR REPLACE INTO member_statistics (name, value) VALUES (?, ?)", (table, storage.encryption.encrypt(json.dumps(stats))))
+
+
+def read(repository):
+    """Get the statistics of the members {repository} (None if they have not been built yet)"""
+    sql = connect(repository)
+    try:
+        return load(sql, repository.table)
+    finally:
+        sql.close()
+
+
+def change(repository, removed, added):
+    """Count the members that were {removed} and {added} (a changed member is both) in the statistics, if they have been built; returns whether this was saved
+    This is part of the change in progress (if any), so it is saved together with the members, or not at all
+    Without any members, this only encrypts the statistics again (with the newest key, see storage.rotation)"""
+    def counted():
+        sql = repository.transaction
+        createTable(sql)
+        stats = load(sql, repository.table)
+        if stats is None:
+            return True # Not built yet: the members are counted when they are built
+        count(stats, removed, -1)
+        count(stats, added, 1)
+        save(sql, repository.table, stats)
+        return True
+    return repository._write(counted)
+
+
+def rebuild(repository, attempts = 3):
+    """Build the statistics again from all members, with one streaming pass; returns them (None if not all members could be read)
+    If members are changed while they are being counted, they are counted again (up to {attempts} times)"""
+    for attempt in range(attempts):
+        version = repository.version()
+        stats = empty()
+        try:
+            count(stats, (item for _, _, item in repository._scan(0, [repository.idField] + fields)), 1)
+        except Exception:
+            return None # The error has been logged
+        sql = connect(repository)
+        try:
+            with storage.migrations.transaction(sql):
+                if repository.version() == version or attempt == attempts - 1:
+                    save(sql, repository.table, stats)
+                    authentication.logging.log("Member statistics rebuilt", f"File: {repository.path}, Members: {stats['members']}")
+                    return stats
+        finally:
+            sql.close()
@@ -0,0 +1,144 @@
+# In-memory view of the decrypted items of a repository (opt-in, see Repository.enableView)
+# The view is loaded once with a streaming scan, kept up to date by this process's own changes and thrown away when another process changes the data (or may have)
+
+import authentication.logging
+import authentication.user
+import monitoring.metrics
+
+views = [] # All views that have been created (so they can be cleared when the session they were created in logs out)
+
+
+class View:
+    """Decrypted copy of all items in a repository, kept in memory"""
+
+    def __init__(self, repository, maxRows = 100000):
+        self.repository = repository
+        self.maxRows = maxRows # The view is not used for repositories with more items than this (to keep memory use bounded)
+        self.ids = [] # Item ids in storage order
+        self.items = {} # Item id => decrypted item
+        self.keys = {} # Uppercase item id => item id (ID fields are compared case insensitively, like the repositories do)
+        self.version = None # Repository version the items were loaded from (None = not loaded)
+        self.tooLarge = False
+        self.session = authentication.user.current() # Session the view belongs to (see clearAll)
+        views.append(self)
+
+
+    def clear(self):
+        """Drop all items from memory"""
+        self.ids = []
+        self.items = {}
+        self.keys = {}
+        self.version = None
+
+
+    def load(self):
+        """Load all items with a single streaming scan (returns False if the repository is too large to keep in memory)"""
+        self.clear()
+        version = self.repository.version()
+        ids = []
+        items = {}
+        keys = {}
+        for _, id, item in self.repository._scan():
+            if len(ids) >= self.maxRows:
+                # Over the limit: stop trying to keep this repository in memory
+                self.tooLarge = True
+                authentication.logging.log(f"In-memory view disabled for {self.repository.name}", f"More than {self.maxRows} items")
+                return False
+            ids.append(id)
+            items[id] = item.decrypted() if hasattr(item, "decrypted") else item # Keep the items decrypted (they take less memory that way)
+            keys[str(id).upper()] = id
+        self.ids = ids
+        self.items = items
+        self.keys = keys
+        self.version = version
+        return True
+
+
+    def ready(self):
+        """Check if the view can be used (loads it if needed, reloads it if the data was changed by another process)"""
+        if self.tooLarge:
+            return False
+        if not authentication.user.loggedIn():
+            self.clear() # Never keep decrypted data around without a logged in user
+            return False
+        if self.version is None or self.version != self.repository.version():
+            monitoring.metrics.increment("um_cache_misses_total", cache = "view", repository = self.repository.name)
+            try:
+                return self.load()
+            except Exception:
+                self.clear()
+                return False # Not all items could be read (the error has been logged): read from the repository instead
+        monitoring.metrics.increment("um_cache_hits_total", cache = "view", repository = self.repository.name)
+        return True
+
+
+    def key(self, id):
+        """Find the key an id is stored under"""
+        if id in self.items:
+            return id
+        return self.keys.get(str(id).upper()) if self.repository.idField is not None else None
+
+
+    def one(self, id):
+        """Get a copy of one item (so callers can't change the view by accident)"""
+        key = self.key(id)
+        return None if key is None else self.items[key].copy()
+
+
+    def list(self, offset, limit, search = None):
+        """List items the same way the repository's _list does (including setting nextOffset)"""
+        results = {}
+        position = offset
+        while position < len(self.ids) and len(results) < limit:
+            id = self.ids[position]
+            position += 1
+            item = self.items[id]
+            if search is not None and not self.repository._matches(id, item, search):
+                continue
+            results[id] = item.copy()
+        self.repository.nextOffset = position
+        self.repository.rowsScanned = position - offset
+        return results
+
+
+    def scan(self, offset = 0):
+        """Yield (position, id, item) for all items from {offset}, like the repository's _scan does"""
+        position = offset
+        for id in self.ids[offset:]:
+            position += 1
+            if id in self.items:
+                yield position, id, self.items[id].copy()
+
+
+    def changed(self, action, id, item, versions):
+        """Apply a change made by this process, if the data was not changed by someone else in the meantime
+        {versions} is the version of the data before and after the change, or None if it is not known whether someone else changed it too (see Repository._write)"""
+        if self.version is None:
+            return # Not loaded
+        if versions is None or versions[0] != self.version or self.repository.idField is None:
+            # (Possibly) changed by another process (or items are keyed by line number, which shift): load again when needed
+            self.clear()
+            return
+        key = self.key(id)
+        if action == "delete":
+            if key is not None:
+                self.ids.remove(key)
+                del self.items[key]
+                del self.keys[str(key).upper()]
+        elif key is None:
+            if len(self.ids) >= self.maxRows:
+                self.clear()
+                return
+            self.ids.append(id)
+            self.items[id] = self.repository.form.record(item)
+            self.keys[str(id).upper()] = id
+        else:
+            self.items[key] = self.repository.form.record(item)
+        self.version = versions[1]
+
+
+def clearAll(session):
+    """Drop the items of the views of {session} from memory (on logout; the views of other sessions, such as the console while serving, are kept)"""
+    for view in views:
+        if view.session is session:
+            view.clear()
@@ -6,19 +6,65 @@ Student number: 1064459
 Requires 'cryptography' package (run "pip install cryptography")
 """
 
+import argparse
 import authentication.logging
+import monitoring.metrics
 import storage.encryption
-import logic.menus
+import storage.retention
+import storage.rotation
+import logic.service
+import logic.transfer
 
 if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Member Management System")
+    parser.add_argument("--serve", action = "store_true", help = "Run as a local JSON-over-HTTP service instead of the console application")
+    parser.add_argument("--port", type = int, default = None, help = "Port for the service (default: 8080)")
+    parser.add_argument("--workers", type = int, default = None, help = "Number of requests the service handles at the same time (default: 8)")
+    parser.add_argument("--import-members", default = None, metavar = "FILE", help = "Import members from a CSV or JSONL file instead of running the console application")
+    parser.add_argument("--rejects", default = None, metavar = "FILE", help = "File to write rejected rows of the import to (default: next to the imported file)")
+    parser.add_argument("--export", default = None, choices = ["members", "users", "logs"], help = "Export members, users or logs to a CSV or JSONL file (given with --output) instead of running the console application")
+    parser.add_argument("--output", default = None, metavar = "FILE", help = "File to export to (.csv or .jsonl)")
+    parser.add_argument("--fields", default = None, help = "Fields to export, separated by commas (default: all)")
+    parser.add_argument("--filter", action = "append", default = [], metavar = "FIELD=VALUE", help = "Only export items with this value in this field (can be given more than once)")
+    parser.add_argument("--search", default = None, help = "Only export items with this value in any field")
+    options = parser.parse_args()
+    if options.export is not None and options.output is None:
+        parser.error("--export requires --output")
+    if any("=" not in condition for condition in options.filter):
+        parser.error("--filter should be given as FIELD=VALUE")
     
     try:
         # Generate encryption key
         if storage.encryption.initializeKeys():
             authentication.logging.log("Generate encryption keys", "This is done automatically if the keys do not exist yet") # Should be done only once
         
-        # Run the main logic
-        logic.menus.main.run()
+        # Archive old logs in the background
+        storage.retention.start()
+
+        # Continue an encryption key rotation that has not finished yet in the background
+        storage.rotation.start()
+
+        # Write metrics for the operations dashboards in the background
+        monitoring.metrics.start()
+
+        if options.serve:
+            # Serve several clients from this process
+            logic.service.serve(options.port, options.workers)
+        elif options.import_members is not None:
+            # Import members (after logging in)
+            logic.transfer.importMembers(options.import_members, options.rejects)
+        elif options.export is not None:
+            # Export (after logging in)
+            try:
+                fields = None if options.fields is None else [field.strip() for field in options.fields.split(",")]
+                logic.transfer.exportRepository(options.export, options.output, fields, dict(condition.split("=", 1) for condition in options.filter), options.search)
+            except ValueError as e:
+                print(e)
+        else:
+            # Run the main logic
+            import logic.menus # Creates the repositories of the menus (only imported here, so the worker processes of an import don't create them)
+            logic.menus.main.run()
 
     except Exception as e:
         # Log any exceptions that may occur
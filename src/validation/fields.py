@@ -2,6 +2,8 @@
 
 import validation.rules
 
+inputSource = input # Function that asks for one line of input (can be replaced to feed the application from a script)
+
 class Text:
     """Handle a validated text (string) value"""
 
@@ -38,7 +40,7 @@ class Text:
     def run(self, default = None):
         """Ask the user and validate the response (the response is guaranteed to be valid, or None)"""
         try:
-            value = input("> " + self.name + (f" ({default})" if default else "") + (" <" if isinstance(self, EmptyValue) else ": "))
+            value = inputSource("> " + self.name + (f" ({default})" if default else "") + (" <" if isinstance(self, EmptyValue) else ": "))
         except:
             # Most likly because user pressed Ctrl+C
             print() # newline
@@ -1,4 +1,7 @@
+from collections.abc import Mapping
+import monitoring.profiling
 import validation.fields
+import validation.records
 import validation.rules
 
 class Form:
@@ -32,19 +35,20 @@ class Form:
         return result if valid else None
     
 
-    def validate(self, model):
-        """Validate a model (dict) to be valid for this form (also checks for any None values)"""
+    @monitoring.profiling.timed()
+    def validate(self, model, fields = None):
+        """Validate a model (dict) to be valid for this form (also checks for any None values), or only the given {fields} of it"""
         self.model = None
         self.errors = {}
-        if not isinstance(model, dict):
-            # Not a dictionary
+        if not isinstance(model, Mapping):
+            # Not a dictionary (or a record)
             return False
-        for field in self.fields:
+        for field in (self.fields if fields is None else fields):
             if field not in model:
                 self.errors[field] = ["Field is missing"]
                 # Model is missing field
                 return False
-        for field in model:
+        for field in (model if fields is None else fields):
             if field not in self.fields:
                 # Model contains unknown field
                 self.errors[field] = ["Unknown field"]
@@ -68,6 +72,27 @@ class Form:
         print() # newline
 
     
+    def recordType(self):
+        """Get the compact record class for models of this form (see validation.records)"""
+        if getattr(self, "_recordType", None) is None:
+            self._recordType = validation.records.recordType(self.name, self.fields)
+        return self._recordType
+
+
+    def record(self, values, encrypted = False):
+        """Create a record from a dict or (field, value) pairs; a plain dict is returned if the values don't fit the form (so validation can report it)"""
+        values = values if isinstance(values, dict) else dict(values)
+        try:
+            return self.recordType()(values, encrypted)
+        except KeyError:
+            return { field: validation.records.decrypt(value) for field, value in values.items() } if encrypted else values
+
+
+    def listFields(self, idField = None):
+        """Fields that are needed to show a model in a table row: the ID field and the columns"""
+        return ([idField] if idField is not None else []) + [field for field in self.getColumns() if field != idField]
+
+
     def getColumns(self):
         """Get list of columns and widths for table view"""
         # Default to showing all values with a max width of 15
@@ -0,0 +1,152 @@
+# Compact record types for form models: every form gets a generated class with one __slots__ entry per field
+# Records behave like a dict (item["field"], "field" in item, item.items(), dict(item), ...) so they can be used anywhere a model is used,
+# but they take a fraction of the memory of a dict, which matters when a lot of items are kept in memory
+# Records read from storage can hold the encrypted values and decrypt each field only when it is first used
+
+import collections
+from collections.abc import MutableMapping
+import storage.encryption
+
+recordTypes = {} # Generated record classes by (name, fields)
+
+
+class Record(MutableMapping):
+    """Base class for records: dict-like access to the field attributes (a field that has not been set is treated as missing)"""
+
+    __slots__ = ("_pending",) # Bit mask of the fields that still hold an encrypted value
+    fields = () # Field names in form order (set for each generated class)
+    bits = {} # Field name => bit in _pending (set for each generated class)
+
+
+    def __init__(self, values = None, encrypted = False):
+        """Initialize from a dict or a list of (field, value) pairs, which are decrypted on first use if {encrypted} is True"""
+        self._pending = 0
+        if values is not None:
+            for field, value in (values.items() if hasattr(values, "items") else values):
+                self[field] = value
+                if encrypted:
+                    self._pending |= self.bits[field]
+
+
+    def __getitem__(self, field):
+        bit = self.bits.get(field)
+        if bit is None:
+            raise KeyError(field)
+        try:
+            value = getattr(self, field)
+        except AttributeError:
+            raise KeyError(field) # Field has not been set
+        if self._pending & bit:
+            # First use of an encrypted value: decrypt it and keep the result
+            value = decrypt(value)
+            setattr(self, field, value)
+            self._pending &= ~bit
+        return value
+
+
+    def __setitem__(self, field, value):
+        bit = self.bits.get(field)
+        if bit is None:
+            raise KeyError(field) # Records can't contain unknown fields
+        setattr(self, field, value)
+        self._pending &= ~bit
+
+
+    def __delitem__(self, field):
+        bit = self.bits.get(field)
+        if bit is None:
+            raise KeyError(field)
+        try:
+            delattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+        self._pending &= ~bit
+
+
+    def __iter__(self):
+        for field in self.fields:
+            if hasattr(self, field):
+                yield field
+
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+    def __repr__(self):
+        return repr(dict(self.items())) # Show like a dict (this is what ends up in the logs)
+
+
+    def copy(self):
+        """Shallow copy, like dict.copy() (values that have not been decrypted yet are copied without decrypting them)"""
+        record = self.__class__()
+        for field in self.fields:
+            if hasattr(self, field):
+                setattr(record, field, getattr(self, field))
+        record._pending = self._pending
+        return record
+
+
+    def decrypted(self):
+        """Decrypt all fields that have not been decrypted yet (returns the record itself)"""
+        for field in self:
+            self[field]
+        return self
+
+
+def decrypt(value):
+    """Decrypt a value, or return None if it can't be decrypted (which will make the item fail validation)"""
+    try:
+        return storage.encryption.decrypt(value)
+    except:
+        return None
+
+
+def decryptValues(values):
+    """Decrypt a list of values (runs in a worker process, see decryptAhead)"""
+    return [decrypt(value) for value in values]
+
+
+def decryptAhead(source, executor, batchSize = 500, ahead = 4):
+    """Yield the (position, id, record) items of {source} with all their fields decrypted, in the same order
+    The values are decrypted a batch at a time by decryptValues on {executor}, a few batches ahead of the items being used"""
+    pending = collections.deque()
+
+    def submit(batch):
+        values = [getattr(record, field) for _, _, record in batch if isinstance(record, Record) for field in record if record._pending & record.bits[field]]
+        pending.append((batch, executor.submit(decryptValues, values)))
+
+    def finish():
+        batch, future = pending.popleft()
+        values = iter(future.result())
+        for _, _, record in batch:
+            if isinstance(record, Record):
+                for field in [field for field in record if record._pending & record.bits[field]]:
+                    record[field] = next(values)
+        return batch
+
+    batch = []
+    for item in source:
+        batch.append(item)
+        if len(batch) == batchSize:
+            submit(batch)
+            batch = []
+            if len(pending) >= ahead:
+                yield from finish()
+    if len(batch) > 0:
+        submit(batch)
+    while pending:
+        yield from finish()
+
+
+def recordType(name, fields):
+    """Get the record class for a form with this name and these fields (generated once and reused)"""
+    fields = tuple(fields)
+    key = (name, fields)
+    if key not in recordTypes:
+        for field in fields:
+            if not field.isidentifier() or hasattr(Record, field):
+                raise ValueError(f"Field '{field}' can't be used in a record")
+        bits = { field: 1 << n for n, field in enumerate(fields) }
+        recordTypes[key] = type(name.replace(" ", "") + "Record", (Record,), { "__slots__": fields, "fields": fields, "bits": bits })
+    return recordTypes[key]
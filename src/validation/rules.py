@@ -28,7 +28,8 @@ passwordRules = [atLeastThisLong(12), noLongerThan(30), containsLowercase, conta
 # Member ID rules
 tenDigits = lambda name: (f"{name} should be ten digits", lambda s: re.search(r"^\d{10}$", s))
 twoDigitYear = lambda name: (f"{name} should start with a two-digit year that is not in the future", lambda s: validation.datetime.validShortYear(s[:2]))
-checksum = lambda name: (f"{name} should have a valid checksum", lambda s: str(reduce(lambda check, digit: (check + ord(digit) - 8) % 10, s[:9], 0)) == s[9:])
+memberIDChecksum = lambda s: str(reduce(lambda check, digit: (check + ord(digit) - 8) % 10, s[:9], 0)) # Check digit for the first nine digits of a member ID
+checksum = lambda name: (f"{name} should have a valid checksum", lambda s: memberIDChecksum(s) == s[9:])
 memberIDRules = [tenDigits, twoDigitYear, checksum]
 
 # Profile fields rules